@@ -0,0 +1,228 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Round-trip benchmark for the REST forwarding path.
+
+A client sends requests to an EndPoint, which forwards them over an
+in-process stand-in for the jabberlink bus to a RepeaterMessageHandler,
+which in turn talks HTTP to a local stub upstream. Everything runs in one
+reactor on the loopback interface, so no network or rBuilder is needed.
+
+Usage: forwarding_bench.py [options]
+"""
+
+
+import optparse
+import os
+import StringIO
+import sys
+import time
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.web import client
+from twisted.web import resource
+from twisted.web import server
+from twisted.web.http_headers import Headers
+from twisted.words.protocols.jabber.jid import JID
+
+try:
+    import rest_forwarding_plugin as rfp
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(
+        __file__)), '..', 'rmake_plugins'))
+    import rest_forwarding_plugin as rfp
+
+from rpath_repeater.utils import throttle
+
+
+class Upstream(resource.Resource):
+    "Stub rBuilder: replies with a body as large as the request body"
+    isLeaf = True
+
+    def render(self, request):
+        body = request.content.read()
+        request.setHeader('Content-Type', 'application/xml')
+        return body or '<ok/>'
+
+
+class FakeNeighbor(object):
+    def __init__(self, jid, onReply):
+        self.jid = jid
+        self.onReply = onReply
+
+    def send(self, msg):
+        self.onReply(msg)
+
+
+class FakeLink(object):
+    """
+    Stand-in for the jabberlink link: messages are handed to the message
+    handler on the next reactor turn, and replies fire the deferred
+    returned by sendWithDeferred.
+    """
+
+    def __init__(self, sourceJID):
+        self.sourceJID = sourceJID
+        self.handler = None
+        self.messages = 0
+        self.bytes = 0
+
+    def sendWithDeferred(self, targetJID, msg):
+        self.messages += 1
+        self.bytes += len(msg.payload)
+        d = defer.Deferred()
+        def onReply(reply):
+            self.bytes += len(reply.payload)
+            reactor.callLater(0, d.callback, [reply])
+        neighbor = FakeNeighbor(self.sourceJID, onReply)
+        reactor.callLater(0, self.handler.onMessage, neighbor, msg)
+        return d
+
+
+class FakeBus(object):
+    def __init__(self, link, targetJID):
+        self.link = link
+        self.targetJID = targetJID
+
+
+class Bench(object):
+    def __init__(self, options):
+        self.options = options
+        upstreamPort = reactor.listenTCP(0, server.Site(Upstream()),
+            interface='127.0.0.1')
+        targetUrl = 'http://127.0.0.1:%d' % upstreamPort.getHost().port
+
+        self.link = FakeLink(JID('node@localhost/rmake'))
+        bus = FakeBus(self.link, JID('dispatcher@localhost/rmake'))
+        self.link.handler = rfp.RepeaterMessageHandler(targetUrl, {},
+            throttle=self._throttle(options.upstream_max_in_flight),
+            retryAfter=1)
+        if options.batch_window:
+            batcher = rfp.MessageBatcher(bus, options.batch_window / 1000.0,
+                options.batch_max_size)
+        else:
+            batcher = None
+        endpoint = rfp.EndPoint(bus, compactFraming=not options.chutney,
+            throttle=self._throttle(options.max_in_flight), retryAfter=1,
+            batcher=batcher)
+        if options.direct:
+            endpoint.direct = rfp.DirectForwarder(targetUrl)
+        endpointPort = reactor.listenTCP(0,
+            server.Site(resource.IResource(endpoint)), interface='127.0.0.1')
+        self.endpointUrl = 'http://127.0.0.1:%d/api/v1/inventory/systems' % (
+            endpointPort.getHost().port)
+
+        pool = client.HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = max(options.concurrency)
+        self.agent = client.Agent(reactor, pool=pool)
+
+    @classmethod
+    def _throttle(cls, maxInFlight):
+        if not maxInFlight:
+            return None
+        return throttle.RequestThrottle(maxInFlight=maxInFlight)
+
+    def request(self, body):
+        start = time.time()
+        d = self.agent.request('PUT', self.endpointUrl,
+            Headers({'Content-Type' : ['application/xml']}),
+            client.FileBodyProducer(StringIO.StringIO(body)))
+        d.addCallback(lambda response: client.readBody(response).addCallback(
+            lambda _: response.code))
+        d.addCallback(lambda code: (code, time.time() - start))
+        return d
+
+    @defer.inlineCallbacks
+    def worker(self, body, count, results):
+        for _ in xrange(count):
+            code, latency = yield self.request(body)
+            results.append((code, latency))
+
+    @defer.inlineCallbacks
+    def runOne(self, bodySize, concurrency):
+        body = os.urandom(bodySize)
+        # Warm up connections
+        yield defer.gatherResults([ self.request(body)
+            for _ in xrange(concurrency) ])
+        self.link.messages = self.link.bytes = 0
+        results = []
+        perWorker = max(1, self.options.requests / concurrency)
+        start = time.time()
+        yield defer.gatherResults([ self.worker(body, perWorker, results)
+            for _ in xrange(concurrency) ])
+        elapsed = time.time() - start
+        self.report(bodySize, concurrency, results, elapsed)
+
+    def report(self, bodySize, concurrency, results, elapsed):
+        latencies = sorted(x[1] for x in results)
+        errors = len([ x for x in results if x[0] != 200 ])
+        def pct(p):
+            idx = min(len(latencies) - 1, int(len(latencies) * p / 100.0))
+            return latencies[idx] * 1000
+        print "%9d %6d %8d %10.1f %8.2f %8.2f %8.2f %8.2f %7d %8d" % (
+            bodySize, concurrency, len(results), len(results) / elapsed,
+            pct(50), pct(90), pct(99), latencies[-1] * 1000, errors,
+            self.link.messages)
+
+    @defer.inlineCallbacks
+    def run(self):
+        print "%9s %6s %8s %10s %8s %8s %8s %8s %7s %8s" % ("body", "conc",
+            "requests", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms",
+            "errors", "bus msgs")
+        try:
+            for bodySize in self.options.body_sizes:
+                for concurrency in self.options.concurrency:
+                    yield self.runOne(bodySize, concurrency)
+        finally:
+            reactor.stop()
+
+
+def intList(option, opt, value, parser):
+    setattr(parser.values, option.dest, [ int(x) for x in value.split(',') ])
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('--body-sizes', type='string', action='callback',
+        callback=intList, default=[0, 1024, 64 * 1024],
+        help="comma-separated request body sizes (default: %default)")
+    parser.add_option('--concurrency', type='string', action='callback',
+        callback=intList, default=[1, 8, 32],
+        help="comma-separated concurrency levels (default: %default)")
+    parser.add_option('--requests', type='int', default=2000,
+        help="requests per run (default: %default)")
+    parser.add_option('--chutney', action='store_true', default=False,
+        help="use chutney instead of the compact framing")
+    parser.add_option('--batch-window', type='int', default=0,
+        help="batch window in milliseconds (default: off)")
+    parser.add_option('--batch-max-size', type='int', default=16)
+    parser.add_option('--max-in-flight', type='int', default=0,
+        help="EndPoint throttle (default: unlimited)")
+    parser.add_option('--upstream-max-in-flight', type='int', default=0,
+        help="repeater throttle (default: unlimited)")
+    parser.add_option('--direct', action='store_true', default=False,
+        help="bypass the bus with direct HTTP")
+    options, args = parser.parse_args()
+
+    bench = Bench(options)
+    reactor.callWhenRunning(bench.run)
+    reactor.run()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Compare the compact framing used for forwarded REST messages with chutney.
+
+Usage: framing_bench.py [iterations]
+"""
+
+
+import os
+import sys
+import time
+
+from rmake3.lib import chutney
+
+from rpath_repeater.utils import framing
+
+HEADERS = {
+    'Host' : ['rbuilder.example.com'],
+    'Content-Type' : ['application/xml; charset="utf-8"'],
+    'X-Forwarded-For' : ['10.0.0.12'],
+    'X-Forwarded-Proto' : ['https'],
+    'User-Agent' : ['rpath-tools/5.0'],
+}
+
+BODY_SIZES = [ 0, 512, 16 * 1024, 1024 * 1024 ]
+
+
+def makeRequest(bodySize):
+    return dict(method='PUT', url='/api/v1/inventory/systems/1234',
+        headers=HEADERS, body=os.urandom(bodySize))
+
+def makeReply(bodySize):
+    return dict(status=200, message='OK', headers=HEADERS,
+        body=os.urandom(bodySize))
+
+def chutneyCodec():
+    return chutney.dumps, chutney.loads, chutney.dumps, chutney.loads
+
+def framingCodec():
+    def encodeRequest(d):
+        return framing.encodeRequest(d['method'], d['url'], d['headers'],
+            d['body'])
+    def encodeReply(d):
+        return framing.encodeReply(d['status'], d['message'], d['headers'],
+            d['body'])
+    return (encodeRequest, framing.decodeRequest,
+        encodeReply, framing.decodeReply)
+
+def timeit(func, arg, iterations):
+    start = time.time()
+    for _ in xrange(iterations):
+        func(arg)
+    return time.time() - start
+
+def bench(name, codec, bodySize, iterations):
+    encReq, decReq, encRep, decRep = codec()
+    req = makeRequest(bodySize)
+    rep = makeReply(bodySize)
+    reqData = encReq(req)
+    repData = encRep(rep)
+    results = [
+        timeit(encReq, req, iterations),
+        timeit(decReq, reqData, iterations),
+        timeit(encRep, rep, iterations),
+        timeit(decRep, repData, iterations),
+    ]
+    rates = [ iterations / max(x, 1e-9) for x in results ]
+    print "%-8s %9d %9d %9d %12.0f %12.0f %12.0f %12.0f" % (
+        (name, bodySize, len(reqData), len(repData)) + tuple(rates))
+
+def main():
+    iterations = 10000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    print "%-8s %9s %9s %9s %12s %12s %12s %12s" % ("codec", "body",
+        "req size", "rep size", "enc req/s", "dec req/s", "enc rep/s",
+        "dec rep/s")
+    for bodySize in BODY_SIZES:
+        # Keep the total amount of copied data reasonable for large bodies
+        count = max(10, min(iterations, iterations * 1024 / max(bodySize, 1)))
+        for name, codec in [ ('chutney', chutneyCodec),
+                ('framing', framingCodec) ]:
+            bench(name, codec, bodySize, count)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Compare the compiled per-class XML serializers and dictionary converters
+of the models with the implementations they replaced: toXmlDom and toDict
+as they were before they were compiled (copied below), and the generic
+_BaseSlotCompare.fromDict, which had no earlier equivalent.
+
+Usage: models_bench.py [count]
+"""
+
+
+import sys
+import time
+
+from rpath_repeater import models
+
+
+def makeVersion(i):
+    return models.Version(full='/example.com@rpath:devel/1.%d-1-1' % i,
+        label='example.com@rpath:devel', revision='1.%d-1-1' % i,
+        ordering='1300000000.%03d' % (i % 1000), flavor='is: x86_64')
+
+def makeTrove(i):
+    return models.Trove(name='group-appliance-%d' % i,
+        version=makeVersion(i), flavor='is: x86_64')
+
+def makeImageFile(i):
+    return models.ImageFile(title='Image %d' % i, size=1024 * i,
+        sha1='%040x' % i, file_name='image-%d.tar.gz' % i,
+        url='https://example.com/downloads/%d' % i)
+
+def makeCommandArguments(i, credentials=1000):
+    allCredentials = [ models.TargetUserCredentials(rbUser='user%d' % x,
+        rbUserId=x, isAdmin=(x == 0), opaqueCredentialsId=x,
+        credentials=dict(username='user%d' % x, password='secret'))
+        for x in xrange(credentials) ]
+    return models.TargetCommandArguments(
+        jobUrl='https://rbuilder.example.com/api/v1/jobs/%d' % i,
+        authToken='%032x' % i,
+        targetConfiguration=models.TargetConfiguration(targetType='ec2',
+            targetName='aws', alias='aws', config=dict(region='us-east-1')),
+        targetUserCredentials=allCredentials[0],
+        targetAllUserCredentials=allCredentials,
+        args=dict(params=dict(imageId='ami-%d' % i)),
+        zoneAddresses=[ '10.0.0.%d' % x for x in range(1, 5) ])
+
+def makeAssimilatorParams(i):
+    return models.AssimilatorParams(host='10.1.%d.%d' % (i / 256, i % 256),
+        port=22, caCert='-----BEGIN CERTIFICATE-----',
+        sshAuth=[ dict(sshUser='root', sshPassword='secret'),
+            dict(sshUser='admin', sshKey='/root/.ssh/id_rsa') ],
+        platformLabels=[ ('centos-5', 'centos.example.com@rpath:5') ],
+        projectLabel='project.example.com@rpath:1',
+        installTrove='group-rpath-tools', eventUuid='%032x' % i)
+
+SERIALIZABLE = [ models.Version, models.Trove, models.ImageFile ]
+CONVERTIBLE = [ models.TargetCommandArguments, models.TargetConfiguration,
+    models.TargetUserCredentials, models.AssimilatorParams ]
+
+def baselineToXmlDom(self, tag=None):
+    "_Serializable.toXmlDom before per-class serializers were compiled"
+    tag = self._getTag()
+    if tag is None:
+        return None
+    children = []
+    for slot in self.__slots__:
+        val = getattr(self, slot)
+        if val is None:
+            continue
+        if hasattr(val, 'toXmlDom'):
+            val = val.toXmlDom(slot)
+            if val is None:
+                continue
+            children.append(val)
+            continue
+        if not isinstance(val, (basestring, int, long, float)):
+            continue
+        # Assume string
+        val = unicode(val)
+        # Crude attempt to not doubly-encode xml
+        if val.lstrip().startswith('<') and val.rstrip().endswith('>'):
+            children.append(models.XML.CDATA(slot, val))
+        else:
+            children.append(models.XML.Text(slot, val))
+    return models.XML.Element(tag, *children)
+
+def baselineToDict(self):
+    "_BaseSlotCompare.toDict before per-class converters were compiled"
+    ret = {}
+    for slot in self.__slots__:
+        val = getattr(self, slot)
+        if val is not None:
+            if isinstance(val, models.SlotCompare):
+                val = val.toDict()
+            ret[slot] = val
+    return ret
+
+def genericFromDict(cls, values):
+    return models._BaseSlotCompare.fromDict.im_func(cls, values)
+
+def timed(classes, methods, func, *args):
+    """
+    Time func(*args), with methods, a {name: function} dictionary,
+    installed on classes
+    """
+    saved = [ (cls, name, cls.__dict__[name])
+        for cls in classes for name in methods ]
+    for cls, name, _ in saved:
+        setattr(cls, name, methods[name])
+    try:
+        start = time.time()
+        ret = func(*args)
+        return time.time() - start, ret
+    finally:
+        for cls, name, method in saved:
+            setattr(cls, name, method)
+
+def serialize(objects):
+    return [ x.toXmlDom() for x in objects ]
+
+def toDicts(objects):
+    return [ x.toDict() for x in objects ]
+
+def fromDicts(cls, values, bulk):
+    if bulk:
+        return cls.fromDictList(values)
+    return [ cls.fromDict(x) for x in values ]
+
+def report(name, count, baselineTime, compiledTime):
+    print "%-31s %9d %12.0f %12.0f %7.2fx" % (name, count,
+        count / max(baselineTime, 1e-9), count / max(compiledTime, 1e-9),
+        baselineTime / max(compiledTime, 1e-9))
+
+def main():
+    count = 100000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    print "%-31s %9s %12s %12s %8s" % ("benchmark", "objects",
+        "baseline/s", "compiled/s", "speedup")
+    for name, factory in [ ('Version', makeVersion), ('Trove', makeTrove),
+            ('ImageFile', makeImageFile) ]:
+        objects = [ factory(i) for i in xrange(count) ]
+        baselineTime, baselineDoms = timed(SERIALIZABLE,
+            dict(toXmlDom=baselineToXmlDom), serialize, objects)
+        compiledTime, compiledDoms = timed(SERIALIZABLE, {}, serialize,
+            objects)
+        for x, y in zip(baselineDoms[:100], compiledDoms[:100]):
+            assert models.XML.toString(x) == models.XML.toString(y)
+        del baselineDoms, compiledDoms
+        report(name + ' toXmlDom', count, baselineTime, compiledTime)
+
+    # Payloads with 1000 user credentials each
+    payloads = max(1, count / 1000)
+    for name, cls, objects in [
+            ('TargetCommandArguments', models.TargetCommandArguments,
+                [ makeCommandArguments(i) for i in xrange(payloads) ]),
+            ('AssimilatorParams', models.AssimilatorParams,
+                [ makeAssimilatorParams(i) for i in xrange(count) ]) ]:
+        baselineTime, baselineDicts = timed(CONVERTIBLE,
+            dict(toDict=baselineToDict), toDicts, objects)
+        compiledTime, compiledDicts = timed(CONVERTIBLE, {}, toDicts,
+            objects)
+        assert baselineDicts == compiledDicts
+        report(name + ' toDict', len(objects), baselineTime, compiledTime)
+        genericTime, genericObjs = timed(CONVERTIBLE,
+            dict(fromDict=classmethod(genericFromDict)), fromDicts, cls,
+            compiledDicts, False)
+        compiledTime, compiledObjs = timed(CONVERTIBLE, {}, fromDicts, cls,
+            compiledDicts, True)
+        assert genericObjs[0].toDict() == compiledObjs[0].toDict()
+        del baselineDicts, compiledDicts, genericObjs, compiledObjs
+        report(name + ' fromDict', len(objects), genericTime,
+            compiledTime)
+
+if __name__ == '__main__':
+    sys.exit(main())
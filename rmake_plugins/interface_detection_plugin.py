@@ -16,26 +16,111 @@
 
 
 import sys
+import time
+import logging
 import StringIO
+import threading
 
 from rmake3.core import types
 from rmake3.core import handler
 
 from conary.lib.formattrace import formatTrace
 
+from rpath_repeater import models
 from rpath_repeater.codes import Codes as C
 from rpath_repeater.utils import nodeinfo
 from rpath_repeater.utils import base_forwarding_plugin as bfp
 
+log = logging.getLogger(__name__)
+
 PREFIX = 'com.rpath.sputnik'
 INTERFACE_JOB = PREFIX + '.interfacedetectionplugin'
 INTERFACE_DETECT_TASK = PREFIX + '.detect_management_interface'
+INTERFACE_BULK_JOB = PREFIX + '.bulkinterfacedetectionplugin'
+INTERFACE_BULK_DETECT_TASK = PREFIX + '.detect_management_interfaces'
 
 IDParams = types.slottype(
-    'IDParams', 'host interfacesList')
+    'IDParams', 'host interfacesList timeout adaptiveTimeout')
+
+IDBulkParams = types.slottype(
+    'IDBulkParams',
+    'hosts interfacesList concurrency timeout adaptiveTimeout')
 
 IDData = types.slottype('IDData', 'p response')
 
+
+class InterfaceStats(object):
+    """
+    Probe outcomes of management interfaces, by subnet. Systems in a subnet
+    tend to all have the same interface, so this is used to guess which one
+    new systems are likely to have. Host names count in the subnet of their
+    cached address; hosts whose subnet is unknown are left out.
+    """
+    # Evidence needed before making a guess
+    MinAttempts = 8
+    MinRate = 0.5
+
+    def __init__(self):
+        self._table = {}
+        self._lock = threading.Lock()
+
+    def record(self, host, interface, success):
+        """
+        Record a probe of interface, an (interfaceHref, port) tuple, on host.
+        """
+        subnet = nodeinfo.subnet_of(host, resolve=True)
+        if subnet is None:
+            return
+        with self._lock:
+            counts = self._table.setdefault(subnet, {}).setdefault(
+                interface, [0, 0])
+            counts[0] += 1
+            if success:
+                counts[1] += 1
+
+    def predict(self, host, interfaces):
+        """
+        Return the index of the interface most likely to be available on
+        host, or None if too little is known about its subnet.
+        """
+        subnet = nodeinfo.subnet_of(host, resolve=True)
+        if subnet is None:
+            return None
+        best, bestRate = None, self.MinRate
+        with self._lock:
+            subnetStats = self._table.get(subnet, {})
+            for idx, interface in enumerate(interfaces):
+                attempts, successes = subnetStats.get(interface, (0, 0))
+                if attempts < self.MinAttempts:
+                    continue
+                rate = float(successes) / attempts
+                if rate > bestRate:
+                    best, bestRate = idx, rate
+        return best
+
+    def getTable(self):
+        """
+        Return the success rates, as {subnet: {(interfaceHref, port):
+        dict(attempts, successes, rate)}}
+        """
+        with self._lock:
+            return dict((subnet, dict((interface, dict(attempts=attempts,
+                    successes=successes,
+                    rate=float(successes) / attempts))
+                for interface, (attempts, successes) in subnetStats.items()))
+                for subnet, subnetStats in self._table.items())
+
+    def logTable(self):
+        "Log the success rates, one line per subnet"
+        for subnet, subnetStats in sorted(self.getTable().items()):
+            log.info("Interface stats for %s: %s", subnet,
+                ', '.join('%s:%s %d/%d' % (href, port, x['successes'],
+                        x['attempts'])
+                    for (href, port), x in sorted(subnetStats.items())))
+
+# Shared by all detection tasks in this worker
+interfaceStats = InterfaceStats()
+
 class InterfaceDetectionForwardPlugin(bfp.BaseForwardingPlugin):
     """
     Setup dispatcher side of the interface detection.
@@ -43,10 +128,12 @@ class InterfaceDetectionForwardPlugin(bfp.BaseForwardingPlugin):
 
     def dispatcher_pre_setup(self, dispatcher):
         handler.registerHandler(InterfaceDetectionHandler)
+        handler.registerHandler(InterfaceBulkDetectionHandler)
 
     def worker_get_task_types(self):
         return {
             INTERFACE_DETECT_TASK: DetectInterfaceTask,
+            INTERFACE_BULK_DETECT_TASK: DetectInterfacesBulkTask,
         }
 
 
@@ -60,6 +147,8 @@ class InterfaceDetectionHandler(bfp.BaseHandler):
 
     def setup(self):
         bfp.BaseHandler.setup(self)
+        self.timeout = None
+        self.adaptiveTimeout = False
 
         cfg = self.dispatcher.cfg
 
@@ -71,14 +160,18 @@ class InterfaceDetectionHandler(bfp.BaseHandler):
 
                 if key == 'timeout':
                     self.timeout = int(value)
+                elif key == 'adaptiveTimeout':
+                    self.adaptiveTimeout = value.lower() in (
+                        '1', 'true', 'yes', 'on')
                 elif key == 'port':
                     self.port = int(value)
 
     def initCall(self):
         bfp.BaseHandler.initCall(self)
-        self.params = self.data.pop('params', None)
-        self.interfacesList = self.params.pop('interfacesList', None)
-        self.eventUuid = self.params.pop('eventUuid', None)
+        self.params = models.ManagementInterfaceParams.fromDict(
+            self.data.pop('params', None) or {})
+        self.interfacesList = self.params.interfacesList
+        self.eventUuid = self.params.eventUuid
 
     def callDetectInterface(self):
         self.setStatus(C.MSG_START, 'Initializing Interface Detection')
@@ -100,16 +193,116 @@ class InterfaceDetectionHandler(bfp.BaseHandler):
     def detect_management_interface(self):
         self.setStatus(C.MSG_NEW_TASK, 'Creating task')
 
-        args = IDData(IDParams(self.params['host'], self.interfacesList))
+        args = IDData(IDParams(self.params.host, self.interfacesList,
+            self.timeout, self.adaptiveTimeout))
         task = self.newTask('detect_management_interface',
             INTERFACE_DETECT_TASK, args, zone=self.zone)
         return self._handleTask(task)
 
 
+class InterfaceBulkDetectionHandler(bfp.BaseHandler):
+    """
+    Dispatcher plugin for probing many systems in a single job. Results are
+    posted incrementally, as the worker reports them; the final results only
+    hold the systems not already posted.
+    """
+
+    jobType = INTERFACE_BULK_JOB
+    firstState = 'callDetectInterfaces'
+    ReportingXmlTag = "systems"
+    MaxHosts = 65536
+
+    def setup(self):
+        bfp.BaseHandler.setup(self)
+        self.concurrency = None
+        self.timeout = None
+        self.adaptiveTimeout = False
+
+        cfg = self.dispatcher.cfg
+
+        # get configuration options
+        if self.__class__.__name__ in cfg.pluginOption:
+            options = cfg.pluginOption[self.__class__.__name__]
+            for option in options:
+                key, value = option.split()
+
+                if key == 'concurrency':
+                    self.concurrency = int(value)
+                elif key == 'timeout':
+                    self.timeout = int(value)
+                elif key == 'adaptiveTimeout':
+                    self.adaptiveTimeout = value.lower() in (
+                        '1', 'true', 'yes', 'on')
+
+    def initCall(self):
+        bfp.BaseHandler.initCall(self)
+        self.params = models.ManagementInterfaceBulkParams.fromDict(
+            self.data.pop('params', None) or {})
+        self.interfacesList = self.params.interfacesList
+        self.eventUuid = self.params.eventUuid
+        self.hosts = self.params.hosts or []
+        self.network = self.params.network
+
+    def callDetectInterfaces(self):
+        self.setStatus(C.MSG_START, 'Initializing Interface Detection')
+        self.initCall()
+
+        if not self.zone:
+            self.setStatus(C.ERR_ZONE_MISSING, 'Interface detection call requires a zone')
+            self.postFailure()
+            return
+
+        if not self.interfacesList:
+            self.setStatus(C.ERR_BAD_ARGS,
+                'Interface detection requires a list of interfaces')
+            self.postFailure()
+            return
+
+        hosts = list(self.hosts)
+        if self.network:
+            try:
+                hosts.extend(nodeinfo.expand_network(self.network,
+                    max_hosts=self.MaxHosts))
+            except ValueError, e:
+                self.setStatus(C.ERR_BAD_ARGS, str(e))
+                self.postFailure()
+                return
+        # Drop duplicates, but keep the order
+        seen = set()
+        self.hosts = [ x for x in hosts if not (x in seen or seen.add(x)) ]
+
+        if not self.hosts:
+            self.setStatus(C.ERR_BAD_ARGS,
+                'Interface detection requires a list of hosts or a network')
+            self.postFailure()
+            return
+
+        return 'detect_management_interfaces'
+
+    def detect_management_interfaces(self):
+        self.setStatus(C.MSG_NEW_TASK, 'Creating task')
+        self.addTaskStatusCodeWatcher(C.PART_RESULT_1,
+            self._postPartialResults)
+
+        args = IDData(IDBulkParams(self.hosts, self.interfacesList,
+            self.concurrency, self.timeout, self.adaptiveTimeout))
+        task = self.newTask('detect_management_interfaces',
+            INTERFACE_BULK_DETECT_TASK, args, zone=self.zone)
+        return self._handleTask(task)
+
+    def _postPartialResults(self, task):
+        # The chunk travels in the task data, to keep it out of the job status
+        response = task.task_data.getObject().response
+        if response:
+            self.postResults(bfp.XML.fromString(response))
+
+
 class DetectInterfaceTask(bfp.BaseTaskHandler):
     """
     Task that runs on the rUS to query the target systems.
     """
+    # Default deadline for probing all the interfaces of a system
+    ProbeTimeout = 10
 
     def run(self):
         try:
@@ -134,19 +327,65 @@ class DetectInterfaceTask(bfp.BaseTaskHandler):
 
         data = self.getData()
         host = data.p.host
-        for params in data.p.interfacesList:
-            port = params['port']
-            interfaceHref = params['interfaceHref']
+        interfaces = [ (x['interfaceHref'], x['port'])
+            for x in data.p.interfacesList ]
+        for interfaceHref, port in interfaces:
             self.sendStatus(C.MSG_PROBE, 'Checking %s:%s' % (host, port))
-            if self._queryService(host, port):
-                self._sendResponse(data, interfaceHref, port)
-                self.sendStatus(C.OK, 'Found management interface on %s:%s'
-                    % (host, port))
-                return
+
+        interfaceHref, port = self._probeInterfaces(host, interfaces,
+            timeout=data.p.timeout or self.ProbeTimeout,
+            adaptive=data.p.adaptiveTimeout)
+        if interfaceHref:
+            self._sendResponse(data, interfaceHref, port)
+            self.sendStatus(C.OK, 'Found management interface on %s:%s'
+                % (host, port))
+            return
 
         self._sendResponse(data)
         self.sendStatus(C.OK_1, 'No management interface discovered')
 
+    def _probeInterfaces(self, host, interfaces, timeout, adaptive=False):
+        """
+        Probe the interfaces concurrently, and return the first one (in list
+        order) that is available.
+        If an interface is predicted to be available, only it and the higher
+        priority ones are probed at first, since any of them settles the
+        answer; the lower priority ones are only probed if they all fail.
+        """
+        predicted = interfaceStats.predict(host, interfaces)
+        if predicted is None:
+            passes = [ range(len(interfaces)) ]
+        else:
+            passes = [ [ predicted ] + range(predicted),
+                range(predicted + 1, len(interfaces)) ]
+        results = {}
+        nextIdx = 0
+        for order in passes:
+            if not order:
+                continue
+            probes = nodeinfo.iter_probe_hosts(
+                [ (host, interfaces[x][1]) for x in order ],
+                timeout=timeout, adaptive=adaptive)
+            try:
+                for index, error in probes:
+                    index = order[index]
+                    interfaceStats.record(host, interfaces[index],
+                        error is None)
+                    results[index] = error
+                    # Only decide once all higher priority probes are done
+                    while nextIdx in results:
+                        interfaceHref, port = interfaces[nextIdx]
+                        error = results[nextIdx]
+                        if error is None:
+                            return interfaceHref, port
+                        self.sendStatus(C.MSG_GENERIC,
+                            'Error probing %s:%s %s'
+                            % (host, port, str(error)))
+                        nextIdx += 1
+            finally:
+                probes.close()
+        return None, None
+
     def _sendResponse(self, data, interfaceHref=None, port=None):
         if interfaceHref:
             children = [ bfp.XML.Element('management_interface',
@@ -158,11 +397,138 @@ class DetectInterfaceTask(bfp.BaseTaskHandler):
         data.response = bfp.XML.toString(el)
         self.setData(data)
 
-    def _queryService(self, host, port):
+
+class DetectInterfacesBulkTask(DetectInterfaceTask):
+    """
+    Task that runs on the rUS to query many target systems, with a bounded
+    number of probes in flight. Results are reported in chunks, with the
+    PART_RESULT_1 status code; the final response only has the last chunk.
+    """
+    ProbeTimeout = 10
+    Concurrency = 256
+    ChunkSize = 100
+    ChunkInterval = 5
+
+    def _run(self):
+        data = self.getData()
+        hosts = data.p.hosts
+        interfaces = [ (x['interfaceHref'], x['port'])
+            for x in data.p.interfacesList ]
+        concurrency = data.p.concurrency or self.Concurrency
+        timeout = data.p.timeout or self.ProbeTimeout
+
+        self.sendStatus(C.MSG_PROBE, 'Detecting Management Interfaces on '
+            '%d systems' % len(hosts))
+
+        done = 0
+        chunk = []
+        found = 0
+        lastReport = time.time()
+        for host, interfaceHref, port in self._scan(hosts, interfaces,
+                concurrency, timeout, data.p.adaptiveTimeout):
+            if interfaceHref:
+                found += 1
+            done += 1
+            chunk.append(self._systemElement(host, interfaceHref, port))
+            if done < len(hosts) and (len(chunk) >= self.ChunkSize or
+                    time.time() - lastReport >= self.ChunkInterval):
+                self._sendPartialResults(data, chunk, done, len(hosts))
+                chunk = []
+                lastReport = time.time()
+
+        # Whatever was not reported yet gets posted with the final status
+        el = bfp.XML.Element("systems", *chunk)
+        data.response = bfp.XML.toString(el)
+        self.setData(data)
+        interfaceStats.logTable()
+        self.sendStatus(C.OK, 'Found management interfaces on %d of %d '
+            'systems' % (found, len(hosts)))
+
+    def _sendPartialResults(self, data, chunk, done, total):
+        el = bfp.XML.Element("systems", *chunk)
+        data.response = bfp.XML.toString(el)
+        self.setData(data)
+        self.sendStatus(C.PART_RESULT_1, 'Probed %d of %d systems'
+            % (done, total))
+
+    @classmethod
+    def _systemElement(cls, host, interfaceHref, port):
+        children = [ bfp.XML.Element('network_address',
+            bfp.XML.Text('address', host)) ]
+        if interfaceHref:
+            children.append(bfp.XML.Element('management_interface',
+                href=interfaceHref))
+            children.append(bfp.XML.Text('agent_port', str(port)))
+        return bfp.XML.Element("system", *children)
+
+    def _scan(self, hosts, interfaces, concurrency, timeout, adaptive=False):
+        """
+        Probe all interfaces on all hosts. Yields (host, interfaceHref, port)
+        for every host as soon as its first available interface (in list
+        order) is known, or (host, None, None) if none is available.
+        """
+        decided = set()
+        results = {}
+        # Interface indexes to probe, by host index, for each pass
+        firstPass = []
+        secondPass = []
+        for hostIdx, host in enumerate(hosts):
+            predicted = interfaceStats.predict(host, interfaces)
+            if predicted is None:
+                firstPass.append((hostIdx, range(len(interfaces))))
+                continue
+            # Start with the likely interface, along with the higher priority
+            # ones that are needed to give the same answer as probing in list
+            # order. The lower priority ones are only needed if all of those
+            # fail.
+            firstPass.append((hostIdx, [ predicted ] + range(predicted)))
+            if predicted + 1 < len(interfaces):
+                secondPass.append((hostIdx,
+                    range(predicted + 1, len(interfaces))))
+
+        for plan in (firstPass, secondPass):
+            for result in self._scanPass(plan, hosts, interfaces, results,
+                    decided, concurrency, timeout, adaptive):
+                yield result
+
+    def _scanPass(self, plan, hosts, interfaces, results, decided,
+            concurrency, timeout, adaptive):
+        # Maps probe index to (host index, interface index)
+        probes = []
+
+        def targets():
+            for hostIdx, ifaceIdxs in plan:
+                for ifaceIdx in ifaceIdxs:
+                    if hostIdx in decided:
+                        # No need to probe lower priority interfaces
+                        break
+                    probes.append((hostIdx, ifaceIdx))
+                    yield hosts[hostIdx], interfaces[ifaceIdx][1]
+
+        scanner = nodeinfo.iter_probe_hosts(targets(),
+            timeout=timeout, concurrency=concurrency, adaptive=adaptive)
         try:
-            nodeinfo.probe_host(host, port)
-            return True
-        except nodeinfo.ProbeHostError, e:
-            self.sendStatus(C.MSG_GENERIC, 'Error probing %s:%s %s'
-                % (host, port, str(e)))
-            return False
+            for index, error in scanner:
+                hostIdx, ifaceIdx = probes[index]
+                interfaceStats.record(hosts[hostIdx], interfaces[ifaceIdx],
+                    error is None)
+                if hostIdx in decided:
+                    continue
+                hostResults = results.setdefault(hostIdx, {})
+                hostResults[ifaceIdx] = error
+                # Skip over the failed interfaces, in priority order
+                idx = 0
+                while idx in hostResults and hostResults[idx] is not None:
+                    idx += 1
+                if idx == len(interfaces):
+                    interfaceHref, port = None, None
+                elif idx in hostResults:
+                    interfaceHref, port = interfaces[idx]
+                else:
+                    # Still waiting on a higher priority interface
+                    continue
+                decided.add(hostIdx)
+                del results[hostIdx]
+                yield hosts[hostIdx], interfaceHref, port
+        finally:
+            scanner.close()
@@ -17,6 +17,7 @@
 
 import base64
 import logging
+import StringIO
 
 from conary.lib import cfg as cny_cfg
 from conary.lib import cfgtypes
@@ -24,6 +25,7 @@ from conary.lib.http.request import URL
 
 from rmake3.lib import chutney
 from rmake3.lib import logger
+from rmake3.lib import netlink
 from rmake3.lib.jabberlink import message
 from rmake3.lib.jabberlink.handlers import link
 
@@ -35,8 +37,14 @@ from rmake3.worker import plug_worker
 from twisted.web import client
 from twisted.web import server
 from twisted.web import resource
+from twisted.internet import defer
+from twisted.internet import error as internet_error
 from twisted.internet import ssl
 from twisted.internet import reactor
+from twisted.internet import task
+
+from rpath_repeater.utils import framing
+from rpath_repeater.utils import throttle
 
 NS = 'http://rpath.com/permanent/xmpp/repeater-1.0'
 log = logging.getLogger(__name__)
@@ -48,9 +56,44 @@ class RestForwardingConfig(cny_cfg.ConfigFile):
     cert                    = (cfgtypes.CfgString, None)
     httpPort                = (cfgtypes.CfgInt, None)
     httpsPort               = (cfgtypes.CfgInt, None)
+    # Use the compact binary framing instead of chutney for forwarded
+    # requests. Replies always use the same encoding as the request; only
+    # turn this on once the rBuilder end understands the framing.
+    compactFraming          = (cfgtypes.CfgBool, False)
+    # Requests in flight over the bus, and requests allowed to wait for a
+    # slot before new ones are shed with a 503
+    maxInFlight             = (cfgtypes.CfgInt, 64)
+    maxQueued               = (cfgtypes.CfgInt, 256)
+    # Answer requests forwarded over the bus with a 504 if no reply came
+    # back within this many seconds, releasing their slot; 0 waits forever
+    replyTimeout            = (cfgtypes.CfgInt, 300)
+    # Send requests straight to this URL over HTTP instead of the bus,
+    # falling back to the bus if it cannot be reached
+    directTarget            = (cfgtypes.CfgString, None)
+    # Without directTarget, go direct to the default target if the
+    # dispatcher runs on this node
+    directDetect            = (cfgtypes.CfgBool, True)
+    # After a failed direct request, use the bus for this many seconds
+    directRetryInterval     = (cfgtypes.CfgInt, 60)
+    # Pack requests sent within this many milliseconds of each other into
+    # a single bus message (at most batchMaxSize of them); 0 disables.
+    # Needs compactFraming, and an rBuilder end that understands batches;
+    # batching stops if a batch gets no reply within replyTimeout.
+    batchWindow             = (cfgtypes.CfgInt, 0)
+    batchMaxSize            = (cfgtypes.CfgInt, 16)
 
     # Dispatcher
     repeaterTarget          = (cfgtypes.CfgString, None)
+    # Upstream connections opened to repeaterTarget, in total and on behalf
+    # of a single management node
+    upstreamMaxInFlight     = (cfgtypes.CfgInt, 128)
+    upstreamMaxPerNeighbor  = (cfgtypes.CfgInt, 16)
+    upstreamMaxQueued       = (cfgtypes.CfgInt, 1024)
+
+    # Both
+    retryAfter              = (cfgtypes.CfgInt, 30)
+    # Log throttling statistics this often (in seconds); 0 disables
+    statsInterval           = (cfgtypes.CfgInt, 0)
 
 
 class RestForwardingPlugin(plug_dispatcher.DispatcherPlugin,
@@ -58,9 +101,20 @@ class RestForwardingPlugin(plug_dispatcher.DispatcherPlugin,
 
     def launcher_post_setup(self, launcher):
         """ The Sputnik end of the rMake topology """
-        endpoint = EndPoint(launcher.bus)
-
         cfg = self.populateConfigFromOptions(RestForwardingConfig())
+        endpointThrottle = throttle.RequestThrottle(
+                maxInFlight=cfg.maxInFlight, maxQueued=cfg.maxQueued)
+        if cfg.batchWindow and cfg.compactFraming:
+            batcher = MessageBatcher(launcher.bus, cfg.batchWindow / 1000.0,
+                    cfg.batchMaxSize, timeout=cfg.replyTimeout)
+        else:
+            batcher = None
+        endpoint = EndPoint(launcher.bus, compactFraming=cfg.compactFraming,
+                throttle=endpointThrottle, retryAfter=cfg.retryAfter,
+                batcher=batcher, replyTimeout=cfg.replyTimeout)
+        logThrottleStats("REST endpoint", endpointThrottle, cfg.statsInterval)
+        self.setUpDirectRoute(launcher, endpoint, cfg)
+
         if cfg.httpPort:
             reactor.listenTCP(cfg.httpPort,
                     server.Site(resource.IResource(endpoint)))
@@ -74,9 +128,123 @@ class RestForwardingPlugin(plug_dispatcher.DispatcherPlugin,
 
         cfg = self.populateConfigFromOptions(RestForwardingConfig())
         if cfg.repeaterTarget:
+            upstreamThrottle = throttle.RequestThrottle(
+                    maxInFlight=cfg.upstreamMaxInFlight,
+                    maxInFlightPerKey=cfg.upstreamMaxPerNeighbor,
+                    maxQueued=cfg.upstreamMaxQueued)
             dispatcher.bus.link.addMessageHandler(
                     RepeaterMessageHandler(cfg.repeaterTarget,
-                        dispatcher.workers))
+                        dispatcher.workers, throttle=upstreamThrottle,
+                        retryAfter=cfg.retryAfter))
+            logThrottleStats("REST repeater", upstreamThrottle,
+                    cfg.statsInterval)
+
+
+    def setUpDirectRoute(self, launcher, endpoint, cfg):
+        zone = getLauncherZone(launcher)
+        def _enable(targetUrl):
+            log.info("Forwarding REST requests directly to %s", targetUrl)
+            endpoint.direct = DirectForwarder(targetUrl, zone=zone,
+                    retryInterval=cfg.directRetryInterval)
+        if cfg.directTarget:
+            _enable(cfg.directTarget)
+            return None
+        if not cfg.directDetect:
+            return None
+        d = isLocalHost(launcher.bus.targetJID.host)
+        @d.addCallback
+        def _detected(isLocal):
+            if isLocal:
+                _enable(DirectForwarder.DefaultTarget)
+        d.addErrback(logger.logFailure,
+                "Unable to detect a direct route to the dispatcher:")
+        return d
+
+
+def getLauncherZone(launcher):
+    for cap in getattr(launcher, 'caps', None) or []:
+        if isinstance(cap, types.ZoneCapability):
+            return cap.zoneName
+    return getattr(launcher.cfg, 'zoneName', None)
+
+
+def isLocalHost(host):
+    """
+    Returns a deferred that fires with True if host resolves to one of the
+    addresses of this node.
+    """
+    d = reactor.resolve(host)
+    @d.addCallback
+    def _resolved(address):
+        rtnl = netlink.RoutingNetlink()
+        localAddresses = set(x[1] for x in rtnl.getAllAddresses())
+        return address in localAddresses or address.startswith('127.')
+    return d
+
+
+def logThrottleStats(name, requestThrottle, interval):
+    if not interval:
+        return None
+    def _log():
+        stats = requestThrottle.getStats()
+        log.info("%s: %d in flight, %d queued (max %d), %d shed", name,
+                stats['inFlight'], stats['queueDepth'],
+                stats['maxQueueDepth'], stats['shed'])
+    lc = task.LoopingCall(_log)
+    lc.start(interval, now=False)
+    return lc
+
+
+def serviceUnavailable(retryAfter):
+    return dict(
+            status=503,
+            message='Service Unavailable',
+            headers={'Retry-After' : [str(retryAfter)]},
+            body='',
+            )
+
+
+def internalServerError():
+    return dict(
+            status=500,
+            message='Internal Server Error',
+            headers={},
+            body='',
+            )
+
+
+def badGateway():
+    return dict(
+            status=502,
+            message='Bad Gateway',
+            headers={},
+            body='',
+            )
+
+
+def gatewayTimeout():
+    return dict(
+            status=504,
+            message='Gateway Timeout',
+            headers={},
+            body='',
+            )
+
+
+def addTimeout(d, timeout, clock=reactor):
+    """
+    Cancel d, failing it with CancelledError, if it has not fired within
+    timeout seconds. A timeout of None (or 0) means no timeout.
+    """
+    if not timeout:
+        return d
+    timer = clock.callLater(timeout, d.cancel)
+    def _fired(result):
+        if timer.active():
+            timer.cancel()
+        return result
+    d.addBoth(_fired)
+    return d
 
 
 class RepeaterMessageHandler(message.MessageHandler):
@@ -84,9 +252,11 @@ class RepeaterMessageHandler(message.MessageHandler):
     XHeader = 'X-rPath-Management-Zone'
     XRepeaterHeader = 'X-rPath-Repeater'
 
-    def __init__(self, host, workers):
+    def __init__(self, host, workers, throttle=None, retryAfter=30):
         self.targetUrl = URL(host)
         self.workers = workers
+        self.throttle = throttle
+        self.retryAfter = retryAfter
 
     def getManagementZone(self, neighbor):
         jid = link.toJID(neighbor.jid.full())
@@ -106,22 +276,102 @@ class RepeaterMessageHandler(message.MessageHandler):
             if isinstance(x, types.ZoneCapability) ]
         return zoneNames
 
+    @classmethod
+    def decodeRequest(cls, payload):
+        """
+        Decode a forwarded request. Returns the request dictionary and the
+        function to be used for encoding the reply.
+        """
+        if framing.isFramed(payload):
+            return framing.decodeRequest(payload), cls._encodeFramedReply
+        return chutney.loads(payload), cls._encodeChutneyReply
+
+    @classmethod
+    def _encodeFramedReply(cls, reply):
+        return framing.encodeReply(reply['status'], reply['message'],
+            reply['headers'], reply['body'])
+
+    @classmethod
+    def _encodeChutneyReply(cls, reply):
+        return chutney.dumps(reply)
+
     def onMessage(self, neighbor, msg):
-        reqDict = chutney.loads(msg.payload)
-        method = reqDict['method']
-        url = reqDict['url']
-        body = reqDict['body']
-        rawHeaders = reqDict['headers']
+        if framing.isBatch(msg.payload):
+            # Process batched requests concurrently, and send all the
+            # replies back in a single batch, in the same order. A request
+            # that fails gets an error reply, so the batch always has one
+            # reply per request.
+            frames = framing.decodeBatch(msg.payload)
+            replies = []
+            for frame in frames:
+                d = defer.maybeDeferred(self.handleRequest, neighbor, frame)
+                d.addErrback(self._failedRequest, self._encodeFramedReply)
+                replies.append(d)
+            d = defer.gatherResults(replies)
+            d.addCallback(framing.encodeBatch)
+        else:
+            if framing.isFramed(msg.payload):
+                encodeReply = self._encodeFramedReply
+            else:
+                encodeReply = self._encodeChutneyReply
+            # Requests that cannot be decoded get an error reply too
+            d = defer.maybeDeferred(self.handleRequest, neighbor, msg.payload)
+            d.addErrback(self._failedRequest, encodeReply)
+        @d.addCallback
+        def sendReply(payload):
+            neighbor.send(message.Message(self.namespace, payload,
+                                           in_reply_to=msg))
+        d.addErrback(logger.logFailure)
+        return d
+
+    def handleRequest(self, neighbor, payload):
+        """
+        Forward a single request. Returns a deferred that fires with the
+        encoded reply.
+        """
+        reqDict, encodeReply = self.decodeRequest(payload)
+        if self.throttle is None:
+            d = self.forwardRequest(neighbor, reqDict)
+        else:
+            d = self.throttle.run(neighbor.jid.full(), self.forwardRequest,
+                    neighbor, reqDict)
+            d.addErrback(self._shedRequest, neighbor)
+        d.addCallback(encodeReply)
+        return d
+
+    def _failedRequest(self, error, encodeReply):
+        logger.logFailure(error, "Error handling forwarded request:")
+        return encodeReply(internalServerError())
+
+    def _shedRequest(self, error, neighbor):
+        error.trap(throttle.ThrottleFull)
+        log.warning("Too many forwarded requests in flight, "
+                "rejecting request from %s", neighbor.jid.full())
+        return serviceUnavailable(self.retryAfter)
+
+    @classmethod
+    def addForwardingHeaders(cls, rawHeaders, managementZone):
         headers = client.Headers(rawHeaders)
-        headers.removeHeader(self.XHeader)
-        managementZone = self.getManagementZone(neighbor)
+        headers.removeHeader(cls.XHeader)
         if managementZone is not None:
-            headers.addRawHeader(self.XHeader, managementZone)
+            headers.addRawHeader(cls.XHeader, managementZone)
         # This header flags a request as _not_ being originated from localhost
         # Some of the management interfaces require localhost access, but
         # everything forwarded through the repeater looks like it's
         # originating from localhost, unless this header is present
-        headers.addRawHeader(self.XRepeaterHeader, 'remote')
+        headers.addRawHeader(cls.XRepeaterHeader, 'remote')
+        return headers
+
+    def forwardRequest(self, neighbor, reqDict):
+        """
+        Send a forwarded request to the target. Returns a deferred that fires
+        with the reply dictionary.
+        """
+        method = reqDict['method']
+        url = reqDict['url']
+        body = reqDict['body']
+        headers = self.addForwardingHeaders(reqDict['headers'],
+            self.getManagementZone(neighbor))
         # XXX this is where multi-valued headers go down the drain
         headers = dict((k.lower(), v[-1])
             for (k, v) in headers.getAllRawHeaders())
@@ -137,34 +387,36 @@ class RepeaterMessageHandler(message.MessageHandler):
                 headers = headers,
                 body = body,
             )
-            neighbor.send(message.Message(self.namespace, chutney.dumps(reply),
-                                           in_reply_to=msg))
-            return args
+            return reply
 
         @fact.deferred.addErrback
         def processError(error):
             logger.logFailure(error, "Error in proxied REST request:")
-            reply = dict(
-                    status=500,
-                    message='Internal Server Error',
-                    headers={},
-                    body='',
-                    )
-            neighbor.send(message.Message(self.namespace, chutney.dumps(reply),
-                                           in_reply_to=msg))
+            return internalServerError()
 
         host, port = self.targetUrl.hostport
         if self.targetUrl.scheme == 'https':
             reactor.connectSSL(str(host), port, fact)
         else:
             reactor.connectTCP(str(host), port, fact)
+        return fact.deferred
 
 
 class EndPoint(resource.Resource):
     isLeaf=True
 
-    def __init__(self, bus):
+    def __init__(self, bus, compactFraming=False, throttle=None,
+            retryAfter=30, batcher=None, replyTimeout=None, clock=reactor):
         self.bus = bus
+        self.compactFraming = compactFraming
+        self.throttle = throttle
+        self.retryAfter = retryAfter
+        self.batcher = batcher
+        # Bus messages can get lost, and a request waiting on a reply that
+        # never comes would hold its throttle slot forever
+        self.replyTimeout = replyTimeout
+        self.clock = clock
+        self.direct = None
 
     def addMessageHandler(self, messageHandler):
         self.bus.addHandler(messageHandler)
@@ -189,42 +441,259 @@ class EndPoint(resource.Resource):
         return self
 
     def sendMsg(self, request, method):
+        if self.throttle is None:
+            return self._sendMsg(request, method)
+        d = self.throttle.run(None, self._sendMsg, request, method)
+        @d.addErrback
+        def shed(error):
+            error.trap(throttle.ThrottleFull)
+            log.warning("Too many forwarded requests in flight, "
+                    "rejecting request for %s", request.uri)
+            self.writeReply(request, serviceUnavailable(self.retryAfter))
+        return d
+
+    def _sendMsg(self, request, method):
+        if request._disconnected:
+            # The client went away while the request was queued
+            return None
         request.content.seek(0, 0)
         request.requestHeaders.setRawHeaders('x-forwarded-for',
                 [request.getClientIP()])
         request.requestHeaders.setRawHeaders('x-forwarded-proto',
                 ['https' if request.isSecure() else 'http'])
         body = request.content.read()
-
-        content = {
-            'url': request.uri,
-            'method': method.upper(),
-            'body': body,
-            'headers': dict(request.requestHeaders.getAllRawHeaders()),
-        }
-
-        content = chutney.dumps(content)
+        headers = dict(request.requestHeaders.getAllRawHeaders())
+
+        if self.direct is not None and self.direct.isAvailable():
+            d = self.direct.forward(method.upper(), request.uri, headers, body)
+            d.addCallbacks(lambda reply: self.writeReply(request, reply),
+                    self._directFailed,
+                    errbackArgs=(request, method, headers, body))
+            return d
+        return self._sendBusMsg(request, method, headers, body)
+
+    def _directFailed(self, error, request, method, headers, body):
+        # Whether or not this request can be replayed, the route is not to
+        # be used by the next ones for a while
+        self.direct.markDown()
+        if not self.direct.canRetry(error, method):
+            logger.logFailure(error, "Error in direct REST request:")
+            self.writeReply(request, badGateway())
+            return None
+        log.warning("Direct REST request failed, using the message bus: %s",
+                error.getErrorMessage())
+        return self._sendBusMsg(request, method, headers, body)
+
+    def _sendBusMsg(self, request, method, headers, body):
+        if self.compactFraming:
+            content = framing.encodeRequest(method.upper(), request.uri,
+                headers, body)
+            if self.batcher is not None:
+                d = self.batcher.send(self.bus.targetJID, content)
+                addTimeout(d, self.replyTimeout, self.clock)
+                d.addCallback(lambda payload: self.writeReply(request,
+                    self.decodeReply(payload)))
+                d.addErrback(self._busFailed, request)
+                return d
+        else:
+            content = chutney.dumps({
+                'url': request.uri,
+                'method': method.upper(),
+                'body': body,
+                'headers': headers,
+            })
         msg = message.Message(NS, content)
 
         d = self.bus.link.sendWithDeferred(self.bus.targetJID, msg)
+        addTimeout(d, self.replyTimeout, self.clock)
 
         @d.addCallback
         def on_reply(replies):
             for reply in replies:
-                dict = chutney.loads(reply.payload)
-                request.setResponseCode(dict['status'])
-                for key, values in dict.get('headers', {}).items():
-                    if key.lower() in ('connection', 'transfer-encoding'):
-                        continue
-                    request.responseHeaders.setRawHeaders(key, values)
+                self.writeReply(request, self.decodeReply(reply.payload))
 
-                responseBody = dict['body']
-                if responseBody:
-                    request.write(responseBody)
+        d.addErrback(self._busFailed, request)
+        return d
 
-                if not request._disconnected:
-                    request.finish()
+    def _busFailed(self, error, request):
+        # Don't leave the client hanging
+        if error.check(defer.CancelledError):
+            log.warning("No reply to forwarded REST request for %s "
+                    "within %s seconds", request.uri, self.replyTimeout)
+            reply = gatewayTimeout()
+        else:
+            logger.logFailure(error, "Error in forwarded REST request:")
+            reply = badGateway()
+        if not request.finished and not request._disconnected:
+            self.writeReply(request, reply)
 
+    @classmethod
+    def writeReply(cls, request, reply):
+        request.setResponseCode(reply['status'])
+        for key, values in reply.get('headers', {}).items():
+            if key.lower() in ('connection', 'transfer-encoding'):
+                continue
+            request.responseHeaders.setRawHeaders(key, values)
+
+        responseBody = reply['body']
+        if responseBody:
+            request.write(responseBody)
+
+        if not request._disconnected:
+            request.finish()
+
+    @classmethod
+    def decodeReply(cls, payload):
+        if framing.isFramed(payload):
+            return framing.decodeReply(payload)
+        return chutney.loads(payload)
+
+
+class MessageBatcher(object):
+    """
+    Pack compact request frames sent to the same target within a short
+    window into a single bus message. The other end replies with a batch
+    of reply frames, in the same order.
+    An end that does not understand batches never replies to them, so if a
+    batch gets no reply within timeout seconds, its requests fail, and
+    frames for that target are sent one by one from then on.
+    """
+
+    def __init__(self, bus, window, maxSize, timeout=None, clock=reactor):
+        self.bus = bus
+        self.window = window
+        self.maxSize = maxSize
+        self.timeout = timeout
+        self.clock = clock
+        self.pending = {}
+        self.timers = {}
+        # Targets that did not answer a batch
+        self.unbatched = set()
+
+    def send(self, targetJID, frame):
+        """
+        Queue a request frame. Returns a deferred that fires with the reply
+        frame.
+        """
+        d = defer.Deferred()
+        entries = self.pending.setdefault(targetJID, [])
+        entries.append((frame, d))
+        if len(entries) >= self.maxSize or targetJID in self.unbatched:
+            self.flush(targetJID)
+        elif targetJID not in self.timers:
+            self.timers[targetJID] = self.clock.callLater(self.window,
+                    self.flush, targetJID)
+        return d
+
+    def flush(self, targetJID):
+        timer = self.timers.pop(targetJID, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        entries = self.pending.pop(targetJID, None)
+        if not entries:
+            return None
+        frames = [ x[0] for x in entries ]
+        deferreds = [ x[1] for x in entries ]
+        if len(frames) == 1:
+            # Not worth the batch envelope
+            payload = frames[0]
+        else:
+            payload = framing.encodeBatch(frames)
+        d = self.bus.link.sendWithDeferred(targetJID,
+                message.Message(NS, payload))
+        addTimeout(d, self.timeout, self.clock)
+
+        @d.addCallback
+        def on_reply(replies):
+            replyFrames = []
+            for reply in replies:
+                if framing.isBatch(reply.payload):
+                    replyFrames.extend(framing.decodeBatch(reply.payload))
+                else:
+                    replyFrames.append(reply.payload)
+            if len(replyFrames) != len(deferreds):
+                raise framing.FramingError("Expected %d replies, got %d" %
+                        (len(deferreds), len(replyFrames)))
+            for replyFrame, replyDeferred in zip(replyFrames, deferreds):
+                replyDeferred.callback(replyFrame)
+
+        @d.addErrback
+        def on_error(error):
+            if error.check(defer.CancelledError) and len(frames) > 1:
+                log.warning("No reply to a batch of %d requests within %s "
+                        "seconds, no longer batching requests to %s",
+                        len(frames), self.timeout, targetJID)
+                self.unbatched.add(targetJID)
+            for replyDeferred in deferreds:
+                if not replyDeferred.called:
+                    replyDeferred.errback(error)
+        return d
+
+
+class DirectForwarder(object):
+    """
+    Forward requests to rBuilder over pooled, persistent HTTP connections,
+    bypassing the message bus. Requests get the same headers that
+    RepeaterMessageHandler would add on the dispatcher end.
+    """
+    DefaultTarget = 'http://localhost:7720'
+    ConnectTimeout = 10
+    MaxPersistentPerHost = 16
+    # Safe to resend over the bus even if the server may have seen them
+    IdempotentMethods = set(['GET', 'HEAD', 'PUT', 'DELETE'])
+    # The agent computes these itself
+    HopByHopHeaders = ['Connection', 'Keep-Alive', 'Transfer-Encoding',
+        'Content-Length', ]
+
+    def __init__(self, targetUrl, zone=None, retryInterval=60,
+            clock=reactor):
+        self.targetUrl = targetUrl.rstrip('/')
+        if zone:
+            self.managementZone = base64.b64encode(zone)
+        else:
+            self.managementZone = None
+        self.retryInterval = retryInterval
+        self.clock = clock
+        self.downUntil = 0
+        self.pool = client.HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = self.MaxPersistentPerHost
+        self.agent = client.Agent(reactor, pool=self.pool,
+                connectTimeout=self.ConnectTimeout)
+
+    def isAvailable(self):
+        return self.clock.seconds() >= self.downUntil
+
+    def markDown(self):
+        self.downUntil = self.clock.seconds() + self.retryInterval
+
+    def canRetry(self, error, method):
+        # The request never made it to the server if we could not connect
+        if error.check(internet_error.ConnectError,
+                internet_error.DNSLookupError):
+            return True
+        return method.upper() in self.IdempotentMethods
+
+    def forward(self, method, uri, rawHeaders, body):
+        headers = RepeaterMessageHandler.addForwardingHeaders(rawHeaders,
+                self.managementZone)
+        for header in self.HopByHopHeaders:
+            headers.removeHeader(header)
+        if body:
+            bodyProducer = client.FileBodyProducer(StringIO.StringIO(body))
+        else:
+            bodyProducer = None
+        d = self.agent.request(method, self.targetUrl + uri, headers,
+                bodyProducer)
+        @d.addCallback
+        def _gotResponse(response):
+            d2 = client.readBody(response)
+            d2.addCallback(lambda responseBody: dict(
+                status=response.code,
+                message=response.phrase,
+                headers=dict(response.headers.getAllRawHeaders()),
+                body=responseBody,
+                ))
+            return d2
         return d
 
 
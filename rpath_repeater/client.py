@@ -113,11 +113,13 @@ class RepeaterClient(object):
     __ASSIMILATOR_PLUGIN_NS = 'com.rpath.sputnik.assimilatorplugin'
     __LAUNCH_PLUGIN_NS = 'com.rpath.sputnik.launchplugin'
     __MGMT_IFACE_PLUGIN_NS = 'com.rpath.sputnik.interfacedetectionplugin'
+    __MGMT_IFACE_BULK_PLUGIN_NS = 'com.rpath.sputnik.bulkinterfacedetectionplugin'
 
     CimParams = models.CimParams
     WmiParams = models.WmiParams
     AssimilatorParams = models.AssimilatorParams
     ManagementInterfaceParams = models.ManagementInterfaceParams
+    ManagementInterfaceBulkParams = models.ManagementInterfaceBulkParams
     URL = models.URL
     ResultsLocation = models.ResultsLocation
     Image = models.Image
@@ -202,6 +204,19 @@ class RepeaterClient(object):
         params['assimilatorParams'] = assimilatorParams.toDict()
         return self._launchRmakeJob(self.__ASSIMILATOR_PLUGIN_NS, params, uuid=uuid)
 
+    def detectMgmtInterfaceBulk(self, bulkParams, resultsLocation=None,
+            zone=None, uuid=None, jobToken=None):
+        '''probe many systems for a management interface in a single job'''
+        params = self._callParams('detectMgmtInterfaceBulk', resultsLocation,
+            zone, jobToken)
+        assert isinstance(bulkParams, self.ManagementInterfaceBulkParams)
+        params['params'] = bulkParams.toDict()
+        # The job URL is derived from the uuid
+        if uuid is None:
+            uuid = RmakeUuid.uuid4()
+        return self._launchRmakeJob(self.__MGMT_IFACE_BULK_PLUGIN_NS, params,
+            uuid=uuid)
+
     def getNodes(self):
         return self.client.getWorkerList()
 
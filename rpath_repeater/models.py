@@ -17,10 +17,14 @@
 
 import sys
 
+from lxml import etree
+
 from conary import conaryclient
 from conary import versions
 from conary.lib import util
 
+from rpath_repeater.utils.immutabledict import ImmutableDict
+from rpath_repeater.utils.immutabledict import FrozenImmutableDict
 from rpath_repeater.utils.xmlutils import XML
 from smartform import descriptor
 
@@ -30,9 +34,14 @@ from rmake3.lib import chutney
 chutney.register(descriptor.ProtectedUnicode)
 
 class ModelMeta(type):
-    """Metaclass to automatically register child classes to chutney"""
+    """
+    Metaclass to automatically register child classes to chutney, and to
+    compile per-class serializers
+    """
     def __new__(mcs, name, bases, attrs):
         new_class = type.__new__(mcs, name, bases, attrs)
+        _compileSerializers(new_class, attrs)
+        _compileConverters(new_class, attrs)
         # Don't register "private" classes
         if not name.startswith('_'):
             # We need to pass _force here, otherwise chutney will try to
@@ -46,6 +55,190 @@ class ModelMeta(type):
             module.__dict__[frozenType.__name__] = frozenType
         return new_class
 
+_XmlTemplate = """\
+def toXmlDom(self, tag=None):
+    tag = self._tag
+    if tag is None:
+        return None
+    node = _Element(tag)
+%s    return node
+"""
+
+_XmlSlotTemplate = """\
+    val = self.%(slot)s
+    if val is not None:
+        typ = type(val)
+        if typ is str or typ is unicode:
+            val = unicode(val)
+            if '<' in val and _isXml(val):
+                node.append(_CDATA(%(slot)r, val))
+            else:
+                _SubElement(node, %(slot)r).text = val
+        elif typ is int or typ is long or typ is float:
+            _SubElement(node, %(slot)r).text = unicode(val)
+        else:
+            _appendValue(node, %(slot)r, val)
+"""
+
+def _isXml(val):
+    # Crude attempt to not doubly-encode xml
+    return val.lstrip().startswith('<') and val.rstrip().endswith('>')
+
+def _appendValue(node, slot, val):
+    "Generic serialization of a slot value, for _Serializable.toXmlDom"
+    if hasattr(val, 'toXmlDom'):
+        val = val.toXmlDom(slot)
+        if val is not None:
+            node.append(val)
+        return
+    if not isinstance(val, (basestring, int, long, float)):
+        return
+    # Assume string
+    val = unicode(val)
+    if _isXml(val):
+        node.append(XML.CDATA(slot, val))
+    else:
+        node.append(XML.Text(slot, val))
+
+def _compileSerializers(cls, attrs):
+    """
+    Replace the generic _Serializable.toXmlDom with one unrolled over the
+    class' slots, unless the class has its own
+    """
+    if not issubclass(cls, _Serializable) or 'toXmlDom' in attrs:
+        return
+    if not _isGeneric(cls.toXmlDom.im_func, _Serializable.toXmlDom.im_func):
+        return
+    if cls._getTag.im_func is not _Serializable._getTag.im_func:
+        return
+    source = _XmlTemplate % ''.join(_XmlSlotTemplate % dict(slot=slot)
+        for slot in cls.__slots__)
+    namespace = dict(_Element=etree.Element, _SubElement=etree.SubElement,
+        _CDATA=XML.CDATA, _isXml=_isXml, _appendValue=_appendValue)
+    exec source in namespace
+    cls.toXmlDom = _compiled(namespace['toXmlDom'], source)
+
+_ToDictTemplate = """\
+def toDict(self):
+    ret = {}
+%s    return ret
+"""
+
+_ToDictSlotTemplate = """\
+    val = self.%(slot)s
+    if val is not None:
+        if type(val) not in _plainTypes and isinstance(val, _SlotCompare):
+            val = val.toDict()
+        ret[%(slot)r] = val
+"""
+
+_FromDictTemplate = """\
+def fromDict(cls, values):
+    if type(values) is not dict:
+        values = _asDict(values)
+    obj = _new(cls)
+%s    get = values.get
+%s    return obj
+"""
+
+_InheritedSlotTemplate = """\
+    obj.%(slot)s = None
+"""
+
+_FromDictSlotTemplate = """\
+    obj.%(slot)s = get(%(slot)r)
+"""
+
+_FromDictModelSlotTemplate = """\
+    val = get(%(slot)r)
+    if type(val) is dict or isinstance(val, _dictTypes):
+        val = _type_%(slot)s.fromDict(val)
+    obj.%(slot)s = val
+"""
+
+_FromDictListSlotTemplate = """\
+    val = get(%(slot)r)
+    if isinstance(val, (list, tuple)):
+        val = _type_%(slot)s.fromDictList(val)
+    obj.%(slot)s = val
+"""
+
+# Values that are never models, and don't need an isinstance check
+_plainTypes = frozenset([ str, unicode, int, long, float, bool, list, tuple,
+    dict, ])
+
+# Values fromDict accepts in place of a dictionary
+_dictTypes = (dict, ImmutableDict, FrozenImmutableDict)
+
+def _asDict(values):
+    if isinstance(values, FrozenImmutableDict):
+        values = values.thaw()
+    if isinstance(values, ImmutableDict):
+        values = values.getDict()
+    return values
+
+def _inheritedSlots(cls):
+    "Slots of the base classes of cls, which cls.__slots__ does not list"
+    slots = []
+    for base in cls.__mro__[1:]:
+        baseSlots = base.__dict__.get('__slots__', ())
+        if isinstance(baseSlots, basestring):
+            baseSlots = [ baseSlots ]
+        for slot in baseSlots:
+            if slot not in cls.__slots__ and slot not in slots:
+                slots.append(slot)
+    return slots
+
+def _compileConverters(cls, attrs):
+    """
+    Replace the generic toDict/fromDict of _BaseSlotCompare with ones
+    unrolled over the class' slots, unless the class has its own
+    """
+    slotTypes = cls._slotTypes
+    namespace = dict(_plainTypes=_plainTypes, _SlotCompare=SlotCompare,
+        _new=object.__new__,
+        _dictTypes=_dictTypes, _asDict=_asDict)
+    toDictSlots = []
+    fromDictSlots = []
+    for slot in cls.__slots__:
+        slotType = slotTypes.get(slot)
+        if isinstance(slotType, list):
+            namespace['_type_' + slot] = slotType[0]
+            # Lists are left as they are, models and all, like the generic
+            # toDict does
+            toDictSlots.append(_ToDictSlotTemplate % dict(slot=slot))
+            fromDictSlots.append(_FromDictListSlotTemplate % dict(slot=slot))
+        elif slotType is not None:
+            namespace['_type_' + slot] = slotType
+            toDictSlots.append(_ToDictSlotTemplate % dict(slot=slot))
+            fromDictSlots.append(_FromDictModelSlotTemplate % dict(slot=slot))
+        else:
+            toDictSlots.append(_ToDictSlotTemplate % dict(slot=slot))
+            fromDictSlots.append(_FromDictSlotTemplate % dict(slot=slot))
+    if 'toDict' not in attrs and _isGeneric(cls.toDict.im_func,
+            _BaseSlotCompare.toDict.im_func):
+        source = _ToDictTemplate % ''.join(toDictSlots)
+        exec source in namespace
+        cls.toDict = _compiled(namespace.pop('toDict'), source)
+    if 'fromDict' not in attrs and _isGeneric(cls.fromDict.im_func,
+            _BaseSlotCompare.fromDict.im_func):
+        # __init__ is skipped, so the inherited slots need initializing too
+        source = _FromDictTemplate % (''.join(_InheritedSlotTemplate
+                % dict(slot=slot) for slot in _inheritedSlots(cls)),
+            ''.join(fromDictSlots))
+        exec source in namespace
+        cls.fromDict = classmethod(_compiled(namespace.pop('fromDict'),
+            source))
+
+def _isGeneric(func, genericFunc):
+    "True if func is the generic implementation, or a compiled one"
+    return func is genericFunc or getattr(func, 'compiled', False)
+
+def _compiled(func, source):
+    func.compiled = True
+    func.source = source
+    return func
+
 class _Serializable(object):
     _tag = None
 
@@ -55,30 +248,19 @@ class _Serializable(object):
         return tag
 
     def toXmlDom(self, tag=None):
+        """
+        Generic serializer; model classes get a compiled equivalent from
+        ModelMeta
+        """
         tag = self._getTag()
         if tag is None:
             return None
-        children = []
+        node = XML.Element(tag)
         for slot in self.__slots__:
             val = getattr(self, slot)
-            if val is None:
-                continue
-            if hasattr(val, 'toXmlDom'):
-                val = val.toXmlDom(slot)
-                if val is None:
-                    continue
-                children.append(val)
-                continue
-            if not isinstance(val, (basestring, int, long, float)):
-                continue
-            # Assume string
-            val = unicode(val)
-            # Crude attempt to not doubly-encode xml
-            if val.lstrip().startswith('<') and val.rstrip().endswith('>'):
-                children.append(XML.CDATA(slot, val))
-            else:
-                children.append(XML.Text(slot, val))
-        return XML.Element(tag, *children)
+            if val is not None:
+                _appendValue(node, slot, val)
+        return node
 
     def toXml(self):
         dom = self.toXmlDom()
@@ -100,8 +282,17 @@ class _SerializableList(list, _SerializableListMixIn):
 
 
 class _BaseSlotCompare(SlotCompare):
+    """
+    Base class for models. _slotTypes maps slots holding models to the
+    model class, or to a list with the model class for slots holding lists
+    of models; fromDict uses it to rebuild nested models.
+    ModelMeta compiles equivalents of toDict and fromDict for every model
+    class.
+    """
     __slots__ = []
     __metaclass__ = ModelMeta
+    _slotTypes = {}
+
     def toDict(self):
         ret = {}
         for slot in self.__slots__:
@@ -112,6 +303,35 @@ class _BaseSlotCompare(SlotCompare):
                 ret[slot] = val
         return ret
 
+    @classmethod
+    def fromDict(cls, values):
+        "Build a model from a dictionary as returned by toDict"
+        values = _asDict(values)
+        obj = cls()
+        for slot in cls.__slots__:
+            val = values.get(slot)
+            slotType = cls._slotTypes.get(slot)
+            if isinstance(slotType, list):
+                if isinstance(val, (list, tuple)):
+                    val = slotType[0].fromDictList(val)
+            elif slotType is not None and isinstance(val, _dictTypes):
+                val = slotType.fromDict(val)
+            setattr(obj, slot, val)
+        return obj
+
+    @classmethod
+    def toDictList(cls, objects):
+        "Convert a list of models to a list of dictionaries"
+        toDict = cls.toDict.im_func
+        return [ toDict(x) if type(x) is cls else x.toDict() for x in objects ]
+
+    @classmethod
+    def fromDictList(cls, values):
+        "Convert a list of dictionaries to a list of models"
+        fromDict = cls.fromDict
+        return [ fromDict(x) if isinstance(x, _dictTypes) else x
+            for x in values ]
+
 class CimParams(_BaseSlotCompare):
     """
     Information required in order to talk to a WBEM endpoint
@@ -146,6 +366,14 @@ class ManagementInterfaceParams(_BaseSlotCompare):
     """
     __slots__ = [ 'host', 'interfacesList', 'eventUuid', ]
 
+class ManagementInterfaceBulkParams(_BaseSlotCompare):
+    """
+    Information needed for probing many systems for a management interface.
+    Systems are given as a list of hosts, a network in CIDR notation, or
+    both.
+    """
+    __slots__ = [ 'hosts', 'network', 'interfacesList', 'eventUuid', ]
+
 class URL(_BaseSlotCompare):
     """
     Basic representation of a URL
@@ -246,6 +474,9 @@ class TargetCommandArguments(_BaseSlotCompare):
     __slots__ = ['jobUrl', 'authToken',
         'targetConfiguration', 'targetUserCredentials', 'args',
         'targetAllUserCredentials', 'zoneAddresses', ]
+    _slotTypes = dict(targetConfiguration=TargetConfiguration,
+        targetUserCredentials=TargetUserCredentials,
+        targetAllUserCredentials=[TargetUserCredentials])
 
 class ScriptOutput(_BaseSlotCompare, _Serializable):
     __slots__ = [ 'returnCode', 'stdout', 'stderr' ]
@@ -22,7 +22,6 @@ log = logging.getLogger(__name__)
 import StringIO
 import socket
 import sys
-import tempfile
 from twisted.internet.defer import maybeDeferred
 
 from conary.lib.formattrace import formatTrace
@@ -34,6 +33,7 @@ from rmake3.lib.logger import logFailure
 from rmake3.worker import plug_worker
 
 from rpath_repeater.codes import Codes as C, NS
+from rpath_repeater.utils import credfiles
 from rpath_repeater.utils import nodeinfo
 from rpath_repeater import models
 from rpath_repeater.utils.xmlutils import XML
@@ -276,12 +276,10 @@ class BaseTaskHandler(plug_worker.TaskHandler):
 
     @classmethod
     def _tempFile(cls, prefix, contents):
-        # NamedTemporaryFile will conveniently go *poof* when it gets closed
-        tmpf = tempfile.NamedTemporaryFile(dir=cls.TemporaryDir, prefix=prefix)
-        tmpf.write(contents)
-        # Flush the contents on the disk, so python's ssl lib can see them
-        tmpf.flush()
-        return tmpf
+        # Tasks with the same contents share one file, which will go *poof*
+        # when the last of them closes it
+        return credfiles.credentialFiles.acquire(contents, prefix=prefix,
+            dir=cls.TemporaryDir)
 
     @classmethod
     def _trove(cls, troveSpec):
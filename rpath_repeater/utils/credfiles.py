@@ -0,0 +1,136 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Worker-wide cache of credential files (certificates, keys), shared by all
+tasks that need the same contents on disk.
+"""
+
+
+import hashlib
+import os
+import tempfile
+import threading
+
+
+class CredentialFile(object):
+    """
+    A reference to a cached credential file. Like a NamedTemporaryFile, the
+    file is available as name until close() is called; the file itself is
+    removed once every reference to it is closed.
+    """
+
+    def __init__(self, cache, key, entry):
+        self._cache = cache
+        self._key = key
+        self._entry = entry
+        self.name = entry.name
+        self.closed = False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._cache._release(self._key, self._entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+class _Entry(object):
+    __slots__ = [ 'name', 'refs', ]
+
+    def __init__(self, name):
+        self.name = name
+        self.refs = 0
+
+
+class CredentialFileCache(object):
+    """
+    Reference-counted, content-addressed credential files. Files are
+    created with mode 0600 under unpredictable names, and unlinked when
+    their last reference is closed.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, contents, prefix='tmp', dir=None):
+        "Return a CredentialFile holding contents"
+        key = (dir, hashlib.sha256(contents).hexdigest())
+        with self._lock:
+            entry = self._entries.get(key)
+            # Something may have cleaned up the directory behind our back
+            if entry is not None and not os.path.exists(entry.name):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                entry = self._entries[key] = _Entry(
+                    self._write(contents, prefix, dir))
+            else:
+                self.hits += 1
+            entry.refs += 1
+            return CredentialFile(self, key, entry)
+
+    @classmethod
+    def _write(cls, contents, prefix, dir):
+        # mkstemp creates the file with mode 0600
+        fd, name = tempfile.mkstemp(prefix=prefix, dir=dir)
+        try:
+            while contents:
+                contents = contents[os.write(fd, contents):]
+        except:
+            os.close(fd)
+            os.unlink(name)
+            raise
+        os.close(fd)
+        return name
+
+    def _release(self, key, entry):
+        with self._lock:
+            entry.refs -= 1
+            if entry.refs > 0:
+                return
+            # The entry may have been replaced already, if its file vanished
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        try:
+            os.unlink(entry.name)
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len(self._entries)
+
+    def getStats(self):
+        return dict(size=len(self._entries), hits=self.hits,
+            misses=self.misses,
+            refs=sum(x.refs for x in self._entries.values()))
+
+# Shared by everything in this worker
+credentialFiles = CredentialFileCache()
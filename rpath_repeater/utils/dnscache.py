@@ -0,0 +1,231 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Worker-wide cache of host name lookups.
+"""
+
+
+import collections
+import socket
+import threading
+import time
+
+from twisted.internet import defer
+from twisted.internet import threads
+
+
+class _Lookup(object):
+    "A lookup in progress, which other threads can wait on"
+    __slots__ = [ 'event', 'outcome', ]
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.outcome = None
+
+
+class DnsCache(object):
+    """
+    Cache of getaddrinfo results, keyed by (host, family). Addresses are
+    remembered for positive_ttl seconds and failed lookups for negative_ttl
+    seconds (temporary resolver failures are not cached). The least
+    recently used entries are evicted beyond max_size.
+    Concurrent lookups of the same name are coalesced into a single query,
+    both for the blocking lookup() and the deferred lookupDeferred().
+    """
+
+    def __init__(self, positive_ttl=300, negative_ttl=30, max_size=10000,
+            clock=time.time, getaddrinfo=socket.getaddrinfo):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._getaddrinfo = getaddrinfo
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Lookups in progress, by key
+        self._inflight = {}
+        # Deferreds waiting on a lookup, by key
+        self._waiting = {}
+        # Counters
+        self.hits = 0
+        self.negativeHits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.queries = 0
+
+    @classmethod
+    def _literal(cls, host, family):
+        for addrFamily in (socket.AF_INET, socket.AF_INET6):
+            if family not in (socket.AF_UNSPEC, addrFamily):
+                continue
+            try:
+                socket.inet_pton(addrFamily, host)
+            except (socket.error, TypeError, ValueError):
+                continue
+            if addrFamily == socket.AF_INET6:
+                return [ (addrFamily, (host, 0, 0, 0)) ]
+            return [ (addrFamily, (host, 0)) ]
+        return None
+
+    def _get(self, key):
+        "Returns (True, outcome) for a cached outcome, or (False, None)"
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] <= self.clock():
+            return False, None
+        # Re-insert, to mark as most recently used
+        self._entries[key] = entry
+        if isinstance(entry[1], Exception):
+            self.negativeHits += 1
+        else:
+            self.hits += 1
+        return True, entry[1]
+
+    def _set(self, key, outcome):
+        if isinstance(outcome, Exception):
+            if getattr(outcome, 'errno', None) == socket.EAI_AGAIN:
+                return
+            ttl = self.negative_ttl
+        else:
+            ttl = self.positive_ttl
+        if not ttl:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (self.clock() + ttl, outcome)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _query(self, host, family):
+        self.queries += 1
+        try:
+            infos = self._getaddrinfo(host, 0, family, socket.SOCK_STREAM)
+        except socket.gaierror, e:
+            return e
+        addresses = []
+        for addrFamily, _, _, _, sockaddr in infos:
+            if (addrFamily, sockaddr) not in addresses:
+                addresses.append((addrFamily, sockaddr))
+        return addresses
+
+    def lookup(self, host, family=socket.AF_UNSPEC, block=True):
+        """
+        Return the (family, sockaddr) pairs for host, with a port of 0, in
+        the order getaddrinfo returned them. Raises socket.gaierror if host
+        could not be resolved. Blocks until the lookup completes, unless
+        block is False: then None is returned if host is not cached.
+        """
+        addresses = self._literal(host, family)
+        if addresses is not None:
+            return addresses
+        key = (host, family)
+        with self._lock:
+            cached, outcome = self._get(key)
+            if not cached and not block:
+                return None
+            if not cached:
+                self.misses += 1
+                pending = self._inflight.get(key)
+                if pending is None:
+                    pending = self._inflight[key] = _Lookup()
+                    owner = True
+                else:
+                    self.coalesced += 1
+                    owner = False
+        if not cached:
+            if owner:
+                try:
+                    pending.outcome = self._query(host, family)
+                finally:
+                    with self._lock:
+                        if pending.outcome is not None:
+                            self._set(key, pending.outcome)
+                        del self._inflight[key]
+                    pending.event.set()
+            else:
+                pending.event.wait()
+            outcome = pending.outcome
+            if outcome is None:
+                raise socket.gaierror(socket.EAI_FAIL, "Lookup failed")
+        if isinstance(outcome, Exception):
+            raise outcome
+        return list(outcome)
+
+    def getaddrinfo(self, host, port, family=socket.AF_UNSPEC, block=True):
+        "Like lookup(), with port filled in the socket addresses"
+        addresses = self.lookup(host, family, block=block)
+        if addresses is None:
+            return None
+        return [ (addrFamily, (sockaddr[0], port) + tuple(sockaddr[2:]))
+            for addrFamily, sockaddr in addresses ]
+
+    def lookupDeferred(self, host, family=socket.AF_UNSPEC):
+        """
+        Like lookup(), but return a deferred instead of blocking. Lookups
+        run in the reactor's thread pool.
+        """
+        addresses = self._literal(host, family)
+        if addresses is not None:
+            return defer.succeed(addresses)
+        key = (host, family)
+        with self._lock:
+            cached, outcome = self._get(key)
+        if cached:
+            if isinstance(outcome, Exception):
+                return defer.fail(outcome)
+            return defer.succeed(list(outcome))
+        d = defer.Deferred()
+        waiting = self._waiting.get(key)
+        if waiting is not None:
+            # lookup() will count the miss for the first deferred only
+            with self._lock:
+                self.misses += 1
+                self.coalesced += 1
+            waiting.append(d)
+            return d
+        self._waiting[key] = [ d ]
+        d2 = threads.deferToThread(self.lookup, host, family)
+        d2.addBoth(self._fire, key)
+        return d
+
+    def _fire(self, result, key):
+        for d in self._waiting.pop(key):
+            if isinstance(result, list):
+                d.callback(list(result))
+            else:
+                d.errback(result)
+
+    def invalidate(self, host=None):
+        "Forget cached lookups for host, or for all hosts if host is None"
+        with self._lock:
+            if host is None:
+                self._entries.clear()
+                return
+            for key in [ x for x in self._entries if x[0] == host ]:
+                del self._entries[key]
+
+    def getStats(self):
+        lookups = self.hits + self.negativeHits + self.misses
+        if lookups:
+            hitRate = float(self.hits + self.negativeHits) / lookups
+        else:
+            hitRate = 0.0
+        return dict(size=len(self._entries), hits=self.hits,
+            negativeHits=self.negativeHits, misses=self.misses,
+            coalesced=self.coalesced, queries=self.queries, hitRate=hitRate)
+
+# Shared by everything in this worker
+resolver = DnsCache()
@@ -0,0 +1,254 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Compact binary framing for REST requests and replies forwarded over the
+message bus.
+
+A frame starts with a fixed prefix (magic, format version, frame kind),
+followed by a fixed-size header with the lengths of all variable fields,
+followed by the fields themselves. Bodies are copied verbatim, so binary
+content is never re-encoded.
+
+Request frame:
+    prefix | methodLen(B) urlLen(I) headerCount(H) bodyLen(I)
+           | method | url | headers | body
+
+Reply frame:
+    prefix | status(H) messageLen(H) headerCount(H) bodyLen(I)
+           | message | headers | body
+
+Each header is encoded as nameLen(H) valueCount(H) name, followed by
+valueLen(I) value for every value.
+
+Batch frame, carrying several request or reply frames in one message:
+    prefix | frameCount(H) | frameLen(I) frame | frameLen(I) frame ...
+"""
+
+
+import struct
+
+MAGIC = 'RPF'
+VERSION = 1
+
+KIND_REQUEST = 'Q'
+KIND_REPLY = 'R'
+KIND_BATCH = 'B'
+
+_Prefix = struct.Struct('!3sBc')
+_RequestHeader = struct.Struct('!BIHI')
+_ReplyHeader = struct.Struct('!HHHI')
+_HeaderName = struct.Struct('!HH')
+_HeaderValue = struct.Struct('!I')
+_BatchHeader = struct.Struct('!H')
+_BatchEntry = struct.Struct('!I')
+
+# Largest values of the B, H and I header fields
+_MaxByte = 0xff
+_MaxShort = 0xffff
+_MaxInt = 0xffffffff
+
+
+class FramingError(Exception):
+    pass
+
+
+def isFramed(data):
+    "Return True if data looks like a compact frame (as opposed to chutney)"
+    return data[:len(MAGIC)] == MAGIC
+
+
+def isBatch(data):
+    "Return True if data is a batch of compact frames"
+    return (isFramed(data) and len(data) >= _Prefix.size
+        and data[_Prefix.size - 1] == KIND_BATCH)
+
+
+def _checkSize(what, size, limit):
+    if size > limit:
+        raise FramingError("%s too large for a frame: %d, at most %d"
+            % (what, size, limit))
+
+
+def _bytes(val):
+    if val is None:
+        return ''
+    if isinstance(val, unicode):
+        return val.encode('utf-8')
+    return str(val)
+
+
+def _encodeHeaders(headers, parts):
+    for name, values in headers.iteritems():
+        if isinstance(values, basestring):
+            values = [ values ]
+        name = _bytes(name)
+        _checkSize("Header name length", len(name), _MaxShort)
+        _checkSize("Header value count", len(values), _MaxShort)
+        parts.append(_HeaderName.pack(len(name), len(values)))
+        parts.append(name)
+        for value in values:
+            value = _bytes(value)
+            _checkSize("Header value length", len(value), _MaxInt)
+            parts.append(_HeaderValue.pack(len(value)))
+            parts.append(value)
+
+
+def _decodeHeaders(data, offset, count):
+    headers = {}
+    for _ in xrange(count):
+        nameLen, valueCount = _HeaderName.unpack_from(data, offset)
+        offset += _HeaderName.size
+        name = data[offset:offset + nameLen]
+        offset += nameLen
+        values = []
+        for _ in xrange(valueCount):
+            valueLen, = _HeaderValue.unpack_from(data, offset)
+            offset += _HeaderValue.size
+            values.append(data[offset:offset + valueLen])
+            offset += valueLen
+        headers.setdefault(name, []).extend(values)
+    return headers, offset
+
+
+def _checkPrefix(data, kind):
+    if len(data) < _Prefix.size:
+        raise FramingError("Truncated frame")
+    magic, version, frameKind = _Prefix.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise FramingError("Not a compact frame")
+    if version != VERSION:
+        raise FramingError("Unsupported frame version %d" % version)
+    if frameKind != kind:
+        raise FramingError("Unexpected frame kind %r" % frameKind)
+    return _Prefix.size
+
+
+def _body(data, offset, bodyLen):
+    if len(data) - offset != bodyLen:
+        raise FramingError("Frame length mismatch")
+    return data[offset:]
+
+
+def encodeRequest(method, url, headers, body):
+    method = _bytes(method)
+    url = _bytes(url)
+    body = _bytes(body)
+    _checkSize("Method length", len(method), _MaxByte)
+    _checkSize("URL length", len(url), _MaxInt)
+    _checkSize("Body length", len(body), _MaxInt)
+    _checkSize("Header count", len(headers), _MaxShort)
+    parts = [
+        _Prefix.pack(MAGIC, VERSION, KIND_REQUEST),
+        _RequestHeader.pack(len(method), len(url), len(headers), len(body)),
+        method,
+        url,
+    ]
+    _encodeHeaders(headers, parts)
+    parts.append(body)
+    return ''.join(parts)
+
+
+def decodeRequest(data):
+    try:
+        offset = _checkPrefix(data, KIND_REQUEST)
+        methodLen, urlLen, headerCount, bodyLen = \
+            _RequestHeader.unpack_from(data, offset)
+        offset += _RequestHeader.size
+        method = data[offset:offset + methodLen]
+        offset += methodLen
+        url = data[offset:offset + urlLen]
+        offset += urlLen
+        headers, offset = _decodeHeaders(data, offset, headerCount)
+    except struct.error, e:
+        raise FramingError("Truncated frame: %s" % e)
+    return dict(
+        method=method,
+        url=url,
+        headers=headers,
+        body=_body(data, offset, bodyLen),
+    )
+
+
+def encodeReply(status, message, headers, body):
+    message = _bytes(message)
+    body = _bytes(body)
+    status = int(status)
+    if status < 0:
+        raise FramingError("Invalid status %d" % status)
+    _checkSize("Status", status, _MaxShort)
+    _checkSize("Status message length", len(message), _MaxShort)
+    _checkSize("Body length", len(body), _MaxInt)
+    _checkSize("Header count", len(headers), _MaxShort)
+    parts = [
+        _Prefix.pack(MAGIC, VERSION, KIND_REPLY),
+        _ReplyHeader.pack(status, len(message), len(headers), len(body)),
+        message,
+    ]
+    _encodeHeaders(headers, parts)
+    parts.append(body)
+    return ''.join(parts)
+
+
+def decodeReply(data):
+    try:
+        offset = _checkPrefix(data, KIND_REPLY)
+        status, messageLen, headerCount, bodyLen = \
+            _ReplyHeader.unpack_from(data, offset)
+        offset += _ReplyHeader.size
+        message = data[offset:offset + messageLen]
+        offset += messageLen
+        headers, offset = _decodeHeaders(data, offset, headerCount)
+    except struct.error, e:
+        raise FramingError("Truncated frame: %s" % e)
+    return dict(
+        status=status,
+        message=message,
+        headers=headers,
+        body=_body(data, offset, bodyLen),
+    )
+
+
+def encodeBatch(frames):
+    _checkSize("Frame count", len(frames), _MaxShort)
+    parts = [
+        _Prefix.pack(MAGIC, VERSION, KIND_BATCH),
+        _BatchHeader.pack(len(frames)),
+    ]
+    for frame in frames:
+        _checkSize("Frame length", len(frame), _MaxInt)
+        parts.append(_BatchEntry.pack(len(frame)))
+        parts.append(frame)
+    return ''.join(parts)
+
+
+def decodeBatch(data):
+    try:
+        offset = _checkPrefix(data, KIND_BATCH)
+        count, = _BatchHeader.unpack_from(data, offset)
+        offset += _BatchHeader.size
+        frames = []
+        for _ in xrange(count):
+            frameLen, = _BatchEntry.unpack_from(data, offset)
+            offset += _BatchEntry.size
+            frames.append(data[offset:offset + frameLen])
+            offset += frameLen
+    except struct.error, e:
+        raise FramingError("Truncated frame: %s" % e)
+    if offset != len(data):
+        raise FramingError("Frame length mismatch")
+    return frames
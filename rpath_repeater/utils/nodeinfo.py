@@ -15,15 +15,24 @@
 #
 
 
-import sys
+import os
+import time
+import errno
 import fcntl
+import heapq
+import hashlib
 import select
 import socket
 import struct
+import threading
+import collections
+import Queue
 
 from OpenSSL import SSL
 from OpenSSL import crypto
 
+from rpath_repeater.utils import dnscache
+
 class ProbeHostError(Exception):
     pass
 
@@ -38,71 +47,819 @@ def get_ip_address(ifname):
 def get_hostname():
     return socket.getfqdn()
 
-def probe_host(host, port):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(10)
-    try:
-        s.connect((host, port))
-    except socket.error, e:
-        raise ProbeHostError(str(e))
-    s.close()
+class ProbeCache(object):
+    """
+    Recent probe outcomes, keyed by (host, port, tag). An outcome is either
+    the exception a probe failed with, or any other value for a successful
+    probe (such as the server's certificate, for TLS probes). tag tells
+    apart probes of the same port that may have different outcomes, such
+    as TLS probes with different client certificates. Successful
+    probes are remembered for positive_ttl seconds and failed ones for
+    negative_ttl seconds; the least recently used entries are evicted beyond
+    max_size.
+    """
+
+    def __init__(self, positive_ttl=60, negative_ttl=10, max_size=10000,
+            clock=time.time):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, host, port, tag=None):
+        """
+        Returns (True, outcome) for a cached outcome, or (False, None) if
+        nothing is cached.
+        """
+        key = (host, port, tag)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= self.clock():
+                self.misses += 1
+                return False, None
+            # Re-insert, to mark as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, host, port, outcome=None, tag=None):
+        if isinstance(outcome, Exception):
+            ttl = self.negative_ttl
+        else:
+            ttl = self.positive_ttl
+        if not ttl:
+            return
+        key = (host, port, tag)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.clock() + ttl, outcome)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, host=None, port=None):
+        """
+        Forget cached outcomes for one port on a host, all ports on a host
+        (if port is None), or everything (if host is None too).
+        """
+        with self._lock:
+            if host is None:
+                self._entries.clear()
+                return
+            for key in [ x for x in self._entries if x[0] == host and
+                    port in (None, x[1]) ]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def getStats(self):
+        return dict(size=len(self._entries), hits=self.hits,
+            misses=self.misses)
+
+class RttTracker(object):
+    """
+    Connect round-trip times observed per subnet (the /prefix network of
+    IPv4 addresses; host names count in the subnet of their address in the
+    DNS cache, and all other hosts share one bucket). Once at least
+    min_samples have been seen for a subnet, timeout() suggests the given
+    percentile of the most recent window samples, times multiplier,
+    bounded by floor and ceiling.
+    """
+
+    def __init__(self, percentile=95, multiplier=3, floor=0.25, ceiling=10,
+            window=256, min_samples=8, prefix=24):
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.floor = floor
+        self.ceiling = ceiling
+        self.window = window
+        self.min_samples = min_samples
+        self.prefix = prefix
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def subnet(self, host):
+        return subnet_of(host, self.prefix, resolve=True)
+
+    def record(self, host, rtt):
+        key = self.subnet(host)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = collections.deque(
+                    maxlen=self.window)
+            samples.append(rtt)
+
+    def timeout(self, host, default=None):
+        """
+        Return the suggested timeout for connecting to host, or default if
+        not enough samples were observed in its subnet yet.
+        """
+        with self._lock:
+            samples = list(self._samples.get(self.subnet(host), ()))
+        return self._suggest(samples, default)
+
+    def _suggest(self, samples, default=None):
+        if len(samples) < self.min_samples:
+            return default
+        samples = sorted(samples)
+        idx = min(len(samples) - 1, len(samples) * self.percentile // 100)
+        return min(self.ceiling,
+            max(self.floor, samples[idx] * self.multiplier))
+
+    def getStats(self):
+        """
+        Return the number of samples and the suggested timeout (None if
+        there are not enough samples yet), by subnet.
+        """
+        with self._lock:
+            samples = dict((x, list(y)) for x, y in self._samples.items())
+        return dict((x, dict(samples=len(y), timeout=self._suggest(y)))
+            for x, y in samples.items())
+
+# Shared by all probes in this worker
+probe_cache = ProbeCache()
+cert_cache = ProbeCache(positive_ttl=300)
+rtt_tracker = RttTracker()
+
+def probe_host(host, port, timeout=10, use_cache=True):
+    engine = ProbeEngine(timeout=timeout,
+        cache=probe_cache if use_cache else None, rtt=rtt_tracker)
+    for probe in engine.run([ Probe(host, port) ]):
+        if probe.error is not None:
+            raise probe.error
     return True
 
-def probe_host_ssl(host, port, cert_file=None, key_file=None,
-        ssl_server_cert=None):
+def connect_dual_stack(host, port, timeout=10, stagger=None):
     """
-    Probe the given host for an SSL connection on the given port.
-    The optional cert_file and key_file arguments point to a client-side
-    certificate pair to be used.
-    If sslServerCert is provided, the server's certificate will be verified
-    against this one.
-    If successful, the function returns the server's SSL certificate in PEM
-    format. Otherwise, None is returned.
+    Open a TCP connection to host, racing all its IPv6 and IPv4 addresses
+    as described in RFC 6555 ("happy eyeballs"). Returns a (sock, family)
+    tuple for the first connection established, with sock in blocking
+    mode. Raises ProbeHostError if no address could be reached within
+    timeout seconds.
+    """
+    probe = Probe(host, port, keep_socket=True)
+    engine = ProbeEngine(timeout=timeout, rtt=rtt_tracker, stagger=stagger)
+    for probe in engine.run([ probe ]):
+        pass
+    if probe.error is not None:
+        raise probe.error
+    probe.sock.setblocking(1)
+    return probe.sock, probe.family
+
+def family_name(family):
+    return { socket.AF_INET : 'IPv4', socket.AF_INET6 : 'IPv6' }.get(
+        family, str(family))
+
+def _connect_error(err):
+    return ProbeHostError(str(socket.error(err, os.strerror(err))))
+
+def _resolve(host, port, block=True):
+    """
+    Return the (family, sockaddr) pairs for connecting to host, alternating
+    between address families, starting with the preferred one. If block is
+    False, None is returned instead of waiting for a lookup that is not
+    cached.
     """
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # Setting the timeout here (for the sake of not blocking if packets are
-    # dropped) complicates do_handshake.
-    sock.settimeout(10)
     try:
-        sock.connect((host, port))
-    except socket.error, e:
-        ei = sys.exc_info()
-        raise ProbeHostError(str(e)), None, ei[2]
+        infos = dnscache.resolver.getaddrinfo(host, port, block=block)
+    except socket.gaierror, e:
+        raise ProbeHostError(str(e))
+    if infos is None:
+        return None
+    byFamily = collections.OrderedDict()
+    for family, sockaddr in infos:
+        byFamily.setdefault(family, []).append((family, sockaddr))
+    addresses = []
+    while byFamily:
+        for family, pending in byFamily.items():
+            addresses.append(pending.pop(0))
+            if not pending:
+                del byFamily[family]
+    return addresses
 
-    ctx = SSL.Context(SSL.SSLv23_METHOD)
-    ctx.set_options(SSL.OP_NO_SSLv2)
-    if cert_file:
-        ctx.use_certificate_file(cert_file)
-    if key_file:
-        ctx.use_privatekey_file(key_file)
-    if 0 and ssl_server_cert:
-        # for some unknown reason, this does not work
-        ctx.load_verify_locations(ssl_server_cert)
-        ctx.set_verify_depth(5)
-        ctx.set_verify(SSL.VERIFY_PEER, verifyCallback)
+class Probe(object):
+    """
+    A single TCP probe, or a TLS probe if ssl_context is set. cache_tag is
+    added to the key of the probe's outcome in the engine's cache. Once done,
+    error is None and result holds True (TCP) or the server certificate in
+    PEM format (TLS), and family is the address family that was used;
+    otherwise error is a ProbeHostError.
+    If keep_socket is set, the connected socket is left open in sock.
+    """
+    __slots__ = [ 'index', 'host', 'port', 'ssl_context', 'cache_tag',
+        'keep_socket', 'token', 'addresses', 'attempts', 'sock', 'family', 'conn',
+        'started', 'deadline', 'error', 'result', ]
+
+    def __init__(self, host, port, ssl_context=None, index=None,
+            keep_socket=False, cache_tag=None):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.cache_tag = cache_tag
+        self.keep_socket = keep_socket
+        self.token = None
+        # Addresses not tried yet
+        self.addresses = []
+        # Connections in progress: fd -> (sock, family, start time)
+        self.attempts = {}
+        self.sock = None
+        self.family = None
+        self.conn = None
+        self.started = None
+        self.deadline = None
+        self.error = None
+        self.result = None
+
+    def close(self):
+        for sock, _, _ in self.attempts.values():
+            sock.close()
+        self.attempts = {}
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = self.conn = None
+
+
+class _Poller(object):
+    "Thin wrapper over epoll, or poll where epoll is not available"
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._scale = 1
+        else:
+            self._poller = select.poll()
+            self._scale = 1000
+        self.register = self._poller.register
+        self.modify = self._poller.modify
+        self.unregister = self._poller.unregister
 
+    def poll(self, timeout):
+        return self._poller.poll(timeout * self._scale)
 
-    conn = SSL.Connection(ctx, sock)
-    conn.set_connect_state()
+    def close(self):
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
 
-    pollObj = select.poll()
-    pollObj.register(sock, select.POLLIN)
 
-    for i in range(100):
+class _Resolver(object):
+    """
+    Resolves host names in up to max_threads background threads. fd becomes
+    readable whenever lookups complete; results() then returns them.
+    """
+
+    def __init__(self, max_threads):
+        self.max_threads = max_threads
+        self._threads = 0
+        self._queue = Queue.Queue()
+        self._results = []
+        self._lock = threading.Lock()
+        self.fd, self._wfd = os.pipe()
+        for fd in (self.fd, self._wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def submit(self, token, host, port):
+        if self._threads < self.max_threads:
+            self._threads += 1
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+        self._queue.put((token, host, port))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None or self.fd is None:
+                return
+            token, host, port = item
+            try:
+                outcome = _resolve(host, port)
+            except ProbeHostError, e:
+                outcome = e
+            with self._lock:
+                if self.fd is None:
+                    # Nobody is waiting for it anymore
+                    return
+                self._results.append((token, outcome))
+                try:
+                    os.write(self._wfd, 'x')
+                except OSError:
+                    # The pipe is full, so a wakeup is pending anyway
+                    pass
+
+    def results(self):
+        """
+        Return the lookups completed since the last call, as (token,
+        addresses) pairs; addresses is a ProbeHostError if the lookup failed.
+        """
         try:
-            conn.do_handshake()
-            break
-        except SSL.WantReadError:
-            while not pollObj.poll(100):
+            while os.read(self.fd, 4096):
                 pass
-        except SSL.Error:
-            ei = sys.exc_info()
-            raise ProbeHostError, ei[1], ei[2]
-    cert = conn.get_peer_certificate()
-    certPem = crypto.dump_certificate(SSL.FILETYPE_PEM, cert)
-    conn.close()
-    sock.close()
-    return certPem
+        except OSError:
+            pass
+        with self._lock:
+            results, self._results = self._results, []
+        return results
+
+    def close(self):
+        for _ in range(self._threads):
+            self._queue.put(None)
+        with self._lock:
+            os.close(self.fd)
+            os.close(self._wfd)
+            self.fd = self._wfd = None
+
+
+class ProbeEngine(object):
+    """
+    Event driven engine for running many TCP and TLS probes concurrently
+    from a single thread. At most concurrency probes are in flight (all of
+    them if concurrency is None), and each probe fails if it does not
+    complete within timeout seconds of being started.
+    When a host has several addresses, they are raced: the next address is
+    tried as soon as the previous one fails, or after stagger seconds if it
+    is still connecting, and the first connection established wins.
+    Probe outcomes are looked up in, and added to, cache (a ProbeCache) if
+    one is given; it should only be shared by probes of the same kind.
+    Connect times are recorded in rtt (an RttTracker) if one is given; with
+    adaptive set, each probe's timeout is also lowered to the one suggested
+    by rtt for its subnet.
+    Host names that are not in the DNS cache are resolved by up to
+    Resolvers background threads, so that slow lookups do not hold up the
+    other probes.
+    """
+    # Same values for poll and epoll
+    READ = select.POLLIN
+    WRITE = select.POLLOUT
+    Stagger = 0.25
+    Resolvers = 4
+
+    # Timer actions
+    _EXPIRE = 0
+    _NEXT_ADDRESS = 1
+
+    def __init__(self, timeout=10, concurrency=None, cache=None, rtt=None,
+            adaptive=False, stagger=None):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.cache = cache
+        self.rtt = rtt
+        self.adaptive = adaptive and rtt is not None
+        if stagger is None:
+            stagger = self.Stagger
+        self.stagger = stagger
+        self._poller = None
+        self._resolver = None
+        # Probes in flight, by token and by the descriptors they wait on
+        self._active = {}
+        self._pending = {}
+        # Heap of (time, probe token, action)
+        self._timers = []
+        self._tokens = 0
+
+    def run(self, probes):
+        """
+        Run probes, which may be any iterable of Probe objects; it is
+        consumed lazily, as probe slots become available.
+        Yields the probes as they complete. Closing the generator abandons
+        the remaining probes.
+        """
+        probes = iter(probes)
+        self._poller = _Poller()
+        try:
+            while True:
+                # Start as many probes as allowed
+                while probes is not None and (self.concurrency is None or
+                        len(self._active) < self.concurrency):
+                    try:
+                        probe = probes.next()
+                    except StopIteration:
+                        probes = None
+                        break
+                    if not self._start(probe):
+                        yield probe
+                if not self._active:
+                    if probes is None:
+                        break
+                    continue
+
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    _, token, action = heapq.heappop(self._timers)
+                    probe = self._active.get(token)
+                    if probe is None:
+                        # Already completed
+                        continue
+                    if action == self._EXPIRE:
+                        probe.error = ProbeHostError('timed out')
+                    elif probe.sock is not None or self._connect(probe):
+                        continue
+                    self._finish(probe)
+                    yield probe
+                if not self._active:
+                    continue
+
+                remaining = max(0, self._timers[0][0] - time.time())
+                for fd, event in self._poller.poll(remaining):
+                    if self._resolver is not None and (
+                            fd == self._resolver.fd):
+                        for probe in self._resolved():
+                            yield probe
+                        continue
+                    probe = self._pending.get(fd)
+                    if probe is None:
+                        # Abandoned while handling an earlier event
+                        continue
+                    if self._step(probe, fd):
+                        continue
+                    self._finish(probe)
+                    yield probe
+        finally:
+            for probe in self._active.values():
+                probe.close()
+            self._active.clear()
+            self._pending.clear()
+            self._poller.close()
+            if self._resolver is not None:
+                self._resolver.close()
+                self._resolver = None
+
+    def _done(self, probe):
+        if self.cache is not None:
+            if probe.error is not None:
+                outcome = probe.error
+            else:
+                outcome = probe.result
+            self.cache.set(probe.host, probe.port, outcome,
+                tag=probe.cache_tag)
+
+    def _finish(self, probe):
+        for fd in probe.attempts.keys():
+            self._unwatch(fd)
+        if probe.sock is not None:
+            self._unwatch(probe.sock.fileno())
+        del self._active[probe.token]
+        if probe.error is not None or not probe.keep_socket:
+            probe.close()
+        self._done(probe)
+
+    def _watch(self, probe, fd, mask):
+        self._pending[fd] = probe
+        self._poller.register(fd, mask)
+
+    def _unwatch(self, fd):
+        if self._pending.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    def _start(self, probe):
+        """
+        Start probing. Returns False if the probe completed right away.
+        """
+        if self.cache is not None:
+            cached, outcome = self.cache.get(probe.host, probe.port,
+                probe.cache_tag)
+            if cached:
+                if isinstance(outcome, Exception):
+                    probe.error = outcome
+                else:
+                    probe.result = outcome
+                return False
+        timeout = self.timeout
+        if self.adaptive:
+            timeout = min(timeout, self.rtt.timeout(probe.host, timeout))
+        probe.started = time.time()
+        probe.deadline = probe.started + timeout
+        try:
+            addresses = _resolve(probe.host, probe.port, block=False)
+        except ProbeHostError, e:
+            probe.error = e
+            self._done(probe)
+            return False
+        self._tokens += 1
+        probe.token = self._tokens
+        self._active[probe.token] = probe
+        heapq.heappush(self._timers,
+            (probe.deadline, probe.token, self._EXPIRE))
+        if addresses is None:
+            self._lookup(probe)
+            return True
+        probe.addresses = addresses
+        if self._connect(probe):
+            return True
+        self._finish(probe)
+        return False
+
+    def _lookup(self, probe):
+        if self._resolver is None:
+            self._resolver = _Resolver(self.Resolvers)
+            self._poller.register(self._resolver.fd, self.READ)
+        self._resolver.submit(probe.token, probe.host, probe.port)
+
+    def _resolved(self):
+        "Start connecting the probes whose lookups completed"
+        for token, addresses in self._resolver.results():
+            probe = self._active.get(token)
+            if probe is None:
+                # Expired while resolving
+                continue
+            if isinstance(addresses, ProbeHostError):
+                probe.error = addresses
+            else:
+                probe.addresses = addresses
+                if self._connect(probe):
+                    continue
+            self._finish(probe)
+            yield probe
+
+    def _connect(self, probe):
+        """
+        Start connecting to the next address of the probe. Returns False if
+        the probe failed: no addresses are left, and no connection attempt
+        is in progress.
+        """
+        while probe.addresses:
+            family, sockaddr = probe.addresses.pop(0)
+            try:
+                sock = socket.socket(family, socket.SOCK_STREAM)
+            except socket.error, e:
+                # Such as IPv6 not being available
+                probe.error = ProbeHostError(str(e))
+                continue
+            sock.setblocking(0)
+            try:
+                err = sock.connect_ex(sockaddr)
+            except socket.error, e:
+                sock.close()
+                probe.error = ProbeHostError(str(e))
+                continue
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sock.close()
+                probe.error = _connect_error(err)
+                continue
+            # Completion (even an immediate one) is reported as writable
+            probe.attempts[sock.fileno()] = (sock, family, time.time())
+            self._watch(probe, sock.fileno(), self.WRITE)
+            if probe.addresses:
+                heapq.heappush(self._timers, (time.time() + self.stagger,
+                    probe.token, self._NEXT_ADDRESS))
+            return True
+        return bool(probe.attempts)
+
+    def _step(self, probe, fd):
+        """
+        Make progress on a probe that has an event pending on fd. Returns
+        False once the probe is done.
+        """
+        if probe.sock is None:
+            sock, family, started = probe.attempts.pop(fd)
+            self._unwatch(fd)
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if self.rtt is not None and err in (0, errno.ECONNREFUSED):
+                # Either way, the host answered
+                self.rtt.record(probe.host, time.time() - started)
+            if err:
+                sock.close()
+                probe.error = _connect_error(err)
+                # Move on to the next address right away
+                return self._connect(probe)
+            # First connection wins, abandon the others
+            for otherFd, (other, _, _) in probe.attempts.items():
+                self._unwatch(otherFd)
+                other.close()
+            probe.attempts = {}
+            probe.sock = sock
+            probe.family = family
+            probe.error = None
+            if probe.ssl_context is None:
+                probe.result = True
+                return False
+            probe.conn = SSL.Connection(probe.ssl_context, sock)
+            probe.conn.set_connect_state()
+            self._watch(probe, fd, self.WRITE)
+        try:
+            probe.conn.do_handshake()
+        except SSL.WantReadError:
+            self._poller.modify(fd, self.READ)
+            return True
+        except SSL.WantWriteError:
+            self._poller.modify(fd, self.WRITE)
+            return True
+        except SSL.Error, e:
+            probe.error = ProbeHostError(e)
+            return False
+        cert = probe.conn.get_peer_certificate()
+        probe.result = crypto.dump_certificate(SSL.FILETYPE_PEM, cert)
+        return False
+
+
+def iter_probe_hosts(targets, timeout=10, concurrency=None, use_cache=True,
+        adaptive=False):
+    """
+    Probe (host, port) targets with non-blocking connects, keeping at most
+    concurrency probes in flight (all of them if concurrency is None).
+    Each probe fails if it does not complete within timeout seconds of
+    being started; without a concurrency limit that is one overall
+    deadline for all the targets.
+    targets may be any iterable; it is consumed lazily, as probe slots
+    become available.
+    Yields (index, error) pairs as probes complete, where index is the
+    position of the target in targets and error is None on success, or a
+    ProbeHostError. Closing the generator abandons the remaining probes.
+    Recent outcomes are answered from probe_cache, unless use_cache is
+    False. If adaptive is set, timeout is only an upper bound, and probes
+    time out as suggested by rtt_tracker for the target's subnet.
+    """
+    probes = (Probe(host, port, index=index)
+        for index, (host, port) in enumerate(targets))
+    engine = ProbeEngine(timeout=timeout, concurrency=concurrency,
+        cache=probe_cache if use_cache else None, rtt=rtt_tracker,
+        adaptive=adaptive)
+    results = engine.run(probes)
+    try:
+        for probe in results:
+            yield probe.index, probe.error
+    finally:
+        results.close()
+
+def iter_probe_hosts_ssl(targets, timeout=10, concurrency=None,
+        cert_file=None, key_file=None, use_cache=True):
+    """
+    Like iter_probe_hosts, but also complete a TLS handshake, optionally
+    with a client-side certificate pair. Yields (index, error, certPem)
+    tuples, where certPem is the server's certificate in PEM format.
+    Recent outcomes are answered from cert_cache, unless use_cache is False.
+    """
+    identity, ctx = _ssl_context(cert_file, key_file)
+    probes = (Probe(host, port, ssl_context=ctx, index=index,
+            cache_tag=identity)
+        for index, (host, port) in enumerate(targets))
+    engine = ProbeEngine(timeout=timeout, concurrency=concurrency,
+        cache=cert_cache if use_cache else None, rtt=rtt_tracker)
+    results = engine.run(probes)
+    try:
+        for probe in results:
+            yield probe.index, probe.error, probe.result
+    finally:
+        results.close()
+
+def _ipv4_to_int(address):
+    # inet_aton would also take shorthands like 10.1
+    return struct.unpack('!I', socket.inet_pton(socket.AF_INET, address))[0]
+
+def _int_to_ipv4(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+def subnet_of(host, prefix=24, resolve=False):
+    """
+    Return the address of the /prefix network host is in, or None if host
+    is not an IPv4 address. If resolve is set, host names count in the
+    subnet of their IPv4 address in the DNS cache; they are not looked up.
+    """
+    mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+    try:
+        return _int_to_ipv4(_ipv4_to_int(host) & mask)
+    except (socket.error, TypeError):
+        pass
+    if not resolve:
+        return None
+    try:
+        addresses = dnscache.resolver.lookup(host, block=False)
+    except socket.gaierror:
+        return None
+    for family, sockaddr in addresses or ():
+        if family == socket.AF_INET:
+            return subnet_of(sockaddr[0], prefix)
+    return None
+
+def expand_network(network, max_hosts=65536):
+    """
+    Return the list of host addresses in an IPv4 network given in CIDR
+    notation (e.g. 10.0.0.0/24). The network and broadcast addresses are
+    left out for networks with more than two addresses.
+    """
+    address, slash, prefix = network.partition('/')
+    try:
+        if not slash:
+            prefix = 32
+        prefix = int(prefix)
+        if not 0 <= prefix <= 32:
+            raise ValueError()
+        start = _ipv4_to_int(address)
+    except (ValueError, socket.error):
+        raise ValueError("Invalid network %s" % network)
+    size = 1 << (32 - prefix)
+    start &= ~(size - 1) & 0xffffffff
+    end = start + size
+    if size > 2:
+        start, end = start + 1, end - 1
+    if end - start > max_hosts:
+        raise ValueError("Network %s has more than %d hosts" %
+            (network, max_hosts))
+    return [ _int_to_ipv4(x) for x in xrange(start, end) ]
+
+def _read(path):
+    if not path:
+        return None
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+# SSL contexts, by digest of the client-side certificate pair. Credential
+# files are usually per-task temporary files, so their names are useless
+# as keys.
+_ssl_contexts = collections.OrderedDict()
+_ssl_contexts_lock = threading.Lock()
+_ssl_contexts_max_size = 64
+# Digests of the pairs seen recently, by file names, along with the files'
+# stat stamps; files that did not change are not read again
+_ssl_identities = collections.OrderedDict()
+_ssl_identities_max_size = 256
+
+def _stamp(path):
+    if not path:
+        return None
+    st = os.stat(path)
+    return st.st_ino, st.st_mtime, st.st_size
+
+def _ssl_context(cert_file=None, key_file=None):
+    """
+    Return (identity, context) for the given client-side certificate pair,
+    where identity is a digest of the certificate and key. Contexts are
+    shared by pairs with the same contents; the least recently used ones
+    are dropped beyond _ssl_contexts_max_size. The files are only read
+    and hashed if they changed since they were last seen.
+    """
+    names = (cert_file, key_file)
+    stamps = (_stamp(cert_file), _stamp(key_file))
+    with _ssl_contexts_lock:
+        entry = _ssl_identities.get(names)
+        if entry is not None and entry[0] == stamps:
+            identity = entry[1]
+            ctx = _ssl_contexts.pop(identity, None)
+            if ctx is not None:
+                # Re-insert, to mark as most recently used
+                _ssl_contexts[identity] = ctx
+                return identity, ctx
+    cert = _read(cert_file)
+    key = _read(key_file)
+    digest = hashlib.sha1()
+    for data in (cert, key):
+        if data is not None:
+            digest.update(hashlib.sha1(data).digest())
+        else:
+            digest.update('\0' * 20)
+    identity = digest.hexdigest()
+    with _ssl_contexts_lock:
+        _ssl_identities.pop(names, None)
+        _ssl_identities[names] = (stamps, identity)
+        while len(_ssl_identities) > _ssl_identities_max_size:
+            _ssl_identities.popitem(last=False)
+        ctx = _ssl_contexts.pop(identity, None)
+        if ctx is not None:
+            _ssl_contexts[identity] = ctx
+            return identity, ctx
+    ctx = SSL.Context(SSL.SSLv23_METHOD)
+    ctx.set_options(SSL.OP_NO_SSLv2)
+    if cert is not None:
+        ctx.use_certificate(crypto.load_certificate(SSL.FILETYPE_PEM, cert))
+    if key is not None:
+        ctx.use_privatekey(crypto.load_privatekey(SSL.FILETYPE_PEM, key))
+    with _ssl_contexts_lock:
+        _ssl_contexts[identity] = ctx
+        while len(_ssl_contexts) > _ssl_contexts_max_size:
+            _ssl_contexts.popitem(last=False)
+    return identity, ctx
+
+def probe_host_ssl(host, port, cert_file=None, key_file=None,
+        ssl_server_cert=None, timeout=10, use_cache=True):
+    """
+    Probe the given host for an SSL connection on the given port.
+    The optional cert_file and key_file arguments point to a client-side
+    certificate pair to be used.
+    ssl_server_cert is currently ignored (verifying the server's certificate
+    against it never worked).
+    The connection and the handshake have to complete within timeout
+    seconds. Recent outcomes are answered from cert_cache, unless use_cache
+    is False.
+    If successful, the function returns the server's SSL certificate in PEM
+    format. Otherwise, ProbeHostError is raised.
+    """
+    identity, ctx = _ssl_context(cert_file, key_file)
+    engine = ProbeEngine(timeout=timeout,
+        cache=cert_cache if use_cache else None, rtt=rtt_tracker)
+    probe = Probe(host, port, ssl_context=ctx, cache_tag=identity)
+    for probe in engine.run([ probe ]):
+        if probe.error is not None:
+            raise probe.error
+        return probe.result
 
 def verifyCallback(conn, x509, errno, depth, retcode):
     return retcode
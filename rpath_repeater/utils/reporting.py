@@ -16,6 +16,7 @@
 
 
 import logging
+import socket
 log = logging.getLogger(__name__)
 
 from twisted.internet import reactor
@@ -23,6 +24,7 @@ from twisted.internet import task as ti_task
 from twisted.web import error as tw_error
 
 from rmake3.lib.twisted_extras import tools
+from rpath_repeater.utils import dnscache
 from rpath_repeater.utils.http import HTTPClientFactory
 from rpath_repeater.utils.xmlutils import XML
 
@@ -96,7 +98,11 @@ class ReportingMixIn(object):
                         "for job %s of type %s: %s", self.job.job_uuid,
                         self.job.job_type, error.getErrorMessage())
         host, port = connArgs
-        reactor.connectTCP(host, port, fact)
+        d = dnscache.resolver.lookupDeferred(host, socket.AF_INET)
+        @d.addCallback
+        def connect(addresses):
+            reactor.connectTCP(addresses[0][1][0], port, fact)
+        d.addErrback(fact.deferred.errback)
         return fact.deferred
 
     def getResultsUrl(self):
@@ -20,9 +20,20 @@ SSH node communication tools
 """
 
 
+import collections
+import hashlib
+import os
+import pipes
+import re
+import select
+import socket
+import threading
+import time
+
 import paramiko
 import logging
 from rpath_repeater.codes import Codes as C
+from rpath_repeater.utils import nodeinfo
 
 class PrivateKey(object):
     """
@@ -38,6 +49,260 @@ class PrivateKey(object):
     def readlines(self):
         return self.key_bytes.split("\n")
 
+def _keyClasses(names):
+    # Newer key types are not available in older versions of paramiko
+    return [ getattr(paramiko, x) for x in names if hasattr(paramiko, x) ]
+
+class KeyCache(object):
+    """
+    Parsed private keys, keyed by hashes of the key material and of the
+    passphrase, so that neither is kept here in the clear. The least
+    recently used keys are dropped beyond maxSize.
+    """
+    # Key classes to try, by PEM header
+    KeyTypes = {
+        'DSA' : _keyClasses([ 'DSSKey' ]),
+        'RSA' : _keyClasses([ 'RSAKey' ]),
+        'EC' : _keyClasses([ 'ECDSAKey' ]),
+        'OPENSSH' : _keyClasses([ 'Ed25519Key', 'RSAKey', 'ECDSAKey',
+            'DSSKey' ]),
+    }
+    AllKeyTypes = _keyClasses([ 'RSAKey', 'DSSKey', 'ECDSAKey',
+        'Ed25519Key' ])
+
+    def __init__(self, maxSize=64):
+        self.maxSize = maxSize
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def _digest(cls, val):
+        if val is None:
+            return None
+        if isinstance(val, unicode):
+            val = val.encode('utf-8')
+        return hashlib.sha256(val).hexdigest()
+
+    def load(self, key, password=None):
+        """
+        Return the parsed private key given as a string; password unlocks
+        it, if it is encrypted.
+        """
+        cacheKey = (self._digest(key), self._digest(password))
+        with self._lock:
+            pkey = self._keys.pop(cacheKey, None)
+            if pkey is not None:
+                self._keys[cacheKey] = pkey
+                self.hits += 1
+                return pkey
+            self.misses += 1
+        pkey = self.parse(key, password)
+        with self._lock:
+            self._keys[cacheKey] = pkey
+            while len(self._keys) > self.maxSize:
+                self._keys.popitem(last=False)
+        return pkey
+
+    @classmethod
+    def parse(cls, key, password=None):
+        header = re.search(r'-----BEGIN (\w+) PRIVATE KEY-----', key)
+        if header is not None:
+            classes = cls.KeyTypes.get(header.group(1), cls.AllKeyTypes)
+        else:
+            classes = cls.AllKeyTypes
+        error = None
+        for keyClass in classes:
+            try:
+                return keyClass.from_private_key(file_obj=PrivateKey(key),
+                    password=password)
+            except paramiko.PasswordRequiredException:
+                raise
+            except paramiko.SSHException, e:
+                error = e
+        raise error or paramiko.SSHException("Unsupported private key")
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+# Shared by all connectors in this process
+keyCache = KeyCache()
+
+def loadPrivateKey(key, password=None):
+    """
+    Parse a private key given as a string; password unlocks it, if it is
+    encrypted.
+    """
+    return keyCache.load(key, password)
+
+class _DigestCache(object):
+    """
+    SHA-1 digests of local files, recomputed only when a file's size or
+    modification time changes.
+    """
+
+    def __init__(self):
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        "Return (size, hex digest) for path"
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime)
+        with self._lock:
+            entry = self._digests.get(path)
+        if entry is not None and entry[0] == stamp:
+            return st.st_size, entry[1]
+        digest = hashlib.sha1()
+        f = open(path, 'rb')
+        try:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                digest.update(data)
+        finally:
+            f.close()
+        with self._lock:
+            self._digests[path] = (stamp, digest.hexdigest())
+        return st.st_size, digest.hexdigest()
+
+localDigests = _DigestCache()
+
+def _connectDualStack(host, port, timeout):
+    '''
+    Like nodeinfo.connect_dual_stack, but fail with socket.error (or
+    socket.timeout), as a plain connect does
+    '''
+    try:
+        return nodeinfo.connect_dual_stack(host, port, timeout=timeout)
+    except nodeinfo.ProbeHostError, e:
+        if str(e) == 'timed out':
+            raise socket.timeout(str(e))
+        raise socket.error(str(e))
+
+class CommandTimeout(Exception):
+    "A remote command did not complete in time"
+
+
+class TransportPool(object):
+    """
+    Authenticated SSH connections, kept open for reuse by later connectors
+    to the same system with the same credentials.
+
+    Connections are keyed by (host, port, user, credential fingerprint).
+    Idle connections are closed after maxIdle seconds, and the least
+    recently returned ones are closed once more than maxSize are idle.
+    Connections are checked to still be active before being handed out.
+    """
+
+    def __init__(self, maxSize=32, maxIdle=300, clock=time.time):
+        self.maxSize = maxSize
+        self.maxIdle = maxIdle
+        self.clock = clock
+        # (key, client id) -> (key, client, returned at), oldest first
+        self._idle = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Counters
+        self.reused = 0
+        self.released = 0
+        self.expired = 0
+        self.evicted = 0
+        self.broken = 0
+
+    @classmethod
+    def fingerprint(cls, password, key):
+        "Hash of the credentials, so they are not kept in the key"
+        digest = hashlib.sha1()
+        for val in (password, key):
+            val = val or ''
+            if isinstance(val, unicode):
+                val = val.encode('utf-8')
+            digest.update('%d:%s' % (len(val), val))
+        return digest.hexdigest()
+
+    @classmethod
+    def makeKey(cls, host, port, user, password, key):
+        return (host, port, user, cls.fingerprint(password, key))
+
+    @classmethod
+    def isHealthy(cls, client):
+        transport = client.get_transport()
+        return (transport is not None and transport.is_active()
+            and transport.is_authenticated())
+
+    def _expire(self, now):
+        expired = []
+        for idleKey, (_, client, returned) in self._idle.items():
+            if now - returned < self.maxIdle:
+                # Entries are in the order they were returned
+                break
+            del self._idle[idleKey]
+            expired.append(client)
+        self.expired += len(expired)
+        return expired
+
+    def borrow(self, key):
+        """
+        Return an idle, healthy client for key, or None if there is none.
+        The client must be given back with release() (or closed).
+        """
+        toClose = []
+        found = None
+        with self._lock:
+            toClose.extend(self._expire(self.clock()))
+            # Prefer the most recently returned connection
+            for idleKey in reversed(self._idle.keys()):
+                if idleKey[0] != key:
+                    continue
+                _, client, _ = self._idle.pop(idleKey)
+                if self.isHealthy(client):
+                    found = client
+                    self.reused += 1
+                    break
+                self.broken += 1
+                toClose.append(client)
+        for client in toClose:
+            client.close()
+        return found
+
+    def release(self, key, client):
+        "Give a client back to the pool, for reuse by later connectors"
+        if not self.isHealthy(client):
+            client.close()
+            return
+        toClose = []
+        with self._lock:
+            now = self.clock()
+            toClose.extend(self._expire(now))
+            self._idle[(key, id(client))] = (key, client, now)
+            self.released += 1
+            while len(self._idle) > self.maxSize:
+                _, (_, oldClient, _) = self._idle.popitem(last=False)
+                toClose.append(oldClient)
+                self.evicted += 1
+        for oldClient in toClose:
+            oldClient.close()
+
+    def clear(self):
+        "Close all idle connections"
+        with self._lock:
+            clients = [ x[1] for x in self._idle.values() ]
+            self._idle.clear()
+        for client in clients:
+            client.close()
+
+    def getStats(self):
+        return dict(idle=len(self._idle), reused=self.reused,
+            released=self.released, expired=self.expired,
+            evicted=self.evicted, broken=self.broken)
+
+# Shared by all the connectors in this worker that opt into pooling
+transportPool = TransportPool()
+
+
 class SshConnector(object):
 
     """
@@ -50,19 +315,51 @@ class SshConnector(object):
         sconn.getFile(remote,local) # or putFile(local,remote)
         sconn.close()
 
+    With pool=transportPool, an idle connection to the same system with the
+    same credentials is reused if there is one, and close() returns the
+    connection to the pool instead of closing it.
+
     This module does not check known_hosts (or add machienes to known hosts)
     because it assumes machines will be frequently reprovisioned.
     """
+    ConnectTimeout = 10
+    # Size of the pipelined writes when resuming uploads, and of command
+    # output reads
+    BlockSize = 32768
+    # Minimum delay between progress reports from execStream
+    ProgressInterval = 5
+
+    # Kinds of items yielded by execStream
+    STDOUT = 'stdout'
+    STDERR = 'stderr'
+    STATUS = 'status'
+    # Operations for runConcurrently
+    EXEC = 'exec'
+    PUT = 'put'
+    GET = 'get'
+    # Most servers limit the number of channels (sessions) per connection to
+    # 10; SFTP sessions count as well
+    MaxChannels = 8
+    # Attempts at resuming an interrupted upload in putFileResumable
+    ResumeRetries = 3
 
     def __init__(self, host=None, port=22, user='root', password='password', 
                  key=None, status=None, clientClass=paramiko.SSHClient, 
-                 sftpClass=paramiko.SFTPClient):
+                 sftpClass=paramiko.SFTPClient, pool=None, client=None,
+                 socketFactory=None):
        ''' 
        Represents one attempt to connect to a system.
        Password is only used if sshKey is not provided or sshKey is locked
        in which case it acts as a password unlock key.
 
        Alternative ssh client classes can be passed in for testing.
+       An already authenticated client can be passed in, in which case
+       no new connection is made.
+
+       socketFactory(host, port, timeout) returns the (sock, family) to
+       connect over; it defaults to racing IPv6 and IPv4 for the stock
+       paramiko client, while an alternative client class connects on its
+       own unless one is given.
        '''
        self.host        = host
        self.port        = port
@@ -71,15 +368,39 @@ class SshConnector(object):
        self.key         = key
        self.clientClass = clientClass
        self.sftpClass   = sftpClass
+       if socketFactory is None and clientClass is paramiko.SSHClient:
+           socketFactory = _connectDualStack
+       self.socketFactory = socketFactory
        self._status    = status 
+       self.pool        = pool
        if self.user is None:
            self.user = 'root'
-       self.client      = self._genClient()
+       self.client      = client
+       self._sftpSession = None
+       if self.pool is not None:
+           self.poolKey = self.pool.makeKey(self.host, self.port, self.user,
+               self.password, self.key)
+       if self.pool is not None and self.client is None:
+           self.client = self.pool.borrow(self.poolKey)
+           if self.client is not None:
+               self.status(C.MSG_GENERIC, 'reusing SSH connection')
+       if self.client is None:
+           self.client  = self._genClient()
       
     def status(self, code, msg):
        if self._status:
            self._status(code, msg)
 
+    def _connectSocket(self):
+       '''
+       Connect to the system over whichever of IPv6 and IPv4 answers first
+       '''
+       sock, family = self.socketFactory(self.host, self.port,
+           timeout=self.ConnectTimeout)
+       self.status(C.MSG_GENERIC, 'connected to %s:%s over %s' % (
+           self.host, self.port, nodeinfo.family_name(family)))
+       return sock
+
     def _genClient(self):
        '''
        Get a SSHClient handle, allows auth by key or username/password
@@ -97,14 +418,12 @@ class SshConnector(object):
 
        # might want an 'ignore' policy that doesn't chirp to stderr later
        client.set_missing_host_key_policy(paramiko.WarningPolicy())
+       connectArgs = {}
+       if self.socketFactory is not None:
+           connectArgs['sock'] = self._connectSocket()
        if self.key and self.key != '':
 
-           key_obj = PrivateKey(self.key)
-           self.key = None
-           try:
-               self.key = paramiko.DSSKey.from_private_key(file_obj=key_obj, password=self.password)
-           except paramiko.SSHException: 
-               self.key = paramiko.RSAKey.from_private_key(file_obj=key_obj, password=self.password)
+           self.key = loadPrivateKey(self.key, self.password)
 
            # try the ssh key, password protected keys are ok
            try:
@@ -116,7 +435,8 @@ class SshConnector(object):
                    password=self.password,
                    look_for_keys=False,
                    pkey=self.key,
-                   allow_agent=False
+                   allow_agent=False,
+                   **connectArgs
                ) 
            except paramiko.PasswordRequiredException:
                # this won't retry the unlock password as your username/password
@@ -130,43 +450,516 @@ class SshConnector(object):
                username=self.user,
                password=self.password, 
                allow_agent=False, 
-               look_for_keys=False
+               look_for_keys=False,
+               **connectArgs
            )
        self.status(C.MSG_GENERIC, 'connection established')
        return client
 
     def close(self):
-        '''SSH disconnect'''
-        self.client.close()
+        '''SSH disconnect, or return the connection to the pool'''
+        self._closeSftp()
+        if self.pool is not None:
+            self.pool.release(self.poolKey, self.client)
+        else:
+            self.client.close()
 
-    def execCommand(self, cmd):
+    def execCommand(self, cmd, timeout=None, progress=False):
         '''Runs a non-interactive command and returns both the exit code & output'''
-        cmd = cmd + "; echo $?"
-        sin, sout, serr = self.client.exec_command(cmd)
-        results = sout.read()
-        lines = results.split("\n")
-        status = int(lines[-2])
-        results = results[0:-2].strip()
-        return (status, results)
+        output = []
+        status = None
+        for kind, data in self.execStream(cmd, timeout=timeout,
+                progress=progress):
+            if kind == self.STDOUT:
+                output.append(data)
+            elif kind == self.STATUS:
+                status = data
+        return (status, ''.join(output).strip())
+
+    def execStream(self, cmd, timeout=None, progress=False):
+        '''
+        Runs a non-interactive command, and yields (kind, data) tuples: the
+        STDOUT and STDERR output as it arrives, and finally the STATUS with
+        the exit code.
+        Raises CommandTimeout if the command does not complete within
+        timeout seconds. If progress is set, the latest line of output is
+        reported as MSG_PROGRESS at most every ProgressInterval seconds.
+        '''
+        if timeout:
+            deadline = time.time() + timeout
+        else:
+            deadline = None
+        lastReport = time.time()
+        lastLine = None
+        chan = self.client.get_transport().open_session()
+        try:
+            chan.exec_command(cmd)
+            while True:
+                while chan.recv_ready():
+                    data = chan.recv(self.BlockSize)
+                    if progress:
+                        lastLine = self._lastLine(data) or lastLine
+                    yield self.STDOUT, data
+                while chan.recv_stderr_ready():
+                    data = chan.recv_stderr(self.BlockSize)
+                    if progress:
+                        lastLine = self._lastLine(data) or lastLine
+                    yield self.STDERR, data
+                if progress and lastLine and (
+                        time.time() - lastReport >= self.ProgressInterval):
+                    self.status(C.MSG_PROGRESS, lastLine)
+                    lastLine = None
+                    lastReport = time.time()
+                # The exit status is sent after all the output
+                if chan.exit_status_ready() and not (chan.recv_ready() or
+                        chan.recv_stderr_ready()):
+                    break
+                wait = 1
+                if deadline is not None:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        raise CommandTimeout("Command timed out after %s "
+                            "seconds" % timeout)
+                select.select([ chan ], [], [], wait)
+            yield self.STATUS, chan.recv_exit_status()
+        finally:
+            chan.close()
+
+    @classmethod
+    def _lastLine(cls, data):
+        lines = [ x.strip() for x in data.splitlines() if x.strip() ]
+        if lines:
+            return lines[-1]
+        return None
+
+    def runConcurrently(self, operations, maxChannels=None, timeout=None):
+        '''
+        Run operations concurrently over this connection, each on its own
+        channel, with at most maxChannels in use at once (including the SFTP
+        session of this connector, if open). operations are
+        (EXEC, command), (PUT, localFile, remoteFile) or (GET, remoteFile,
+        localFile) tuples.
+        Returns the results in the same order: (status, output) for
+        commands, None for transfers, or the exception an operation failed
+        with.
+        '''
+        operations = list(operations)
+        results = [ None ] * len(operations)
+        pending = collections.deque(enumerate(operations))
+        lock = threading.Lock()
+
+        def worker():
+            # Transfers from this thread share one SFTP session. A thread
+            # only uses one channel at a time, so the session is closed
+            # before running a command.
+            sftp = None
+            try:
+                while True:
+                    with lock:
+                        if not pending:
+                            return
+                        idx, op = pending.popleft()
+                    try:
+                        if op[0] == self.EXEC:
+                            if sftp is not None:
+                                sftp.close()
+                                sftp = None
+                            results[idx] = self.execCommand(op[1],
+                                timeout=timeout)
+                            continue
+                        if op[0] not in (self.PUT, self.GET):
+                            raise ValueError("Unknown operation %r" % (op[0],))
+                        if sftp is None:
+                            sftp = self.sftpClass.from_transport(
+                                self.client.get_transport())
+                        if op[0] == self.PUT:
+                            sftp.put(op[1], op[2])
+                        else:
+                            sftp.get(op[1], op[2])
+                    except Exception, e:
+                        results[idx] = e
+            finally:
+                if sftp is not None:
+                    sftp.close()
+
+        maxChannels = maxChannels or self.MaxChannels
+        if self._sftpSession is not None:
+            maxChannels -= 1
+        threads = [ threading.Thread(target=worker) for _ in
+            range(min(max(maxChannels, 1), len(operations))) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
 
     def _sftp(self):
-        '''Create a SFTP connection'''
-        return self.sftpClass.from_transport(self.client.get_transport())
+        '''Return the SFTP session, opening it first if needed'''
+        if (self._sftpSession is not None and
+                self._sftpSession.get_channel().closed):
+            self._closeSftp()
+        if self._sftpSession is None:
+            self._sftpSession = self.sftpClass.from_transport(
+                self.client.get_transport())
+        return self._sftpSession
+
+    def _closeSftp(self):
+        sftp, self._sftpSession = self._sftpSession, None
+        if sftp is None:
+            return
+        try:
+            sftp.close()
+        except (EOFError, socket.error, paramiko.SSHException):
+            pass
+
+    def _callSftp(self, func, *args):
+        '''
+        Call func(sftp, *args) with the SFTP session. If the session failed,
+        it is reopened and func is called again, so func must be idempotent.
+        '''
+        try:
+            return func(self._sftp(), *args)
+        except (EOFError, socket.error, paramiko.SSHException):
+            self._closeSftp()
+        return func(self._sftp(), *args)
 
     def putFile(self, localFile, remoteFile):
         '''place a file on the remote system'''
-        sftp = self._sftp()
-        sftp.put(localFile, remoteFile)
-        sftp.close()
+        self._callSftp(lambda sftp: sftp.put(localFile, remoteFile,
+            confirm=True))
+
+    def putFiles(self, files, skipUnchanged=False):
+        '''
+        place several (localFile, remoteFile) files on the remote system.
+        With skipUnchanged, files already present with the same contents
+        are not transferred again.
+        '''
+        for localFile, remoteFile in files:
+            if skipUnchanged:
+                self.putFileIfChanged(localFile, remoteFile)
+            else:
+                self.putFile(localFile, remoteFile)
+
+    @classmethod
+    def _append(cls, sftp, localFile, remoteFile, offset):
+        '''
+        Append the rest of localFile, starting at offset, to remoteFile.
+        Like SFTPClient.putfo, writes are pipelined; errors are reported
+        when the remote file is closed.
+        '''
+        fl = open(localFile, 'rb')
+        try:
+            fl.seek(offset)
+            fr = sftp.open(remoteFile, 'ab')
+            try:
+                fr.set_pipelined(True)
+                while True:
+                    data = fl.read(cls.BlockSize)
+                    if not data:
+                        break
+                    fr.write(data)
+            finally:
+                fr.close()
+        finally:
+            fl.close()
+
+    def putFileIfChanged(self, localFile, remoteFile, resumable=False):
+        '''
+        place a file on the remote system, unless an identical copy is
+        already there. Returns True if the file was uploaded.
+        '''
+        size, digest = localDigests.get(localFile)
+        if self.remoteDigest(remoteFile, size) == digest:
+            return False
+        if resumable:
+            self.putFileResumable(localFile, remoteFile)
+        else:
+            self.putFile(localFile, remoteFile)
+        return True
+
+    def remoteDigest(self, remoteFile, size=None):
+        '''
+        Return the SHA-1 digest of a remote file, or None if it does not
+        exist (or, if size is given, has a different size)
+        '''
+        path = pipes.quote(remoteFile)
+        if size is None:
+            cmd = 'sha1sum %s' % path
+        else:
+            # Only checksum the file if the size matches
+            cmd = 'test "$(stat -c %%s %s 2>/dev/null)" = %d && sha1sum %s' % (
+                path, size, path)
+        status, output = self.execCommand(cmd)
+        if status != 0 or not output:
+            return None
+        return output.split()[0]
+
+    def putFileResumable(self, localFile, remoteFile):
+        '''
+        place a large file on the remote system, resuming where the upload
+        left off if the SFTP session fails. The data goes to remoteFile.part
+        first, which is verified and renamed once complete. A remoteFile.part
+        left over by the upload of other contents is discarded.
+        '''
+        size, digest = localDigests.get(localFile)
+        partFile = remoteFile + '.part'
+        for _ in range(2):
+            resumed = self._putPart(localFile, partFile, size)
+            if not resumed or self.remoteDigest(partFile, size) == digest:
+                break
+            self.status(C.MSG_GENERIC, 'discarding stale %s' % partFile)
+            try:
+                self.unlink(partFile)
+            except IOError:
+                pass
+        else:
+            raise IOError("Resumed upload of %s to %s is corrupted" %
+                (localFile, remoteFile))
+        # Not retried, renaming is not idempotent
+        self._rename(self._sftp(), partFile, remoteFile)
+
+    def _putPart(self, localFile, partFile, size):
+        '''
+        Upload localFile to partFile, resuming after session failures.
+        Returns True if data already in partFile was kept.
+        '''
+        attempt = 0
+        while True:
+            try:
+                return self._putChunks(self._sftp(), localFile, partFile,
+                    size)
+            except (EOFError, socket.error, paramiko.SSHException):
+                self._closeSftp()
+                attempt += 1
+                if attempt > self.ResumeRetries:
+                    raise
+
+    @classmethod
+    def _putChunks(cls, sftp, localFile, partFile, size):
+        '''
+        Upload the part of localFile that is not in partFile yet. Returns
+        True if an earlier upload was resumed.
+        '''
+        try:
+            offset = sftp.stat(partFile).st_size
+        except IOError:
+            offset = 0
+        if offset > size:
+            offset = 0
+        if offset:
+            cls._append(sftp, localFile, partFile, offset)
+        else:
+            sftp.put(localFile, partFile, confirm=True)
+        return offset > 0
+
+    @classmethod
+    def _rename(cls, sftp, oldPath, newPath):
+        if hasattr(sftp, 'posix_rename'):
+            sftp.posix_rename(oldPath, newPath)
+            return
+        # Plain SFTP renames fail if the target exists
+        try:
+            sftp.unlink(newPath)
+        except IOError:
+            pass
+        sftp.rename(oldPath, newPath)
 
     def getFile(self, remoteFile, localFile):
         '''download a remote file'''
-        sftp = self._sftp()
-        sftp.get(remoteFile, localFile)
-        sftp.close()
+        self._callSftp(lambda sftp: sftp.get(remoteFile, localFile))
 
     def unlink(self, remoteFile):
         '''delete a remote file'''
-        sftp = self._sftp()
-        sftp.unlink(remoteFile)
-        sftp.close()
+        # Not retried, a second attempt would fail if the first one went
+        # through
+        self._sftp().unlink(remoteFile)
+
+    def unlinkFiles(self, remoteFiles):
+        '''delete several remote files'''
+        for remoteFile in remoteFiles:
+            self.unlink(remoteFile)
+
+
+class TransportClient(object):
+    """
+    Minimal stand-in for paramiko.SSHClient, around a transport that is
+    already authenticated.
+    """
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def get_transport(self):
+        return self._transport
+
+    def close(self):
+        self._transport.close()
+
+
+class _Race(object):
+    "State of one CredentialRacer.connect() call, shared with its threads"
+
+    def __init__(self, groups):
+        self.cond = threading.Condition()
+        self.queue = collections.deque(groups)
+        self.remaining = len(groups)
+        self.winner = None
+        self.errors = []
+
+    def done(self):
+        return self.winner is not None
+
+
+class CredentialRacer(object):
+    """
+    Find working credentials among a list of them (like the sshAuth list
+    of AssimilatorParams), and return an SshConnector that uses them.
+
+    Credentials for the same user are tried one after the other over a
+    single connection, since SSH allows several authentication attempts per
+    connection; if the server disconnects after too many failures, a new
+    connection is made. Different users are tried in parallel, over at most
+    maxParallel connections. The first credentials to be accepted win, and
+    the other attempts are abandoned. connect() may be called again, for
+    instance after the connection it returned was closed.
+    """
+    MaxParallel = 4
+
+    def __init__(self, host, port=22, sshAuth=None, status=None, pool=None,
+            maxParallel=None, connectTimeout=SshConnector.ConnectTimeout):
+        self.host = host
+        self.port = port
+        self.sshAuth = sshAuth or []
+        self._status = status
+        self.pool = pool
+        self.maxParallel = maxParallel or self.MaxParallel
+        self.connectTimeout = connectTimeout
+
+    def status(self, code, msg):
+        if self._status:
+            self._status(code, msg)
+
+    @classmethod
+    def _credentials(cls, auth):
+        return (auth.get('sshUser') or 'root', auth.get('sshPassword') or None,
+            auth.get('sshKey') or None)
+
+    def connect(self):
+        credentials = [ self._credentials(x) for x in self.sshAuth ]
+        if not credentials:
+            raise paramiko.AuthenticationException("No credentials to try")
+        if self.pool is not None:
+            for cred in credentials:
+                client = self.pool.borrow(self.pool.makeKey(self.host,
+                    self.port, *cred))
+                if client is not None:
+                    self.status(C.MSG_GENERIC, 'reusing SSH connection')
+                    return self._connector(cred, client)
+
+        groups = collections.OrderedDict()
+        for cred in credentials:
+            groups.setdefault(cred[0], []).append(cred)
+        # Attempts of earlier calls that are still running keep their own
+        # state
+        race = _Race(groups.values())
+        # Attempts run in other threads, which do not report status
+        self.status(C.MSG_GENERIC, 'attempting SSH login with %d credentials'
+            % len(credentials))
+        for _ in range(min(self.maxParallel, len(race.queue))):
+            thread = threading.Thread(target=self._worker, args=(race,))
+            thread.setDaemon(True)
+            thread.start()
+
+        with race.cond:
+            while race.winner is None and race.remaining:
+                race.cond.wait()
+            winner = race.winner
+        if winner is None:
+            raise self._failure(race)
+        cred, transport = winner
+        return self._connector(cred, TransportClient(transport))
+
+    def _connector(self, cred, client):
+        user, password, key = cred
+        conn = SshConnector(self.host, self.port, user=user, password=password,
+            key=key, status=self._status, pool=self.pool, client=client)
+        self.status(C.MSG_GENERIC, 'connection established')
+        return conn
+
+    def _failure(self, race):
+        for error in race.errors:
+            if isinstance(error, paramiko.AuthenticationException):
+                return paramiko.AuthenticationException(
+                    "None of the %d credentials were accepted"
+                    % len(self.sshAuth))
+        if not race.errors:
+            return paramiko.SSHException("No credentials could be tried")
+        return race.errors[0]
+
+    def _worker(self, race):
+        while not race.done():
+            with race.cond:
+                if not race.queue:
+                    return
+                group = race.queue.popleft()
+            try:
+                self._tryGroup(race, group)
+            finally:
+                with race.cond:
+                    race.remaining -= 1
+                    race.cond.notifyAll()
+
+    def _tryGroup(self, race, group):
+        transport = None
+        try:
+            for cred in group:
+                if race.done():
+                    return
+                if transport is None or not transport.is_active():
+                    if transport is not None:
+                        transport.close()
+                    transport = self._openTransport()
+                try:
+                    self._authenticate(transport, cred)
+                except Exception, e:
+                    # A key that cannot be used is no reason to give up on
+                    # the other credentials
+                    race.errors.append(e)
+                    continue
+                with race.cond:
+                    if race.winner is None:
+                        race.winner = (cred, transport)
+                        # Handed over to the winner
+                        transport = None
+                        race.cond.notifyAll()
+                return
+        except Exception, e:
+            # Anything left unrecorded would leave connect() without a
+            # reason to report
+            race.errors.append(e)
+        finally:
+            if transport is not None:
+                transport.close()
+
+    def _openTransport(self):
+        sock, family = _connectDualStack(self.host, self.port,
+            timeout=self.connectTimeout)
+        transport = paramiko.Transport(sock)
+        transport.start_client()
+        return transport
+
+    def _authenticate(self, transport, cred):
+        user, password, key = cred
+        if key:
+            pkey = loadPrivateKey(key, password)
+            try:
+                transport.auth_publickey(user, pkey)
+                return
+            except paramiko.AuthenticationException:
+                # Like SSHClient, fall back to the password
+                if not password:
+                    raise
+        if not password:
+            raise paramiko.AuthenticationException(
+                "No key or password for %s" % user)
+        transport.auth_password(user, password)
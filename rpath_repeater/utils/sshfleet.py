@@ -0,0 +1,193 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Run the same SSH operations on many systems concurrently.
+"""
+
+
+import sys
+import Queue
+import socket
+import threading
+
+import paramiko
+
+from rpath_repeater.codes import Codes as C
+from rpath_repeater.utils import ssh
+
+
+class HostResult(object):
+    """
+    Outcome of the operations on one system. code is OK if everything
+    succeeded (and the command exited with status 0), OK_1 if the command
+    exited with another status, ERR_AUTHENTICATION if no credentials were
+    accepted, ERR_NOT_FOUND if the system could not be reached, or
+    ERR_GENERIC.
+    output and errorOutput hold the end of the command's output.
+    """
+    __slots__ = [ 'host', 'port', 'code', 'message', 'status', 'output',
+        'errorOutput', ]
+
+    def __init__(self, host, port, code, message, status=None, output=None,
+            errorOutput=None):
+        self.host = host
+        self.port = port
+        self.code = code
+        self.message = message
+        self.status = status
+        self.output = output
+        self.errorOutput = errorOutput
+
+    def __repr__(self):
+        return "<HostResult %s:%s %s %r>" % (self.host, self.port, self.code,
+            self.message)
+
+
+class _Tail(object):
+    "Keeps the last maxSize bytes written"
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size - len(self.chunks[0]) >= self.maxSize:
+            self.size -= len(self.chunks.pop(0))
+
+    def getvalue(self):
+        return ''.join(self.chunks)[-self.maxSize:]
+
+
+class FleetRunner(object):
+    """
+    Upload putFiles, a list of (localFile, remoteFile), and then run
+    command on every system in hosts, at most concurrency systems at a
+    time. hosts are host names, or (host, port) tuples. The first working
+    credentials from sshAuth (as in AssimilatorParams) are used on each
+    system. With skipUnchanged, files already present on a system with the
+    same contents are not transferred again.
+
+    run() yields a HostResult for every system, as soon as it is done.
+    """
+    Concurrency = 16
+    MaxOutput = 65536
+
+    def __init__(self, hosts, sshAuth, command=None, putFiles=None, port=22,
+            concurrency=None, timeout=None, pool=None, maxOutput=None,
+            skipUnchanged=False):
+        self.hosts = list(hosts)
+        self.sshAuth = sshAuth
+        self.command = command
+        self.putFiles = putFiles or []
+        self.port = port
+        self.concurrency = concurrency or self.Concurrency
+        self.timeout = timeout
+        self.pool = pool
+        self.maxOutput = maxOutput or self.MaxOutput
+        self.skipUnchanged = skipUnchanged
+
+    def run(self):
+        """
+        Yield a HostResult per system, in the order they complete. Closing
+        the generator stops starting new systems.
+        """
+        pending = Queue.Queue()
+        for host in self.hosts:
+            pending.put(host)
+        results = Queue.Queue()
+        stop = threading.Event()
+        for _ in range(min(self.concurrency, len(self.hosts))):
+            thread = threading.Thread(target=self._worker,
+                args=(pending, results, stop))
+            thread.setDaemon(True)
+            thread.start()
+        try:
+            for _ in xrange(len(self.hosts)):
+                yield results.get()
+        finally:
+            stop.set()
+
+    def _worker(self, pending, results, stop):
+        while not stop.isSet():
+            try:
+                host = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = self._runHost(host)
+            except:
+                # run() waits for a result from every system, so one must be
+                # put no matter what
+                hostName, port = self._hostPort(host)
+                result = HostResult(hostName, port, C.ERR_GENERIC,
+                    "Error: %s" % sys.exc_info()[1])
+            results.put(result)
+
+    def _hostPort(self, host):
+        if isinstance(host, tuple):
+            return host
+        return host, self.port
+
+    def _runHost(self, host):
+        host, port = self._hostPort(host)
+        try:
+            conn = ssh.CredentialRacer(host, port, self.sshAuth,
+                pool=self.pool).connect()
+        except paramiko.AuthenticationException, e:
+            return HostResult(host, port, C.ERR_AUTHENTICATION, str(e))
+        except socket.error, e:
+            return HostResult(host, port, C.ERR_NOT_FOUND,
+                "Unable to connect: %s" % e)
+        except Exception, e:
+            return HostResult(host, port, C.ERR_GENERIC, "Error: %s" % e)
+        try:
+            try:
+                if self.putFiles:
+                    conn.putFiles(self.putFiles,
+                        skipUnchanged=self.skipUnchanged)
+                if self.command is None:
+                    return HostResult(host, port, C.OK,
+                        "Transferred %d files" % len(self.putFiles))
+                return self._exec(conn, host, port)
+            except ssh.CommandTimeout, e:
+                return HostResult(host, port, C.ERR_GENERIC, str(e))
+            except Exception, e:
+                return HostResult(host, port, C.ERR_GENERIC, "Error: %s" % e)
+        finally:
+            conn.close()
+
+    def _exec(self, conn, host, port):
+        output = _Tail(self.maxOutput)
+        errorOutput = _Tail(self.maxOutput)
+        status = None
+        for kind, data in conn.execStream(self.command, timeout=self.timeout):
+            if kind == conn.STDOUT:
+                output.write(data)
+            elif kind == conn.STDERR:
+                errorOutput.write(data)
+            else:
+                status = data
+        if status == 0:
+            code, message = C.OK, "Command succeeded"
+        else:
+            code, message = C.OK_1, "Command exited with status %s" % status
+        return HostResult(host, port, code, message, status=status,
+            output=output.getvalue(), errorOutput=errorOutput.getvalue())
@@ -0,0 +1,143 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Limit the number of concurrent operations, globally and per key, with a
+bounded wait queue.
+"""
+
+
+import collections
+
+from twisted.internet import defer
+
+
+class ThrottleFull(Exception):
+    "The wait queue is full, the operation was shed"
+
+
+class RequestThrottle(object):
+    """
+    Grants at most maxInFlight concurrent slots, and at most
+    maxInFlightPerKey for any single key. Requests that cannot be granted
+    right away wait in a FIFO queue of at most maxQueued entries; once the
+    queue is full, acquire() fails immediately with ThrottleFull.
+
+    A limit of None (or 0) means unlimited.
+    """
+
+    def __init__(self, maxInFlight=None, maxInFlightPerKey=None,
+            maxQueued=None):
+        self.maxInFlight = maxInFlight
+        self.maxInFlightPerKey = maxInFlightPerKey
+        self.maxQueued = maxQueued
+        self.inFlight = 0
+        self.inFlightByKey = {}
+        self.queue = collections.deque()
+        # Counters
+        self.granted = 0
+        self.waited = 0
+        self.shed = 0
+        self.maxQueueDepth = 0
+
+    def _hasCapacity(self, key):
+        if self.maxInFlight and self.inFlight >= self.maxInFlight:
+            return False
+        if (self.maxInFlightPerKey and
+                self.inFlightByKey.get(key, 0) >= self.maxInFlightPerKey):
+            return False
+        return True
+
+    def _grant(self, key):
+        self.inFlight += 1
+        self.inFlightByKey[key] = self.inFlightByKey.get(key, 0) + 1
+        self.granted += 1
+
+    def acquire(self, key=None):
+        """
+        Return a deferred that fires when a slot is available for key.
+        The caller must call release(key) when done.
+        """
+        # Anything still queued is waiting on a limit that also applies here,
+        # so checking capacity is enough to keep waiters in FIFO order
+        if self._hasCapacity(key):
+            self._grant(key)
+            return defer.succeed(key)
+        if self.maxQueued and len(self.queue) >= self.maxQueued:
+            self.shed += 1
+            return defer.fail(ThrottleFull())
+        d = defer.Deferred()
+        self.queue.append((key, d))
+        self.waited += 1
+        self.maxQueueDepth = max(self.maxQueueDepth, len(self.queue))
+        return d
+
+    def release(self, key=None):
+        self.inFlight -= 1
+        count = self.inFlightByKey[key] - 1
+        if count:
+            self.inFlightByKey[key] = count
+        else:
+            del self.inFlightByKey[key]
+        self._pump()
+
+    def _pump(self):
+        # Grant slots to the oldest waiters whose key has capacity. Waiters
+        # for a key that is at its limit do not block other keys.
+        if not self.queue:
+            return
+        ready = []
+        remaining = collections.deque()
+        while self.queue:
+            key, d = self.queue.popleft()
+            if self._hasCapacity(key):
+                self._grant(key)
+                ready.append((key, d))
+            else:
+                remaining.append((key, d))
+                if self.maxInFlight and self.inFlight >= self.maxInFlight:
+                    break
+        remaining.extend(self.queue)
+        self.queue = remaining
+        for key, d in ready:
+            d.callback(key)
+
+    def run(self, key, func, *args, **kwargs):
+        """
+        Call func once a slot is granted for key, and release the slot when
+        the deferred it returns fires.
+        """
+        d = self.acquire(key)
+        def _run(_):
+            d2 = defer.maybeDeferred(func, *args, **kwargs)
+            def _release(result):
+                self.release(key)
+                return result
+            d2.addBoth(_release)
+            return d2
+        d.addCallback(_run)
+        return d
+
+    def getStats(self):
+        return dict(
+            inFlight=self.inFlight,
+            queueDepth=len(self.queue),
+            maxQueueDepth=self.maxQueueDepth,
+            granted=self.granted,
+            waited=self.waited,
+            shed=self.shed,
+        )
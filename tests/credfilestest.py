@@ -0,0 +1,75 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import testsuite
+testsuite.setup()
+
+import os
+import shutil
+import stat
+import tempfile
+
+from testrunner import testcase
+
+from rpath_repeater.utils import credfiles
+
+class CredentialFileCacheTest(testcase.TestCase):
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.workDir = tempfile.mkdtemp()
+        self.cache = credfiles.CredentialFileCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+        testcase.TestCase.tearDown(self)
+
+    def testShared(self):
+        f1 = self.cache.acquire('cert', prefix='cert-', dir=self.workDir)
+        f2 = self.cache.acquire('cert', prefix='cert-', dir=self.workDir)
+        f3 = self.cache.acquire('key', prefix='key-', dir=self.workDir)
+        self.failUnlessEqual(f1.name, f2.name)
+        self.failIfEqual(f1.name, f3.name)
+        self.failUnlessEqual(file(f1.name).read(), 'cert')
+        self.failUnlessEqual(file(f3.name).read(), 'key')
+        self.failUnless(os.path.basename(f1.name).startswith('cert-'))
+        self.failUnlessEqual(stat.S_IMODE(os.stat(f1.name).st_mode), 0600)
+        self.failUnlessEqual(self.cache.getStats(),
+            dict(size=2, hits=1, misses=2, refs=3))
+
+    def testRelease(self):
+        f1 = self.cache.acquire('cert', dir=self.workDir)
+        f2 = self.cache.acquire('cert', dir=self.workDir)
+        f1.close()
+        # Closing twice does not drop another reference
+        f1.close()
+        self.failUnless(os.path.exists(f2.name))
+        f2.close()
+        self.failIf(os.path.exists(f2.name))
+        self.failUnlessEqual(len(self.cache), 0)
+        self.failUnlessEqual(os.listdir(self.workDir), [])
+
+    def testRecreate(self):
+        f1 = self.cache.acquire('cert', dir=self.workDir)
+        os.unlink(f1.name)
+        f2 = self.cache.acquire('cert', dir=self.workDir)
+        self.failUnlessEqual(file(f2.name).read(), 'cert')
+        f1.close()
+        self.failUnless(os.path.exists(f2.name))
+        f2.close()
+        self.failUnlessEqual(os.listdir(self.workDir), [])
+
+testsuite.main()
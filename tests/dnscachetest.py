@@ -0,0 +1,100 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import testsuite
+testsuite.setup()
+
+import socket
+
+from testrunner import testcase
+
+from rpath_repeater.utils import dnscache
+
+class DnsCacheTest(testcase.TestCase):
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.now = 1000.0
+        self.queries = []
+        self.cache = dnscache.DnsCache(positive_ttl=60, negative_ttl=10,
+            clock=lambda: self.now, getaddrinfo=self._getaddrinfo)
+
+    def _getaddrinfo(self, host, port, family, socktype):
+        self.queries.append(host)
+        if host == 'missing.example.com':
+            raise socket.gaierror(socket.EAI_NONAME, 'Name not known')
+        if host == 'flaky.example.com':
+            raise socket.gaierror(socket.EAI_AGAIN, 'Try again')
+        return [
+            (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('fd00::1', 0, 0, 0)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', 0)),
+        ]
+
+    def testPositive(self):
+        addresses = [ (socket.AF_INET6, ('fd00::1', 0, 0, 0)),
+            (socket.AF_INET, ('10.0.0.1', 0)), ]
+        self.failUnlessEqual(self.cache.lookup('host.example.com'),
+            addresses)
+        self.failUnlessEqual(self.cache.getaddrinfo('host.example.com', 22),
+            [ (socket.AF_INET6, ('fd00::1', 22, 0, 0)),
+                (socket.AF_INET, ('10.0.0.1', 22)), ])
+        self.failUnlessEqual(self.queries, [ 'host.example.com' ])
+        self.now += 61
+        self.cache.lookup('host.example.com')
+        self.failUnlessEqual(len(self.queries), 2)
+        stats = self.cache.getStats()
+        self.failUnlessEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def testNegative(self):
+        for _ in range(2):
+            self.failUnlessRaises(socket.gaierror,
+                self.cache.lookup, 'missing.example.com')
+        self.failUnlessEqual(len(self.queries), 1)
+        self.now += 11
+        self.failUnlessRaises(socket.gaierror,
+            self.cache.lookup, 'missing.example.com')
+        self.failUnlessEqual(len(self.queries), 2)
+        # Temporary failures are not cached
+        for _ in range(2):
+            self.failUnlessRaises(socket.gaierror,
+                self.cache.lookup, 'flaky.example.com')
+        self.failUnlessEqual(len(self.queries), 4)
+
+    def testLiterals(self):
+        self.failUnlessEqual(self.cache.lookup('10.1.2.3'),
+            [ (socket.AF_INET, ('10.1.2.3', 0)) ])
+        self.failUnlessEqual(self.cache.lookup('::1'),
+            [ (socket.AF_INET6, ('::1', 0, 0, 0)) ])
+        self.failUnlessEqual(self.queries, [])
+
+    def testInvalidate(self):
+        self.cache.lookup('host.example.com')
+        self.cache.invalidate('host.example.com')
+        self.cache.lookup('host.example.com')
+        self.failUnlessEqual(len(self.queries), 2)
+
+    def testNonBlocking(self):
+        self.failUnlessEqual(self.cache.lookup('host.example.com',
+            block=False), None)
+        self.failUnlessEqual(self.cache.getaddrinfo('10.1.2.3', 22,
+            block=False), [ (socket.AF_INET, ('10.1.2.3', 22)) ])
+        self.failUnlessEqual(self.queries, [])
+        self.cache.lookup('host.example.com')
+        self.failUnlessEqual(len(self.cache.lookup('host.example.com',
+            block=False)), 2)
+        self.failUnlessEqual(self.queries, [ 'host.example.com' ])
+
+testsuite.main()
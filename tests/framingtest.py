@@ -0,0 +1,97 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from rpath_repeater.utils import framing
+
+class FramingTest(testcase.TestCase):
+    headers = {
+        'Content-Type' : ['application/xml'],
+        'X-Multi' : ['a', 'b'],
+    }
+
+    def testRequestRoundTrip(self):
+        body = ''.join(chr(x) for x in range(256)) * 4
+        data = framing.encodeRequest('PUT', '/api/v1/systems', self.headers,
+            body)
+        self.failUnless(framing.isFramed(data))
+        self.failUnlessEqual(framing.decodeRequest(data), dict(
+            method='PUT', url='/api/v1/systems', headers=self.headers,
+            body=body))
+
+    def testReplyRoundTrip(self):
+        data = framing.encodeReply(404, 'Not Found', self.headers, '')
+        self.failUnlessEqual(framing.decodeReply(data), dict(
+            status=404, message='Not Found', headers=self.headers, body=''))
+
+    def testSingleValuedHeaders(self):
+        data = framing.encodeReply(200, None, {'Host' : 'localhost'}, None)
+        self.failUnlessEqual(framing.decodeReply(data), dict(
+            status=200, message='', headers={'Host' : ['localhost']},
+            body=''))
+
+    def testBadFrames(self):
+        data = framing.encodeRequest('GET', '/', {}, 'abc')
+        self.failIf(framing.isFramed('(dp0\n'))
+        self.failUnlessRaises(framing.FramingError,
+            framing.decodeReply, data)
+        self.failUnlessRaises(framing.FramingError,
+            framing.decodeRequest, data[:-1])
+        self.failUnlessRaises(framing.FramingError,
+            framing.decodeRequest, data[:12])
+        data = data[:3] + chr(framing.VERSION + 1) + data[4:]
+        self.failUnlessRaises(framing.FramingError,
+            framing.decodeRequest, data)
+
+    def testOversized(self):
+        # Fields that do not fit in their length field
+        self.failUnlessRaises(framing.FramingError, framing.encodeRequest,
+            'X' * 256, '/', {}, '')
+        framing.encodeRequest('X' * 255, '/', {}, '')
+        self.failUnlessRaises(framing.FramingError, framing.encodeReply,
+            200, 'OK' * 40000, {}, '')
+        self.failUnlessRaises(framing.FramingError, framing.encodeReply,
+            70000, 'OK', {}, '')
+        self.failUnlessRaises(framing.FramingError, framing.encodeReply,
+            -1, 'OK', {}, '')
+        self.failUnlessRaises(framing.FramingError, framing.encodeRequest,
+            'GET', '/', { 'X' * 70000 : 'a' }, '')
+        self.failUnlessRaises(framing.FramingError, framing.encodeReply,
+            200, 'OK', { 'X-Multi' : [ 'a' ] * 70000 }, '')
+        self.failUnlessRaises(framing.FramingError, framing.encodeRequest,
+            'GET', '/', dict(('X-%d' % i, 'a') for i in range(70000)), '')
+        self.failUnlessRaises(framing.FramingError, framing.encodeBatch,
+            [ 'frame' ] * 70000)
+
+    def testBatch(self):
+        frames = [
+            framing.encodeRequest('GET', '/a', {}, ''),
+            framing.encodeRequest('PUT', '/b', self.headers, 'body'),
+        ]
+        data = framing.encodeBatch(frames)
+        self.failUnless(framing.isBatch(data))
+        self.failIf(framing.isBatch(frames[0]))
+        self.failUnlessEqual(framing.decodeBatch(data), frames)
+        self.failUnlessEqual(framing.decodeBatch(framing.encodeBatch([])), [])
+        self.failUnlessRaises(framing.FramingError,
+            framing.decodeBatch, data[:-1])
+
+testsuite.main()
@@ -52,4 +52,110 @@ class ModelsTest(TestBase):
         self.assertEquals(xml,
             '<scriptOutput><stdout><![CDATA[ <blah/>\n]]></stdout><stderr>some data</stderr></scriptOutput>')
 
+    def testCompiledSerializer(self):
+        self.failUnless(models.ImageFile.toXmlDom.compiled)
+        objects = [
+            models.ImageFile(title=u"t\xe9", size=10L, sha1=" <a/> ",
+                file_name=True, url=1.5, destination=object()),
+            models.Trove(name='n', flavor='',
+                version=models.Version(full='/a@b:c/1-1-1', ordering=1.5)),
+            models.ScriptOutput(returnCode=0, stdout='<x>', stderr='a < b'),
+            models.Target(),
+        ]
+        for obj in objects:
+            self.failUnlessEqual(obj.toXml(), models.XML.toString(
+                models._Serializable.toXmlDom(obj)))
+        self.failUnlessEqual(objects[0].toXml(),
+            '<file><title>t\xc3\xa9</title><size>10</size><sha1><![CDATA[ <a/> ]]></sha1><file_name>True</file_name><url>1.5</url></file>')
+
+    def testOwnSerializer(self):
+        class Custom(models._BaseSlotCompare, models._Serializable):
+            __slots__ = [ 'a', ]
+            _tag = 'custom'
+            def toXmlDom(self, tag=None):
+                return models.XML.Element(self._tag, a=self.a)
+        class SubCustom(Custom):
+            pass
+        class SubTrove(models.Trove):
+            __slots__ = [ 'extra', ]
+        self.failUnlessEqual(SubCustom(a=1).toXml(), '<custom a="1"/>')
+        self.failUnlessEqual(SubTrove(extra='e').toXml(),
+            '<trove><extra>e</extra></trove>')
+
+    def testDictRoundTrip(self):
+        creds = [ models.TargetUserCredentials(rbUser='u%d' % i, rbUserId=i,
+            credentials=dict(password='p')) for i in range(2) ]
+        args = models.TargetCommandArguments(jobUrl='http://localhost/job',
+            targetConfiguration=models.TargetConfiguration(targetType='ec2'),
+            targetUserCredentials=creds[0], targetAllUserCredentials=creds,
+            args=dict(params=[1, 2]))
+        data = args.toDict()
+        # Lists are passed through as they are, models included
+        allCreds = data.pop('targetAllUserCredentials')
+        self.failUnless(allCreds is creds)
+        self.failUnlessEqual(data, {
+            'jobUrl' : 'http://localhost/job',
+            'targetConfiguration' : { 'targetType' : 'ec2', },
+            'targetUserCredentials' : { 'rbUser' : 'u0', 'rbUserId' : 0,
+                'credentials' : { 'password' : 'p', }, },
+            'args' : { 'params' : [1, 2], },
+        })
+        data['targetAllUserCredentials'] = allCreds
+        self.failUnlessEqual(models._BaseSlotCompare.toDict(args), data)
+        # Lists of models and lists of dictionaries both come back as models
+        dictCreds = [ x.toDict() for x in creds ]
+        for value in [ creds, dictCreds ]:
+            data['targetAllUserCredentials'] = value
+            fromDicts = [ models.TargetCommandArguments.fromDict,
+                models._BaseSlotCompare.fromDict.im_func.__get__(
+                    models.TargetCommandArguments) ]
+            for fromDict in fromDicts:
+                obj = fromDict(data)
+                self.failUnless(isinstance(obj.targetConfiguration,
+                    models.TargetConfiguration))
+                self.failUnlessEqual([ x.rbUser
+                        for x in obj.targetAllUserCredentials ], ['u0', 'u1'])
+                self.failUnless(isinstance(obj.targetAllUserCredentials[1],
+                    models.TargetUserCredentials))
+                self.failUnlessEqual(obj.authToken, None)
+                objData = obj.toDict()
+                self.failUnlessEqual([ x.toDict()
+                        for x in objData.pop('targetAllUserCredentials') ],
+                    dictCreds)
+                self.failUnlessEqual(objData, dict((k, v)
+                    for k, v in data.items()
+                    if k != 'targetAllUserCredentials'))
+
+    def testDictList(self):
+        params = [ models.AssimilatorParams(host='h%d' % i, port=22,
+            sshAuth=[ dict(sshUser='root') ]) for i in range(3) ]
+        data = models.AssimilatorParams.toDictList(params)
+        self.failUnlessEqual(data, [ x.toDict() for x in params ])
+        objs = models.AssimilatorParams.fromDictList(data)
+        self.failUnlessEqual([ x.host for x in objs ], ['h0', 'h1', 'h2'])
+        self.failUnlessEqual([ x.sshAuth for x in objs ],
+            [ [ dict(sshUser='root') ] ] * 3)
+
+    def testFromDictInheritedSlots(self):
+        class SubParams(models.WmiParams):
+            __slots__ = [ 'extra', ]
+        obj = SubParams.fromDict(dict(extra='e', host='h'))
+        self.failUnlessEqual(obj.extra, 'e')
+        for slot in models.WmiParams.__slots__:
+            self.failUnlessEqual(getattr(obj, slot), None)
+
+    def testFromImmutableDict(self):
+        from rpath_repeater.utils.immutabledict import ImmutableDict
+        data = dict(jobUrl='http://localhost/job',
+            targetConfiguration=ImmutableDict(dict(targetType='ec2')))
+        for fromDict in [ models.TargetCommandArguments.fromDict,
+                models._BaseSlotCompare.fromDict.im_func.__get__(
+                    models.TargetCommandArguments) ]:
+            obj = fromDict(ImmutableDict(data))
+            self.failUnlessEqual(obj.jobUrl, 'http://localhost/job')
+            self.failUnlessEqual(obj.targetConfiguration.targetType, 'ec2')
+        objs = models.TargetConfiguration.fromDictList(
+            [ ImmutableDict(dict(targetType='ec2')) ])
+        self.failUnlessEqual(objs[0].targetType, 'ec2')
+
 testsuite.main()
@@ -0,0 +1,335 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import testsuite
+testsuite.setup()
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from OpenSSL import crypto
+from testrunner import testcase
+
+from rpath_repeater.utils import dnscache
+from rpath_repeater.utils import nodeinfo
+
+class ProbeCacheTest(testcase.TestCase):
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.now = 1000.0
+        self.cache = nodeinfo.ProbeCache(positive_ttl=60, negative_ttl=10,
+            max_size=3, clock=lambda: self.now)
+
+    def testTTL(self):
+        error = nodeinfo.ProbeHostError('refused')
+        self.cache.set('a', 22)
+        self.cache.set('b', 22, error)
+        self.failUnlessEqual(self.cache.get('a', 22), (True, None))
+        self.failUnlessEqual(self.cache.get('b', 22), (True, error))
+        self.failUnlessEqual(self.cache.get('a', 5989), (False, None))
+        self.now += 30
+        self.failUnlessEqual(self.cache.get('a', 22), (True, None))
+        self.failUnlessEqual(self.cache.get('b', 22), (False, None))
+        self.now += 30
+        self.failUnlessEqual(self.cache.get('a', 22), (False, None))
+        self.failUnlessEqual(self.cache.getStats(),
+            dict(size=0, hits=3, misses=3))
+
+    def testEviction(self):
+        for host in 'abc':
+            self.cache.set(host, 22)
+        # Touch a, so b is the least recently used
+        self.cache.get('a', 22)
+        self.cache.set('d', 22)
+        self.failUnlessEqual(len(self.cache), 3)
+        self.failUnlessEqual(self.cache.get('b', 22), (False, None))
+        self.failUnlessEqual(self.cache.get('a', 22), (True, None))
+
+    def testInvalidate(self):
+        self.cache.set('a', 22)
+        self.cache.set('a', 5989)
+        self.cache.set('b', 22)
+        self.cache.invalidate('a', 22)
+        self.failUnlessEqual(self.cache.get('a', 22), (False, None))
+        self.failUnlessEqual(self.cache.get('a', 5989), (True, None))
+        self.cache.invalidate('a')
+        self.failUnlessEqual(self.cache.get('a', 5989), (False, None))
+        self.failUnlessEqual(len(self.cache), 1)
+        self.cache.invalidate()
+        self.failUnlessEqual(len(self.cache), 0)
+
+    def testTag(self):
+        error = nodeinfo.ProbeHostError('handshake failed')
+        self.cache.set('a', 5989, error, tag='cert1')
+        self.cache.set('a', 5989, 'certPem', tag='cert2')
+        self.failUnlessEqual(self.cache.get('a', 5989, 'cert1'), (True, error))
+        self.failUnlessEqual(self.cache.get('a', 5989, 'cert2'),
+            (True, 'certPem'))
+        self.failUnlessEqual(self.cache.get('a', 5989), (False, None))
+        self.cache.invalidate('a', 5989)
+        self.failUnlessEqual(len(self.cache), 0)
+
+class SslContextTest(testcase.TestCase):
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.workDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+        testcase.TestCase.tearDown(self)
+
+    def _writePair(self, name, serial):
+        pkey = crypto.PKey()
+        pkey.generate_key(crypto.TYPE_RSA, 1024)
+        cert = crypto.X509()
+        cert.get_subject().CN = name
+        cert.set_serial_number(serial)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(3600)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(pkey)
+        cert.sign(pkey, 'sha256')
+        certFile = os.path.join(self.workDir, name + '.crt')
+        keyFile = os.path.join(self.workDir, name + '.key')
+        file(certFile, 'w').write(
+            crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        file(keyFile, 'w').write(
+            crypto.dump_privatekey(crypto.FILETYPE_PEM, pkey))
+        return certFile, keyFile
+
+    def testContents(self):
+        pair1 = self._writePair('a', 1)
+        pair2 = self._writePair('b', 2)
+        identity1, ctx1 = nodeinfo._ssl_context(*pair1)
+        identity2, ctx2 = nodeinfo._ssl_context(*pair2)
+        self.failIfEqual(identity1, identity2)
+        self.failIf(ctx1 is ctx2)
+        # Same contents under a different name share the context
+        copies = [ os.path.join(self.workDir, x) for x in ('c.crt', 'c.key') ]
+        for src, dst in zip(pair1, copies):
+            shutil.copy(src, dst)
+        self.failUnlessEqual(nodeinfo._ssl_context(*copies),
+            (identity1, ctx1))
+        self.failIfEqual(nodeinfo._ssl_context()[0], identity1)
+
+    def testUnchangedFiles(self):
+        reads = []
+        def _read(path):
+            reads.append(path)
+            return origRead(path)
+        origRead = nodeinfo._read
+        nodeinfo._read = _read
+        try:
+            certFile, keyFile = self._writePair('a', 1)
+            identity, ctx = nodeinfo._ssl_context(certFile, keyFile)
+            self.failUnlessEqual(reads, [ certFile, keyFile ])
+            self.failUnlessEqual(nodeinfo._ssl_context(certFile, keyFile),
+                (identity, ctx))
+            self.failUnlessEqual(len(reads), 2)
+            # New contents under the same names
+            self._writePair('a', 2)
+            st = os.stat(certFile)
+            os.utime(certFile, (st.st_atime, st.st_mtime + 10))
+            identity2, ctx2 = nodeinfo._ssl_context(certFile, keyFile)
+            self.failUnlessEqual(len(reads), 4)
+            self.failIfEqual(identity2, identity)
+            self.failIf(ctx2 is ctx)
+        finally:
+            nodeinfo._read = origRead
+
+    def testBounded(self):
+        maxSize = nodeinfo._ssl_contexts_max_size
+        nodeinfo._ssl_contexts_max_size = 2
+        try:
+            pairs = [ self._writePair(x, i) for i, x in enumerate('abc') ]
+            identities = [ nodeinfo._ssl_context(*x)[0] for x in pairs ]
+            self.failUnlessEqual(nodeinfo._ssl_contexts.keys(),
+                identities[1:])
+        finally:
+            nodeinfo._ssl_contexts_max_size = maxSize
+
+
+class ExpandNetworkTest(testcase.TestCase):
+    def testNetworks(self):
+        self.failUnlessEqual(nodeinfo.expand_network('10.1.2.0/30'),
+            [ '10.1.2.1', '10.1.2.2' ])
+        hosts = nodeinfo.expand_network('10.1.2.0/24')
+        # No network nor broadcast address
+        self.failUnlessEqual((len(hosts), hosts[0], hosts[-1]),
+            (254, '10.1.2.1', '10.1.2.254'))
+        # The host bits are ignored
+        self.failUnlessEqual(nodeinfo.expand_network('10.1.2.77/24'), hosts)
+        self.failUnlessEqual(len(nodeinfo.expand_network('10.0.0.0/16')),
+            65534)
+
+    def testSmallNetworks(self):
+        # Point-to-point links (RFC 3021) use both addresses
+        self.failUnlessEqual(nodeinfo.expand_network('10.1.2.4/31'),
+            [ '10.1.2.4', '10.1.2.5' ])
+        self.failUnlessEqual(nodeinfo.expand_network('10.1.2.4/32'),
+            [ '10.1.2.4' ])
+        self.failUnlessEqual(nodeinfo.expand_network('10.1.2.4'),
+            [ '10.1.2.4' ])
+        self.failUnlessEqual(nodeinfo.expand_network('10.1.2.255/32'),
+            [ '10.1.2.255' ])
+
+    def testMaxHosts(self):
+        self.failUnlessEqual(len(nodeinfo.expand_network('10.1.2.0/29',
+            max_hosts=6)), 6)
+        self.failUnlessRaises(ValueError, nodeinfo.expand_network,
+            '10.1.2.0/28', max_hosts=6)
+        self.failUnlessRaises(ValueError, nodeinfo.expand_network,
+            '10.0.0.0/8')
+
+    def testInvalid(self):
+        for network in [ '', '10.1.2.0/33', '10.1.2.0/-1', '10.1.2.0/abc',
+                '10.1.2/24', '10.1.2.256/24', 'host.example.com/24',
+                '::1/128', '10.1.2.0/' ]:
+            self.failUnlessRaises(ValueError, nodeinfo.expand_network,
+                network)
+
+
+class RttTrackerTest(testcase.TestCase):
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self._origResolver = dnscache.resolver
+        dnscache.resolver = dnscache.DnsCache(getaddrinfo=self._getaddrinfo)
+        self.rtt = nodeinfo.RttTracker(min_samples=2, multiplier=2,
+            floor=0.1)
+
+    def tearDown(self):
+        dnscache.resolver = self._origResolver
+        testcase.TestCase.tearDown(self)
+
+    def _getaddrinfo(self, host, port, family, socktype):
+        addresses = {
+            'a.example.com' : '10.1.2.3',
+            'b.example.com' : '10.1.2.4',
+            'c.example.com' : '10.9.9.9',
+        }
+        if host not in addresses:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name not known')
+        return [ (socket.AF_INET, socket.SOCK_STREAM, 6, '',
+            (addresses[host], 0)) ]
+
+    def testSubnets(self):
+        self.failUnlessEqual(self.rtt.subnet('10.1.2.3'), '10.1.2.0')
+        # Unknown until resolved, and never looked up by the tracker
+        self.failUnlessEqual(self.rtt.subnet('a.example.com'), None)
+        for host in [ 'a.example.com', 'b.example.com', 'c.example.com' ]:
+            dnscache.resolver.lookup(host)
+        self.failUnlessRaises(socket.gaierror, dnscache.resolver.lookup,
+            'missing.example.com')
+        self.failUnlessEqual(self.rtt.subnet('a.example.com'), '10.1.2.0')
+        self.failUnlessEqual(self.rtt.subnet('missing.example.com'), None)
+
+    def testTimeout(self):
+        for host in [ 'a.example.com', 'c.example.com' ]:
+            dnscache.resolver.lookup(host)
+        self.rtt.record('a.example.com', 0.5)
+        self.rtt.record('10.1.2.5', 1.0)
+        self.rtt.record('c.example.com', 3.0)
+        self.failUnlessEqual(self.rtt.timeout('b.example.com'), None)
+        dnscache.resolver.lookup('b.example.com')
+        # Same subnet as the other two, not the one of c.example.com
+        self.failUnlessEqual(self.rtt.timeout('b.example.com'), 2.0)
+        self.failUnlessEqual(self.rtt.timeout('c.example.com', 5), 5)
+
+
+class ProbeEngineTest(testcase.TestCase):
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        self.port = self.listener.getsockname()[1]
+        self.unblock = threading.Event()
+        self._origResolver = dnscache.resolver
+        dnscache.resolver = dnscache.DnsCache(getaddrinfo=self._getaddrinfo)
+
+    def tearDown(self):
+        self.unblock.set()
+        dnscache.resolver = self._origResolver
+        self.listener.close()
+        testcase.TestCase.tearDown(self)
+
+    def _getaddrinfo(self, host, port, family, socktype):
+        if host == 'dual.example.com':
+            # The IPv6 address is in the discard-only prefix (RFC 6666)
+            return [ (socket.AF_INET6, socket.SOCK_STREAM, 6, '',
+                ('100::1', 0, 0, 0)), (socket.AF_INET, socket.SOCK_STREAM,
+                6, '', ('127.0.0.1', 0)) ]
+        if host == 'slow.example.com':
+            self.unblock.wait()
+        elif host != 'fast.example.com':
+            raise socket.gaierror(socket.EAI_NONAME, 'Name not known')
+        return [ (socket.AF_INET, socket.SOCK_STREAM, 6, '',
+            ('127.0.0.1', 0)) ]
+
+    def testSlowLookup(self):
+        engine = nodeinfo.ProbeEngine(timeout=10)
+        probes = [ nodeinfo.Probe(x, self.port, index=i)
+            for i, x in enumerate([ 'slow.example.com', 'fast.example.com',
+                '127.0.0.1', 'missing.example.com' ]) ]
+        results = engine.run(probes)
+        done = {}
+        # The slow lookup does not hold up the other probes
+        for _ in range(3):
+            probe = results.next()
+            done[probe.host] = probe.error
+        self.failUnlessEqual(sorted(done), [ '127.0.0.1', 'fast.example.com',
+            'missing.example.com' ])
+        self.failUnlessEqual(done['fast.example.com'], None)
+        self.failUnless(isinstance(done['missing.example.com'],
+            nodeinfo.ProbeHostError))
+        self.unblock.set()
+        probe = results.next()
+        self.failUnlessEqual((probe.host, probe.error),
+            ('slow.example.com', None))
+        self.failUnlessRaises(StopIteration, results.next)
+
+    def testCachedLookup(self):
+        dnscache.resolver.lookup('fast.example.com')
+        engine = nodeinfo.ProbeEngine(timeout=10)
+        for probe in engine.run([ nodeinfo.Probe('fast.example.com',
+                self.port) ]):
+            self.failUnlessEqual(probe.error, None)
+        # Cached names are resolved right away
+        self.failUnlessEqual(dnscache.resolver.getStats()['hits'], 1)
+
+    def testDualStack(self):
+        start = time.time()
+        sock, family = nodeinfo.connect_dual_stack('dual.example.com',
+            self.port, timeout=10, stagger=0.5)
+        elapsed = time.time() - start
+        sock.close()
+        # The dead IPv6 address is given up on after the stagger delay at
+        # most, not after the timeout
+        self.failUnlessEqual(family, socket.AF_INET)
+        self.failUnless(elapsed < 1.5, elapsed)
+
+    def testExpiredLookup(self):
+        engine = nodeinfo.ProbeEngine(timeout=0.2)
+        probes = list(engine.run([ nodeinfo.Probe('slow.example.com',
+            self.port) ]))
+        self.failUnlessEqual(str(probes[0].error), 'timed out')
+
+testsuite.main()
@@ -0,0 +1,295 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import testsuite
+testsuite.setup()
+
+import socket
+
+from testrunner import testcase
+
+import interface_detection_plugin as idp
+from rpath_repeater.codes import Codes as C
+from rpath_repeater.utils import base_forwarding_plugin as bfp
+from rpath_repeater.utils import dnscache
+from rpath_repeater.utils import nodeinfo
+
+
+class ProbeInterfacesTest(testcase.TestCase):
+    host = '10.1.2.3'
+    interfaces = [ ('/api/wmi', 135), ('/api/cim', 5989),
+        ('/api/ssh', 22) ]
+
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.probed = []
+        self.openPorts = set()
+        self.statuses = []
+        self._origStats = idp.interfaceStats
+        self._origProbe = nodeinfo.iter_probe_hosts
+        idp.interfaceStats = idp.InterfaceStats()
+        nodeinfo.iter_probe_hosts = self._probe
+        self.task = object.__new__(idp.DetectInterfaceTask)
+        self.task.sendStatus = lambda *args: self.statuses.append(args)
+
+    def tearDown(self):
+        idp.interfaceStats = self._origStats
+        nodeinfo.iter_probe_hosts = self._origProbe
+        testcase.TestCase.tearDown(self)
+
+    def _probe(self, targets, timeout, adaptive):
+        targets = list(targets)
+        self.probed.append([ port for _, port in targets ])
+        for index, (host, port) in enumerate(targets):
+            if port in self.openPorts:
+                yield index, None
+            else:
+                yield index, nodeinfo.ProbeHostError('Connection refused')
+
+    def _train(self, interface):
+        for _ in range(idp.InterfaceStats.MinAttempts):
+            idp.interfaceStats.record('10.1.2.99', interface, True)
+
+    def _probeInterfaces(self):
+        return self.task._probeInterfaces(self.host, self.interfaces,
+            timeout=1)
+
+    def testNoPrediction(self):
+        self.openPorts.update([ 5989, 22 ])
+        self.failUnlessEqual(self._probeInterfaces(), ('/api/cim', 5989))
+        self.failUnlessEqual(self.probed, [ [ 135, 5989, 22 ] ])
+
+    def testPredicted(self):
+        self._train(self.interfaces[1])
+        self.openPorts.update([ 5989, 22 ])
+        self.failUnlessEqual(self._probeInterfaces(), ('/api/cim', 5989))
+        # The lower priority interface is not needed
+        self.failUnlessEqual(self.probed, [ [ 5989, 135 ] ])
+        self.failUnlessEqual(len(self.statuses), 1)
+
+    def testPredictedUnavailable(self):
+        self._train(self.interfaces[1])
+        self.openPorts.add(22)
+        self.failUnlessEqual(self._probeInterfaces(), ('/api/ssh', 22))
+        self.failUnlessEqual(self.probed, [ [ 5989, 135 ], [ 22 ] ])
+
+    def testHigherPriorityWins(self):
+        self._train(self.interfaces[1])
+        self.openPorts.update([ 135, 5989 ])
+        self.failUnlessEqual(self._probeInterfaces(), ('/api/wmi', 135))
+
+    def testNoneAvailable(self):
+        self._train(self.interfaces[2])
+        self.failUnlessEqual(self._probeInterfaces(), (None, None))
+        self.failUnlessEqual(self.probed, [ [ 22, 135, 5989 ] ])
+        self.failUnlessEqual(len(self.statuses), 3)
+
+    def testTable(self):
+        self._train(self.interfaces[1])
+        self.openPorts.add(5989)
+        self._probeInterfaces()
+        table = idp.interfaceStats.getTable()
+        self.failUnlessEqual(table.keys(), [ '10.1.2.0' ])
+        self.failUnlessEqual(table['10.1.2.0'][self.interfaces[1]],
+            dict(attempts=9, successes=9, rate=1.0))
+        self.failUnlessEqual(table['10.1.2.0'][self.interfaces[0]],
+            dict(attempts=1, successes=0, rate=0.0))
+
+
+class InterfaceStatsTest(testcase.TestCase):
+    interface = ('/api/ssh', 22)
+
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self._origResolver = dnscache.resolver
+        dnscache.resolver = dnscache.DnsCache(getaddrinfo=self._getaddrinfo)
+        self.stats = idp.InterfaceStats()
+
+    def tearDown(self):
+        dnscache.resolver = self._origResolver
+        testcase.TestCase.tearDown(self)
+
+    def _getaddrinfo(self, host, port, family, socktype):
+        if host != 'a.example.com':
+            raise socket.gaierror(socket.EAI_NONAME, 'Name not known')
+        return [ (socket.AF_INET, socket.SOCK_STREAM, 6, '',
+            ('10.1.2.3', 0)) ]
+
+    def _train(self, host):
+        for _ in range(idp.InterfaceStats.MinAttempts):
+            self.stats.record(host, self.interface, True)
+
+    def testHostNames(self):
+        # Not resolved yet, so its subnet is unknown
+        self._train('a.example.com')
+        self.failUnlessEqual(self.stats.getTable(), {})
+        self.failUnlessEqual(self.stats.predict('a.example.com',
+            [ self.interface ]), None)
+        dnscache.resolver.lookup('a.example.com')
+        self._train('a.example.com')
+        self.failUnlessEqual(self.stats.getTable().keys(), [ '10.1.2.0' ])
+        # Host names and addresses in the same subnet share the outcomes
+        self.failUnlessEqual(self.stats.predict('10.1.2.99',
+            [ ('/api/wmi', 135), self.interface ]), 1)
+        self.failUnlessEqual(self.stats.predict('a.example.com',
+            [ self.interface ]), 0)
+        # Names that cannot be resolved do not make a subnet of their own
+        self._train('missing.example.com')
+        self.failUnlessEqual(self.stats.getTable().keys(), [ '10.1.2.0' ])
+        self.failUnlessEqual(self.stats.predict('missing.example.com',
+            [ self.interface ]), None)
+
+
+class BulkDetectionHandlerTest(testcase.TestCase):
+    interfacesList = [ dict(interfaceHref='/api/ssh', port=22) ]
+
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.statuses = []
+        self.posted = []
+        self.handler = object.__new__(idp.InterfaceBulkDetectionHandler)
+        self.handler.initCall = lambda: None
+        self.handler.setStatus = lambda *args: self.statuses.append(args)
+        self.handler.postFailure = lambda: self.posted.append(None)
+        self.handler.postResults = self.posted.append
+        self.handler.zone = 'zone1'
+        self.handler.interfacesList = self.interfacesList
+        self.handler.hosts = []
+        self.handler.network = None
+
+    def _call(self, hosts=(), network=None):
+        self.handler.hosts = list(hosts)
+        self.handler.network = network
+        return self.handler.callDetectInterfaces()
+
+    def testHosts(self):
+        self.failUnlessEqual(self._call([ 'a.example.com', '10.1.2.1' ],
+            '10.1.2.0/30'), 'detect_management_interfaces')
+        # Duplicates are dropped, the order is kept
+        self.failUnlessEqual(self.handler.hosts,
+            [ 'a.example.com', '10.1.2.1', '10.1.2.2' ])
+        self.failUnlessEqual(self.posted, [])
+
+    def testMaxHosts(self):
+        self.handler.MaxHosts = 4
+        self.failUnlessEqual(self._call(network='10.1.2.0/29'), None)
+        self.failUnlessEqual(self.statuses[-1][0], C.ERR_BAD_ARGS)
+        self.failUnlessEqual(self.posted, [ None ])
+        self.failUnlessEqual(self._call(network='10.1.2.0/30'),
+            'detect_management_interfaces')
+
+    def testBadArgs(self):
+        for hosts, network in [ ([], None), ([], 'bogus/24'),
+                ([ '10.1.2.3' ], '10.1.2.0/40') ]:
+            del self.statuses[:], self.posted[:]
+            self.failUnlessEqual(self._call(hosts, network), None)
+            self.failUnlessEqual(self.statuses[-1][0], C.ERR_BAD_ARGS)
+            self.failUnlessEqual(self.posted, [ None ])
+
+    def testPartialResults(self):
+        class Task(object):
+            class task_data(object):
+                @staticmethod
+                def getObject():
+                    return idp.IDData(None, self.response)
+        self.response = '<systems><system/></systems>'
+        self.handler._postPartialResults(Task)
+        self.failUnlessEqual([ bfp.XML.toString(x) for x in self.posted ],
+            [ '<systems><system/></systems>' ])
+        # Nothing to post
+        self.response = None
+        self.handler._postPartialResults(Task)
+        self.failUnlessEqual(len(self.posted), 1)
+
+
+class BulkDetectionTaskTest(testcase.TestCase):
+    interfacesList = [ dict(interfaceHref='/api/wmi', port=135),
+        dict(interfaceHref='/api/ssh', port=22) ]
+
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.openPorts = {}
+        self.statuses = []
+        self.responses = []
+        self._origStats = idp.interfaceStats
+        self._origProbe = nodeinfo.iter_probe_hosts
+        idp.interfaceStats = idp.InterfaceStats()
+        nodeinfo.iter_probe_hosts = self._probe
+        self.task = object.__new__(idp.DetectInterfacesBulkTask)
+        self.task.ChunkSize = 2
+        self.task.ChunkInterval = 3600
+        self.task.sendStatus = lambda *args: self.statuses.append(args)
+        self.task.setData = lambda data: self.responses.append(
+            (len(self.statuses), data.response))
+
+    def tearDown(self):
+        idp.interfaceStats = self._origStats
+        nodeinfo.iter_probe_hosts = self._origProbe
+        testcase.TestCase.tearDown(self)
+
+    def _probe(self, targets, timeout, concurrency, adaptive):
+        for index, (host, port) in enumerate(targets):
+            if port in self.openPorts.get(host, ()):
+                yield index, None
+            else:
+                yield index, nodeinfo.ProbeHostError('Connection refused')
+
+    def _run(self, hosts):
+        data = idp.IDData(idp.IDBulkParams(hosts, self.interfacesList,
+            None, None, False))
+        self.task.getData = lambda: data
+        self.task._run()
+
+    @classmethod
+    def _addresses(cls, response):
+        return [ x.findtext('network_address/address')
+            for x in bfp.XML.fromString(response) ]
+
+    def testChunks(self):
+        hosts = [ '10.1.2.%d' % x for x in range(1, 6) ]
+        self.openPorts = { '10.1.2.1' : [ 22 ], '10.1.2.3' : [ 135, 22 ] }
+        self._run(hosts)
+        codes = [ x[0] for x in self.statuses ]
+        self.failUnlessEqual(codes, [ C.MSG_PROBE, C.PART_RESULT_1,
+            C.PART_RESULT_1, C.OK ])
+        self.failUnlessEqual(self.statuses[1][1], 'Probed 2 of 5 systems')
+        self.failUnlessEqual(self.statuses[-1][1],
+            'Found management interfaces on 2 of 5 systems')
+        # Each chunk is in the task data when its status is sent, and the
+        # final response only has the systems not reported yet
+        self.failUnlessEqual([ (x, self._addresses(y))
+                for x, y in self.responses ],
+            [ (1, hosts[:2]), (2, hosts[2:4]), (3, hosts[4:]) ])
+
+        systems = list(bfp.XML.fromString(self.responses[0][1]))
+        self.failUnlessEqual(systems[0].find('management_interface').get(
+            'href'), '/api/ssh')
+        self.failUnlessEqual(systems[0].findtext('agent_port'), '22')
+        self.failUnlessEqual(systems[1].find('management_interface'), None)
+        systems = list(bfp.XML.fromString(self.responses[1][1]))
+        self.failUnlessEqual(systems[0].find('management_interface').get(
+            'href'), '/api/wmi')
+
+    def testSingleChunk(self):
+        self._run([ '10.1.2.1', '10.1.2.2' ])
+        # The last chunk is never sent as a partial result
+        self.failUnlessEqual([ x[0] for x in self.statuses ],
+            [ C.MSG_PROBE, C.OK ])
+        self.failUnlessEqual([ self._addresses(y) for _, y in self.responses ],
+            [ [ '10.1.2.1', '10.1.2.2' ] ])
+
+testsuite.main()
@@ -0,0 +1,408 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import testsuite
+testsuite.setup()
+
+import StringIO
+
+from testrunner import testcase
+
+from twisted.internet import defer
+from twisted.internet import error as internet_error
+from twisted.internet import task
+from twisted.python import failure
+from twisted.web import client
+from twisted.web.http_headers import Headers
+
+from rmake3.lib import chutney
+from rmake3.lib.jabberlink import message
+
+import rest_forwarding_plugin as rfp
+from rpath_repeater.utils import framing
+from rpath_repeater.utils import throttle
+
+
+class FakeRequest(object):
+    "Just enough of twisted.web's Request for EndPoint"
+
+    def __init__(self, uri='/api/v1/inventory/systems', body='',
+            headers=None):
+        self.uri = uri
+        self.content = StringIO.StringIO(body)
+        self.requestHeaders = Headers(headers or {})
+        self.responseHeaders = Headers()
+        self.code = None
+        self.written = []
+        self.finished = False
+        self._disconnected = False
+
+    def getClientIP(self):
+        return '10.0.0.1'
+
+    def isSecure(self):
+        return False
+
+    def setResponseCode(self, code):
+        self.code = code
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished = True
+
+
+class FakeLink(object):
+    "Records the messages sent; the test answers them"
+
+    def __init__(self):
+        self.sent = []
+
+    def sendWithDeferred(self, targetJID, msg):
+        d = defer.Deferred()
+        self.sent.append((targetJID, msg, d))
+        return d
+
+    def reply(self, idx, *payloads):
+        self.sent[idx][2].callback([ message.Message(rfp.NS, x)
+            for x in payloads ])
+
+
+class FakeBus(object):
+    targetJID = 'dispatcher@localhost/rmake'
+
+    def __init__(self):
+        self.link = FakeLink()
+
+
+class FakeNeighbor(object):
+    def __init__(self):
+        self.replies = []
+
+    def send(self, msg):
+        self.replies.append(msg)
+
+
+class FakeHandler(rfp.RepeaterMessageHandler):
+    "Answers with the request URL as the body, or fails for /fail"
+
+    def forwardRequest(self, neighbor, reqDict):
+        if reqDict['url'] == '/fail':
+            return defer.fail(RuntimeError("upstream exploded"))
+        return defer.succeed(okReply(reqDict['url']))
+
+
+class FakeResponse(object):
+    def __init__(self, code, phrase, headers, body):
+        self.code = code
+        self.phrase = phrase
+        self.headers = Headers(headers)
+        self.body = body
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(failure.Failure(client.ResponseDone()))
+
+
+class FakeAgent(object):
+    "Records requests; the test answers them"
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, uri, headers, bodyProducer):
+        if bodyProducer is not None:
+            body = bodyProducer._inputFile.read()
+        else:
+            body = None
+        d = defer.Deferred()
+        self.requests.append((method, uri, headers, body, d))
+        return d
+
+
+def okReply(body='<ok/>'):
+    return dict(status=200, message='OK',
+        headers={'Content-Type' : ['application/xml']}, body=body)
+
+
+class EndPointTest(testcase.TestCase):
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.clock = task.Clock()
+        self.bus = FakeBus()
+        self.throttle = throttle.RequestThrottle(maxInFlight=2)
+
+    def _endPoint(self, **kwargs):
+        return rfp.EndPoint(self.bus, throttle=self.throttle,
+            clock=self.clock, **kwargs)
+
+    def testReply(self):
+        endpoint = self._endPoint(replyTimeout=10)
+        request = FakeRequest(body='<system/>')
+        endpoint.sendMsg(request, 'put')
+        _, msg, _ = self.bus.link.sent[0]
+        reqDict = chutney.loads(msg.payload)
+        self.failUnlessEqual((reqDict['method'], reqDict['url'],
+            reqDict['body']), ('PUT', request.uri, '<system/>'))
+        self.failUnlessEqual(reqDict['headers']['X-Forwarded-For'],
+            ['10.0.0.1'])
+        self.bus.link.reply(0, chutney.dumps(okReply()))
+        self.failUnlessEqual((request.code, request.written, request.finished),
+            (200, ['<ok/>'], True))
+        self.failUnlessEqual(self.throttle.getStats()['inFlight'], 0)
+        # The deadline was cancelled along with the reply
+        self.failUnlessEqual(self.clock.getDelayedCalls(), [])
+
+    def testLostReply(self):
+        endpoint = self._endPoint(replyTimeout=10)
+        requests = [ FakeRequest() for _ in range(3) ]
+        for request in requests:
+            endpoint.sendMsg(request, 'GET')
+        self.failUnlessEqual(self.throttle.getStats()['inFlight'], 2)
+        self.failUnlessEqual(self.throttle.getStats()['queueDepth'], 1)
+        # No reply ever comes back
+        self.clock.advance(10)
+        self.failUnlessEqual([ x.code for x in requests[:2] ], [ 504, 504 ])
+        # The queued request got a slot, and its own deadline
+        self.failUnlessEqual(len(self.bus.link.sent), 3)
+        self.failUnlessEqual(self.throttle.getStats()['inFlight'], 1)
+        self.clock.advance(10)
+        self.failUnlessEqual(requests[2].code, 504)
+        self.failUnlessEqual(self.throttle.getStats()['inFlight'], 0)
+        # Late replies are dropped
+        self.bus.link.reply(0, chutney.dumps(okReply()))
+        self.failUnlessEqual(requests[0].written, [])
+
+    def testBusError(self):
+        endpoint = self._endPoint(replyTimeout=10)
+        request = FakeRequest()
+        endpoint.sendMsg(request, 'GET')
+        self.bus.link.sent[0][2].errback(RuntimeError("link down"))
+        self.failUnlessEqual(request.code, 502)
+        self.failUnlessEqual(self.throttle.getStats()['inFlight'], 0)
+
+
+class BatchTest(testcase.TestCase):
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.clock = task.Clock()
+        self.bus = FakeBus()
+        self.batcher = rfp.MessageBatcher(self.bus, 0.01, 16, timeout=10,
+            clock=self.clock)
+        self.endpoint = rfp.EndPoint(self.bus, compactFraming=True,
+            batcher=self.batcher, replyTimeout=10, clock=self.clock)
+        self.handler = FakeHandler('http://localhost:7720', {})
+
+    def _send(self, uris):
+        requests = [ FakeRequest(uri=x) for x in uris ]
+        for request in requests:
+            self.endpoint.sendMsg(request, 'GET')
+        self.clock.advance(0.01)
+        return requests
+
+    def _handle(self, idx):
+        "Have the handler answer a message, and return its reply payload"
+        neighbor = FakeNeighbor()
+        self.handler.onMessage(neighbor, self.bus.link.sent[idx][1])
+        return neighbor.replies[0].payload
+
+    def testRoundTrip(self):
+        requests = self._send([ '/a', '/b', '/c' ])
+        # All three went out in one message
+        self.failUnlessEqual(len(self.bus.link.sent), 1)
+        payload = self.bus.link.sent[0][1].payload
+        self.failUnless(framing.isBatch(payload))
+        self.failUnlessEqual(len(framing.decodeBatch(payload)), 3)
+        self.bus.link.reply(0, self._handle(0))
+        self.failUnlessEqual([ (x.code, x.written) for x in requests ],
+            [ (200, ['/a']), (200, ['/b']), (200, ['/c']) ])
+
+    def testSingle(self):
+        # A lone request is not wrapped in a batch
+        request, = self._send([ '/a' ])
+        payload = self.bus.link.sent[0][1].payload
+        self.failIf(framing.isBatch(payload))
+        self.failUnless(framing.isFramed(payload))
+        self.bus.link.reply(0, self._handle(0))
+        self.failUnlessEqual((request.code, request.written), (200, ['/a']))
+
+    def testFailedFrame(self):
+        requests = self._send([ '/a', '/fail', '/c' ])
+        self.bus.link.reply(0, self._handle(0))
+        # The failure does not affect the other requests of the batch
+        self.failUnlessEqual([ (x.code, x.written) for x in requests ],
+            [ (200, ['/a']), (500, []), (200, ['/c']) ])
+
+    def testCorruptFrame(self):
+        frames = [ framing.encodeRequest('GET', '/a', {}, ''), 'garbage',
+            framing.encodeRequest('GET', '/c', {}, '') ]
+        neighbor = FakeNeighbor()
+        self.handler.onMessage(neighbor, message.Message(rfp.NS,
+            framing.encodeBatch(frames)))
+        replies = framing.decodeBatch(neighbor.replies[0].payload)
+        self.failUnlessEqual([ framing.decodeReply(x)['status']
+            for x in replies ], [ 200, 500, 200 ])
+
+    def testReplyCountMismatch(self):
+        requests = self._send([ '/a', '/b', '/c' ])
+        replies = framing.decodeBatch(self._handle(0))
+        self.bus.link.reply(0, framing.encodeBatch(replies[:2]))
+        # Replies cannot be matched to requests, so they all fail
+        self.failUnlessEqual([ x.code for x in requests ], [ 502 ] * 3)
+        self.failUnlessEqual([ x.written for x in requests ], [ [] ] * 3)
+
+    def testNoBatchSupport(self):
+        requests = self._send([ '/a', '/b' ])
+        self.clock.advance(10)
+        self.failUnlessEqual([ x.code for x in requests ], [ 504, 504 ])
+        self.failUnlessEqual(self.batcher.unbatched,
+            set([ self.bus.targetJID ]))
+        # From then on, requests go one by one, without waiting
+        self.endpoint.sendMsg(FakeRequest(uri='/c'), 'GET')
+        self.endpoint.sendMsg(FakeRequest(uri='/d'), 'GET')
+        self.failUnlessEqual(len(self.bus.link.sent), 3)
+        self.failIf(framing.isBatch(self.bus.link.sent[1][1].payload))
+
+class DirectForwarderTest(testcase.TestCase):
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.bus = FakeBus()
+        self.direct = rfp.DirectForwarder('http://rbuilder.example.com/',
+            zone='zone1', retryInterval=60, clock=self.clock)
+        self.direct.agent = FakeAgent()
+        self.endpoint = rfp.EndPoint(self.bus, clock=self.clock)
+        self.endpoint.direct = self.direct
+
+    def _fail(self, idx, exception):
+        self.direct.agent.requests[idx][4].errback(exception)
+
+    def testForward(self):
+        results = []
+        self.direct.forward('PUT', '/api/v1/systems/1', {
+            'Content-Type' : ['application/xml'], 'X-Custom' : ['a', 'b'],
+            'Connection' : ['close'], 'Content-Length' : ['9'],
+            rfp.RepeaterMessageHandler.XHeader : ['forged'] },
+            '<system/>').addCallback(results.append)
+        method, uri, headers, body, d = self.direct.agent.requests[0]
+        self.failUnlessEqual((method, uri, body),
+            ('PUT', 'http://rbuilder.example.com/api/v1/systems/1',
+                '<system/>'))
+        self.failUnlessEqual(headers.getRawHeaders('X-Custom'), ['a', 'b'])
+        self.failUnlessEqual(headers.getRawHeaders('Content-Type'),
+            ['application/xml'])
+        # Hop-by-hop headers are left to the agent, and the zone header is
+        # ours to set
+        self.failIf(headers.hasHeader('Connection'))
+        self.failIf(headers.hasHeader('Content-Length'))
+        self.failUnlessEqual(headers.getRawHeaders(
+            rfp.RepeaterMessageHandler.XHeader), ['em9uZTE='])
+        self.failUnlessEqual(headers.getRawHeaders(
+            rfp.RepeaterMessageHandler.XRepeaterHeader), ['remote'])
+        d.callback(FakeResponse(201, 'Created',
+            { 'Location' : ['/api/v1/systems/2'] }, '<system id="2"/>'))
+        self.failUnlessEqual(results, [ dict(status=201, message='Created',
+            headers={ 'Location' : ['/api/v1/systems/2'] },
+            body='<system id="2"/>') ])
+
+    def testNoBody(self):
+        self.direct.forward('GET', '/api', {}, '')
+        self.failUnlessEqual(self.direct.agent.requests[0][3], None)
+
+    def testCanRetry(self):
+        for error in [ internet_error.ConnectionRefusedError(),
+                internet_error.DNSLookupError() ]:
+            self.failUnless(self.direct.canRetry(failure.Failure(error),
+                'POST'))
+        lost = failure.Failure(internet_error.ConnectionLost())
+        for method in [ 'GET', 'head', 'PUT', 'DELETE' ]:
+            self.failUnless(self.direct.canRetry(lost, method))
+        self.failIf(self.direct.canRetry(lost, 'POST'))
+
+    def testAvailability(self):
+        self.failUnless(self.direct.isAvailable())
+        self.direct.markDown()
+        self.failIf(self.direct.isAvailable())
+        self.clock.advance(59)
+        self.failIf(self.direct.isAvailable())
+        self.clock.advance(1)
+        self.failUnless(self.direct.isAvailable())
+
+    def testDirectReply(self):
+        request = FakeRequest(body='<system/>')
+        self.endpoint.sendMsg(request, 'post')
+        method, _, headers, body, d = self.direct.agent.requests[0]
+        self.failUnlessEqual((method, body), ('POST', '<system/>'))
+        self.failUnlessEqual(headers.getRawHeaders('X-Forwarded-For'),
+            ['10.0.0.1'])
+        d.callback(FakeResponse(200, 'OK', {}, '<ok/>'))
+        self.failUnlessEqual((request.code, request.written), (200, ['<ok/>']))
+        self.failUnlessEqual(self.bus.link.sent, [])
+
+    def testBusFallback(self):
+        request = FakeRequest(body='<system/>')
+        self.endpoint.sendMsg(request, 'GET')
+        self._fail(0, internet_error.ConnectionLost())
+        # Replayed over the bus
+        self.failUnlessEqual(len(self.bus.link.sent), 1)
+        reqDict = chutney.loads(self.bus.link.sent[0][1].payload)
+        self.failUnlessEqual((reqDict['method'], reqDict['body']),
+            ('GET', '<system/>'))
+        self.bus.link.reply(0, chutney.dumps(okReply()))
+        self.failUnlessEqual((request.code, request.written), (200, ['<ok/>']))
+        self.failIf(self.direct.isAvailable())
+
+    def testPostFailure(self):
+        request = FakeRequest(body='<system/>')
+        self.endpoint.sendMsg(request, 'POST')
+        self._fail(0, internet_error.ConnectionLost())
+        # The server may have seen it, so it is not replayed
+        self.failUnlessEqual(request.code, 502)
+        self.failUnlessEqual(self.bus.link.sent, [])
+        # but the route is down all the same
+        self.failIf(self.direct.isAvailable())
+        self.endpoint.sendMsg(FakeRequest(), 'GET')
+        self.failUnlessEqual(len(self.direct.agent.requests), 1)
+        self.failUnlessEqual(len(self.bus.link.sent), 1)
+        self.clock.advance(60)
+        self.endpoint.sendMsg(FakeRequest(), 'GET')
+        self.failUnlessEqual(len(self.direct.agent.requests), 2)
+
+    def testPostNotConnected(self):
+        request = FakeRequest(body='<system/>')
+        self.endpoint.sendMsg(request, 'POST')
+        self._fail(0, internet_error.ConnectionRefusedError())
+        # Never reached the server, so safe to replay
+        self.failUnlessEqual(len(self.bus.link.sent), 1)
+        self.failIf(self.direct.isAvailable())
+
+
+class IsLocalHostTest(testcase.TestCase):
+    def _isLocalHost(self, host):
+        results = []
+        rfp.isLocalHost(host).addCallback(results.append)
+        return results
+
+    def testLocal(self):
+        self.failUnlessEqual(self._isLocalHost('127.0.0.1'), [ True ])
+        self.failUnlessEqual(self._isLocalHost('127.1.2.3'), [ True ])
+        # TEST-NET-1, not assigned to anyone
+        self.failUnlessEqual(self._isLocalHost('192.0.2.1'), [ False ])
+
+testsuite.main()
@@ -0,0 +1,109 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import testsuite
+testsuite.setup()
+
+import os
+import shutil
+import socket
+import tempfile
+
+from testrunner import testcase
+
+from rpath_repeater.codes import Codes as C
+from rpath_repeater.utils import sshfleet
+from tests import sshserver
+
+class FleetRunnerTest(testcase.TestCase):
+    sshAuth = [ dict(sshUser='root', sshPassword='password') ]
+
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.workDir = tempfile.mkdtemp()
+        self.server = sshserver.SshServer()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.workDir)
+        testcase.TestCase.tearDown(self)
+
+    def _hosts(self, count):
+        return [ ('127.0.0.1', self.server.port) ] * count
+
+    def _closedPort(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def testCommand(self):
+        runner = sshfleet.FleetRunner(self._hosts(3), self.sshAuth,
+            command='echo out; echo err >&2', concurrency=2)
+        results = list(runner.run())
+        self.failUnlessEqual([ x.code for x in results ], [ C.OK ] * 3)
+        self.failUnlessEqual(set((x.status, x.output, x.errorOutput)
+            for x in results), set([ (0, 'out\n', 'err\n') ]))
+
+    def testExitStatus(self):
+        runner = sshfleet.FleetRunner(self._hosts(1), self.sshAuth,
+            command='exit 3')
+        result, = list(runner.run())
+        self.failUnlessEqual((result.code, result.status), (C.OK_1, 3))
+
+    def testOutputTail(self):
+        runner = sshfleet.FleetRunner(self._hosts(1), self.sshAuth,
+            command='seq 1000', maxOutput=9)
+        result, = list(runner.run())
+        self.failUnlessEqual(result.output, '999\n1000\n')
+
+    def testPutFiles(self):
+        local = os.path.join(self.workDir, 'local')
+        remote = os.path.join(self.workDir, 'remote')
+        file(local, 'w').write('data')
+        runner = sshfleet.FleetRunner(self._hosts(1), self.sshAuth,
+            putFiles=[ (local, remote) ])
+        result, = list(runner.run())
+        self.failUnlessEqual(result.code, C.OK)
+        self.failUnlessEqual(file(remote).read(), 'data')
+
+    def testFailures(self):
+        port = self._closedPort()
+        runner = sshfleet.FleetRunner([ ('127.0.0.1', port) ],
+            [ dict(sshUser='root', sshPassword='wrong') ] )
+        result, = list(runner.run())
+        self.failUnlessEqual((result.host, result.port, result.code),
+            ('127.0.0.1', port, C.ERR_NOT_FOUND))
+        runner = sshfleet.FleetRunner(self._hosts(1),
+            [ dict(sshUser='root', sshPassword='wrong') ], command='true')
+        result, = list(runner.run())
+        self.failUnlessEqual(result.code, C.ERR_AUTHENTICATION)
+
+    def testUnexpectedError(self):
+        class Runner(sshfleet.FleetRunner):
+            def _runHost(self, host):
+                raise RuntimeError("close failed")
+        runner = Runner(self._hosts(2) + [ 'other.example.com' ],
+            self.sshAuth, command='true', port=2222)
+        results = sorted(runner.run(), key=lambda x: x.host)
+        self.failUnlessEqual([ (x.host, x.code, x.message) for x in results ],
+            [ ('127.0.0.1', C.ERR_GENERIC, 'Error: close failed') ] * 2 +
+            [ ('other.example.com', C.ERR_GENERIC, 'Error: close failed') ])
+        self.failUnlessEqual(results[-1].port, 2222)
+
+testsuite.main()
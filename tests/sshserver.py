@@ -0,0 +1,196 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+In-process SSH server for the tests. Commands run locally through the
+shell, and SFTP works on the local file system.
+"""
+
+
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+
+HostKey = paramiko.RSAKey.generate(1024)
+
+
+class _SftpHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(
+            os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class _SftpServer(paramiko.SFTPServerInterface):
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0600)
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_APPEND:
+            mode = 'ab'
+        elif flags & os.O_RDWR:
+            mode = 'r+b'
+        elif flags & os.O_WRONLY:
+            mode = 'wb'
+        else:
+            mode = 'rb'
+        handle = _SftpHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldPath, newPath):
+        try:
+            os.rename(oldPath, newPath)
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    posix_rename = rename
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, server, transport):
+        self.server = server
+        self.transport = transport
+
+    def _sessions(self):
+        return len([ x for x in self.transport._channels.values()
+            if not x.closed ])
+
+    def check_channel_request(self, kind, chanid):
+        sessions = self._sessions()
+        with self.server.lock:
+            if (self.server.maxSessions is not None and
+                    sessions >= self.server.maxSessions):
+                self.server.refused += 1
+                return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+            self.server.peakSessions = max(self.server.peakSessions,
+                sessions + 1)
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_auth_password(self, user, password):
+        self.server.auths += 1
+        if self.server.users.get(user) == password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_publickey(self, user, key):
+        self.server.auths += 1
+        expected = self.server.keys.get(user)
+        if expected is not None and expected.get_base64() == key.get_base64():
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, user):
+        return 'password,publickey'
+
+    def check_channel_subsystem_request(self, channel, name):
+        self.server.sftpSessions += 1
+        return paramiko.ServerInterface.check_channel_subsystem_request(self,
+            channel, name)
+
+    def check_channel_exec_request(self, channel, command):
+        self.server.commands.append(command)
+        def run():
+            proc = subprocess.Popen(command, shell=True,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+            channel.sendall(out)
+            channel.sendall_stderr(err)
+            channel.send_exit_status(proc.returncode)
+            channel.close()
+        thread = threading.Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+        return True
+
+
+class SshServer(object):
+    """
+    Accepts password (users maps user names to passwords) and public key
+    (keys maps user names to keys) logins. With maxSessions set, channels
+    beyond that many per connection are refused, like sshd's MaxSessions.
+    """
+
+    def __init__(self, users=None, keys=None, maxSessions=None):
+        self.users = users or dict(root='password')
+        self.keys = keys or {}
+        self.maxSessions = maxSessions
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.auths = 0
+        self.sftpSessions = 0
+        self.peakSessions = 0
+        self.refused = 0
+        self.commands = []
+        self.transports = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(HostKey)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                _SftpServer)
+            transport.start_server(server=_ServerInterface(self, transport))
+            self.transports.append(transport)
+
+    def close(self):
+        try:
+            # Wakes up the accepting thread
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
@@ -0,0 +1,330 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import testsuite
+testsuite.setup()
+
+import os
+import shutil
+import socket
+import StringIO
+import tempfile
+
+import paramiko
+from testrunner import testcase
+
+from rpath_repeater.utils import ssh
+from tests import sshserver
+
+class SshTestBase(testcase.TestCase):
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.workDir = tempfile.mkdtemp()
+        self.server = sshserver.SshServer()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.workDir)
+        testcase.TestCase.tearDown(self)
+
+    def _path(self, name):
+        return os.path.join(self.workDir, name)
+
+    def _write(self, name, contents):
+        file(self._path(name), 'w').write(contents)
+        return self._path(name)
+
+    def _read(self, name):
+        return file(self._path(name)).read()
+
+    def _connect(self, **kwargs):
+        return ssh.SshConnector('127.0.0.1', self.server.port, **kwargs)
+
+class SshConnectorTest(SshTestBase):
+    def testExec(self):
+        conn = self._connect()
+        try:
+            self.failUnlessEqual(conn.execCommand('echo hello'),
+                (0, 'hello'))
+            self.failUnlessEqual(conn.execCommand('echo oops >&2; exit 3'),
+                (3, ''))
+        finally:
+            conn.close()
+
+    def testConnectError(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        # Not a ProbeHostError, which task handlers report as a missing
+        # management interface
+        try:
+            ssh.SshConnector('127.0.0.1', port)
+        except Exception, e:
+            self.failUnlessEqual(type(e), socket.error)
+        else:
+            self.fail("connected to a closed port")
+        racer = ssh.CredentialRacer('127.0.0.1', port,
+            [ dict(sshUser='root', sshPassword='password') ])
+        self.failUnlessRaises(socket.error, racer.connect)
+
+    def testClientClass(self):
+        connects = []
+        class Client(paramiko.SSHClient):
+            def connect(self, hostname, **kwargs):
+                connects.append(kwargs.get('sock'))
+                return paramiko.SSHClient.connect(self, hostname, **kwargs)
+        # An alternative client class makes its own connection
+        self._connect(clientClass=Client).close()
+        self.failUnlessEqual(connects, [ None ])
+        sockets = []
+        def socketFactory(host, port, timeout):
+            sockets.append(socket.create_connection((host, port), timeout))
+            return sockets[-1], socket.AF_INET
+        self._connect(clientClass=Client, socketFactory=socketFactory).close()
+        self.failUnlessEqual(connects[1:], sockets)
+
+    def testSftpSession(self):
+        conn = self._connect()
+        try:
+            conn.putFiles([ (self._write('a', 'A'), self._path('ra')),
+                (self._write('b', 'B'), self._path('rb')) ])
+            conn.getFile(self._path('ra'), self._path('la'))
+            conn.unlinkFiles([ self._path('ra') ])
+        finally:
+            conn.close()
+        self.failUnlessEqual(self._read('rb'), 'B')
+        self.failUnlessEqual(self._read('la'), 'A')
+        self.failIf(os.path.exists(self._path('ra')))
+        # All transfers went over one session
+        self.failUnlessEqual(self.server.sftpSessions, 1)
+
+    def testRunConcurrently(self):
+        self.server.maxSessions = 4
+        conn = self._connect()
+        try:
+            # The connector's own SFTP session counts against the limit
+            conn.putFile(self._write('a', 'A'), self._path('ra'))
+            operations = []
+            for i in range(6):
+                operations.append((conn.EXEC, 'echo %d' % i))
+                operations.append((conn.PUT, self._write('f%d' % i, str(i)),
+                    self._path('r%d' % i)))
+            operations.append((conn.GET, self._path('r0'), self._path('g0')))
+            operations.append(('bogus', ))
+            results = conn.runConcurrently(operations, maxChannels=4)
+        finally:
+            conn.close()
+        self.failUnlessEqual(results[:12:2],
+            [ (0, str(i)) for i in range(6) ])
+        self.failUnlessEqual(results[1:12:2], [ None ] * 6)
+        self.failUnlessEqual(results[12], None)
+        self.failUnless(isinstance(results[13], ValueError))
+        self.failUnlessEqual(self._read('g0'), '0')
+        self.failUnlessEqual(self.server.refused, 0)
+        self.failUnless(self.server.peakSessions <= 4)
+
+    def testRetries(self):
+        calls = []
+        class FlakySftp(object):
+            "Every operation fails with EOFError the first time"
+            def __getattr__(self, name):
+                def call(*args, **kwargs):
+                    calls.append(name)
+                    if calls.count(name) == 1:
+                        raise EOFError()
+                return call
+        conn = self._connect()
+        try:
+            conn._sftp = FlakySftp
+            conn.getFile(self._path('ra'), self._path('la'))
+            conn.putFile(self._path('la'), self._path('ra'))
+            # Not idempotent, so not retried
+            self.failUnlessRaises(EOFError, conn.unlink, self._path('ra'))
+        finally:
+            conn.close()
+        self.failUnlessEqual(calls, [ 'get', 'get', 'put', 'put', 'unlink' ])
+
+    def testResumable(self):
+        data = ''.join(chr(x % 251) for x in range(100000))
+        localFile = self._write('l', data)
+        remoteFile = self._path('r')
+        conn = self._connect()
+        try:
+            # Interrupted upload
+            self._write('r.part', data[:30000])
+            conn.putFileResumable(localFile, remoteFile)
+            self.failUnlessEqual(self._read('r'), data)
+            self.failIf(os.path.exists(remoteFile + '.part'))
+            # Left over by an upload of other contents
+            self._write('r.part', 'x' * 30000)
+            conn.putFileResumable(localFile, remoteFile)
+            self.failUnlessEqual(self._read('r'), data)
+            # Larger than the file
+            self._write('r.part', data + data)
+            conn.putFileResumable(localFile, remoteFile)
+            self.failUnlessEqual(self._read('r'), data)
+        finally:
+            conn.close()
+
+    def testPool(self):
+        pool = ssh.TransportPool(maxSize=2)
+        conn = self._connect(pool=pool)
+        self.failUnlessEqual(conn.execCommand('true'), (0, ''))
+        conn.close()
+        conn = self._connect(pool=pool)
+        self.failUnlessEqual(conn.execCommand('true'), (0, ''))
+        conn.close()
+        self.failUnlessEqual(self.server.connections, 1)
+        # Different credentials use a different connection
+        self.server.users['other'] = 'secret'
+        conn = self._connect(pool=pool, user='other', password='secret')
+        conn.close()
+        self.failUnlessEqual(self.server.connections, 2)
+        stats = pool.getStats()
+        self.failUnlessEqual(stats['idle'], 2)
+        pool.clear()
+        self.failUnlessEqual(pool.getStats()['idle'], 0)
+
+
+def _keyString(key, password=None):
+    out = StringIO.StringIO()
+    key.write_private_key(out, password=password)
+    return out.getvalue()
+
+class CredentialRacerTest(SshTestBase):
+    def setUp(self):
+        SshTestBase.setUp(self)
+        self.key = paramiko.RSAKey.generate(1024)
+        self.server.users = dict(root='password', other='secret')
+        self.server.keys = dict(keyed=self.key)
+
+    def _racer(self, sshAuth, **kwargs):
+        return ssh.CredentialRacer('127.0.0.1', self.server.port, sshAuth,
+            **kwargs)
+
+    def testWinner(self):
+        sshAuth = [ dict(sshUser='root', sshPassword='wrong'),
+            dict(sshUser='nobody', sshPassword='x'),
+            dict(sshUser='root', sshPassword='password'),
+            dict(sshUser='keyed', sshKey=_keyString(self.key)), ]
+        conn = self._racer(sshAuth).connect()
+        try:
+            self.failUnless(conn.user in ('root', 'keyed'))
+            self.failUnlessEqual(conn.execCommand('echo hi'), (0, 'hi'))
+        finally:
+            conn.close()
+
+    def testFailure(self):
+        racer = self._racer([ dict(sshUser='root', sshPassword='wrong'),
+            dict(sshUser='other', sshPassword='wrong') ])
+        self.failUnlessRaises(paramiko.AuthenticationException,
+            racer.connect)
+        self.failUnlessRaises(paramiko.AuthenticationException,
+            self._racer([]).connect)
+
+    def testUnreadableKey(self):
+        def loadPrivateKey(key, password=None):
+            raise IOError(13, "Permission denied")
+        origLoad = ssh.loadPrivateKey
+        ssh.loadPrivateKey = loadPrivateKey
+        try:
+            racer = self._racer([ dict(sshUser='keyed', sshKey='unreadable') ])
+            try:
+                racer.connect()
+            except IOError, e:
+                self.failUnlessEqual(e.errno, 13)
+            else:
+                self.fail("IOError not raised")
+            # The other credentials of the same user are still tried
+            racer = self._racer([ dict(sshUser='root', sshKey='unreadable'),
+                dict(sshUser='root', sshPassword='password') ])
+            conn = racer.connect()
+            try:
+                self.failUnlessEqual(conn.execCommand('true'), (0, ''))
+            finally:
+                conn.close()
+        finally:
+            ssh.loadPrivateKey = origLoad
+
+    def testNothingTried(self):
+        racer = self._racer([ dict(sshUser='root', sshPassword='password') ])
+        err = racer._failure(ssh._Race([]))
+        self.failUnless(isinstance(err, paramiko.SSHException))
+        self.failUnlessEqual(str(err), "No credentials could be tried")
+
+    def testReuse(self):
+        racer = self._racer([ dict(sshUser='other', sshPassword='secret') ])
+        for _ in range(2):
+            conn = racer.connect()
+            self.failUnlessEqual(conn.execCommand('true'), (0, ''))
+            conn.close()
+        self.failUnlessEqual(self.server.connections, 2)
+        # A failed attempt does not carry over either
+        self.server.users['other'] = 'changed'
+        self.failUnlessRaises(paramiko.AuthenticationException,
+            racer.connect)
+        self.server.users['other'] = 'secret'
+        racer.connect().close()
+
+    def testPool(self):
+        pool = ssh.TransportPool()
+        racer = self._racer([ dict(sshUser='root', sshPassword='password') ],
+            pool=pool)
+        racer.connect().close()
+        racer.connect().close()
+        self.failUnlessEqual(self.server.connections, 1)
+        pool.clear()
+
+
+class KeyCacheTest(testcase.TestCase):
+    def testLoad(self):
+        cache = ssh.KeyCache(maxSize=2)
+        keys = [ paramiko.RSAKey.generate(1024) for _ in range(3) ]
+        keyStrings = [ _keyString(x) for x in keys ]
+        pkey = cache.load(keyStrings[0])
+        self.failUnlessEqual(pkey.get_base64(), keys[0].get_base64())
+        self.failUnless(cache.load(keyStrings[0]) is pkey)
+        self.failUnlessEqual((cache.hits, cache.misses), (1, 1))
+        cache.load(keyStrings[1])
+        cache.load(keyStrings[2])
+        # The least recently used key was dropped
+        self.failIf(cache.load(keyStrings[0]) is pkey)
+        self.failUnlessEqual(cache.misses, 4)
+        cache.clear()
+        cache.load(keyStrings[2])
+        self.failUnlessEqual(cache.misses, 5)
+
+    def testPassword(self):
+        cache = ssh.KeyCache()
+        key = paramiko.RSAKey.generate(1024)
+        keyString = _keyString(key, password='pass')
+        self.failUnlessRaises(paramiko.PasswordRequiredException,
+            cache.load, keyString)
+        self.failUnlessRaises(paramiko.SSHException,
+            cache.load, keyString, 'wrong')
+        pkey = cache.load(keyString, 'pass')
+        self.failUnlessEqual(pkey.get_base64(), key.get_base64())
+        # The passphrase is part of the cache key
+        self.failUnlessRaises(paramiko.SSHException,
+            cache.load, keyString, 'wrong')
+
+    def testUnsupported(self):
+        self.failUnlessRaises(paramiko.SSHException,
+            ssh.KeyCache().load, 'not a key')
+
+testsuite.main()
@@ -0,0 +1,91 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from twisted.internet import defer
+
+from rpath_repeater.utils import throttle
+
+class RequestThrottleTest(testcase.TestCase):
+    def _acquire(self, thr, key, granted):
+        d = thr.acquire(key)
+        d.addCallback(granted.append)
+        return d
+
+    def testLimit(self):
+        thr = throttle.RequestThrottle(maxInFlight=2)
+        granted = []
+        for key in 'abc':
+            self._acquire(thr, key, granted)
+        self.failUnlessEqual(granted, ['a', 'b'])
+        self.failUnlessEqual(thr.getStats()['queueDepth'], 1)
+        thr.release('a')
+        self.failUnlessEqual(granted, ['a', 'b', 'c'])
+        self.failUnlessEqual(thr.inFlight, 2)
+
+    def testPerKeyLimit(self):
+        thr = throttle.RequestThrottle(maxInFlight=3, maxInFlightPerKey=1)
+        granted = []
+        for key in 'aab':
+            self._acquire(thr, key, granted)
+        # The second request for a waits, without blocking b
+        self.failUnlessEqual(granted, ['a', 'b'])
+        thr.release('a')
+        self.failUnlessEqual(granted, ['a', 'b', 'a'])
+
+    def testFifo(self):
+        thr = throttle.RequestThrottle(maxInFlight=1)
+        granted = []
+        for key in 'abcd':
+            self._acquire(thr, key, granted)
+        for key in 'abc':
+            thr.release(key)
+        self.failUnlessEqual(granted, ['a', 'b', 'c', 'd'])
+
+    def testShed(self):
+        thr = throttle.RequestThrottle(maxInFlight=1, maxQueued=1)
+        calls = []
+        failures = []
+        blocker = defer.Deferred()
+        thr.run(None, lambda: blocker)
+        thr.run(None, calls.append, 'queued')
+        d = thr.run(None, calls.append, 'shed')
+        d.addErrback(lambda f: failures.append(f.trap(throttle.ThrottleFull)))
+        self.failUnlessEqual(failures, [throttle.ThrottleFull])
+        self.failUnlessEqual(thr.getStats()['shed'], 1)
+        # Completing the first request runs the queued one
+        blocker.callback(None)
+        self.failUnlessEqual(calls, ['queued'])
+        self.failUnlessEqual(thr.inFlight, 0)
+
+    def testUnlimitedQueue(self):
+        for maxQueued in (None, 0):
+            thr = throttle.RequestThrottle(maxInFlight=1,
+                maxQueued=maxQueued)
+            granted = []
+            failures = []
+            for key in range(10):
+                d = self._acquire(thr, key, granted)
+                d.addErrback(failures.append)
+            self.failUnlessEqual(failures, [])
+            self.failUnlessEqual(thr.getStats()['queueDepth'], 9)
+
+testsuite.main()